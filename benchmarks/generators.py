@@ -0,0 +1,119 @@
+"""synthetic IOC lists and CSV files for the benchmarks"""
+
+import csv
+import hashlib
+import random
+import socket
+import struct
+
+IOC_TYPES = ("ip", "domain", "url", "md5", "sha1", "sha256")
+WORDS = (
+    "alpha",
+    "bravo",
+    "cdn",
+    "delta",
+    "echo",
+    "files",
+    "login",
+    "mail",
+    "secure",
+    "update",
+)
+TLDS = ("com", "net", "org", "info", "ru", "xyz")
+
+
+def random_ipv4(rng):
+    return socket.inet_ntoa(struct.pack("!I", rng.getrandbits(32)))
+
+
+def random_domain(rng):
+    return "{}-{}{}.{}".format(
+        rng.choice(WORDS), rng.choice(WORDS), rng.getrandbits(24), rng.choice(TLDS)
+    )
+
+
+def random_value(rng, ioc_type):
+    if ioc_type == "ip":
+        return random_ipv4(rng)
+    if ioc_type == "domain":
+        return random_domain(rng)
+    if ioc_type == "url":
+        return "http://{}/{}".format(random_domain(rng), rng.getrandbits(32))
+    seed = str(rng.getrandbits(64)).encode()
+    return hashlib.new(ioc_type, seed).hexdigest()
+
+
+def unique_values(size, generate, seed=0, exclude=()):
+    """generating size distinct values not in exclude"""
+    rng = random.Random(seed)
+    excluded = set(exclude)
+    values = set()
+    while len(values) < size:
+        value = generate(rng)
+        if value not in excluded:
+            values.add(value)
+    return list(values)
+
+
+def ipv4_blacklist(size, seed=0, density=0.0):
+    """random addresses, a density share of them listed as contiguous ranges"""
+    rng = random.Random(seed)
+    ranged = set()
+    target = int(size * density)
+    while len(ranged) < target:
+        start = rng.getrandbits(24) << 8
+        length = min(target - len(ranged), rng.choice((8, 16, 64, 256)))
+        ranged.update(
+            socket.inet_ntoa(struct.pack("!I", start + offset))
+            for offset in range(length)
+        )
+    return list(ranged) + unique_values(
+        size - len(ranged), random_ipv4, seed, exclude=ranged
+    )
+
+
+def domain_blacklist(size, seed=0):
+    return unique_values(size, random_domain, seed)
+
+
+def churn(values, ratio, generate=random_ipv4, seed=1):
+    """removing ratio of the values and adding as many new ones"""
+    rng = random.Random(seed)
+    changed = int(len(values) * ratio)
+    kept = rng.sample(values, len(values) - changed)
+    return kept + unique_values(changed, generate, seed, exclude=values)
+
+
+def write_blacklist(path, values, comments=True):
+    with open(path, "w") as output:
+        if comments:
+            output.write("# synthetic blacklist, {} entries\n".format(len(values)))
+        for value in values:
+            output.write(value + "\n")
+
+
+def ioc_rows(size, invalid_ratio=0.0, duplicate_ratio=0.0, types=IOC_TYPES, seed=0):
+    """generating [value, type, description] rows with invalid and duplicated ones"""
+    rng = random.Random(seed)
+    rows = []
+    for index in range(size):
+        draw = rng.random()
+        if draw < invalid_ratio:
+            rows.append(["not-an-ioc-{}".format(index), rng.choice(types), "invalid"])
+        elif draw < invalid_ratio + duplicate_ratio and len(rows) > 0:
+            rows.append(list(rng.choice(rows)))
+        else:
+            ioc_type = rng.choice(types)
+            rows.append(
+                [random_value(rng, ioc_type), ioc_type, "synthetic " + ioc_type]
+            )
+    return rows
+
+
+def write_csv(path, rows, report_description=None):
+    with open(path, "w", newline="") as output:
+        writer = csv.writer(output, quoting=csv.QUOTE_ALL)
+        for row in rows:
+            writer.writerow(row)
+        if report_description is not None:
+            writer.writerow(["_report", report_description])
@@ -0,0 +1,374 @@
+"""stand-in for the pycti package, recording API calls and injecting latency
+
+install() registers the mock as the pycti module, so connectors import it
+unchanged. Every API call is counted per method and can be slowed down by a
+fixed latency plus a random jitter to mimic a remote OpenCTI platform.
+"""
+
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+from collections import Counter
+
+# latency applied to every API call, set by the benchmark before the connector starts
+settings = {"latency": 0.0, "jitter": 0.0}
+# helpers created by the connector, the benchmark inspects the last one
+helpers = []
+
+# query sent by the entity helpers, answered by the MockApi handlers
+ENTITY_QUERY = "mock entity call"
+NAMESPACE = uuid.UUID("6ba7b811-9dad-11d1-80b4-00c04fd430c8")
+
+
+def _stable_id(entity_type, key):
+    # uuid4 form, stix2 1.4.0 rejects ids of other uuid versions
+    digest = uuid.uuid5(NAMESPACE, entity_type + ":" + key).int
+    return entity_type + "--" + str(uuid.UUID(int=digest, version=4))
+
+
+class CustomProperties:
+    REPORT_CLASS = "x_opencti_report_class"
+    OBSERVABLE_TYPE = "x_opencti_observable_type"
+    OBSERVABLE_VALUE = "x_opencti_observable_value"
+    CREATE_OBSERVABLES = "x_opencti_observables_create"
+    TAG_TYPE = "x_opencti_tags"
+
+
+def get_config_variable(env_var, yaml_path, config={}, isNumber=False):
+    if os.getenv(env_var) is not None:
+        result = os.getenv(env_var)
+    elif yaml_path is not None:
+        if yaml_path[0] in config and yaml_path[1] in config[yaml_path[0]]:
+            result = config[yaml_path[0]][yaml_path[1]]
+        else:
+            return None
+    else:
+        return None
+    if result in ("yes", "true", "True"):
+        return True
+    if result in ("no", "false", "False"):
+        return False
+    if isNumber:
+        return int(result)
+    return result
+
+
+class MockEntity:
+    """one entity helper of the api client (api.report, api.indicator...)"""
+
+    def __init__(self, api, name):
+        self._api = api
+        self._name = name
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            # like pycti, entity helpers end in api.query, where a rate
+            # limiter can be installed
+            result = self._api.query(
+                ENTITY_QUERY, {"method": self._name + "." + method, "kwargs": kwargs}
+            )
+            return result["data"]["result"]
+
+        return call
+
+
+class MockApi:
+    """in-memory OpenCTI api client keeping just enough state for the connectors"""
+
+    ENTITIES = (
+        "connector",
+        "external_reference",
+        "identity",
+        "indicator",
+        "marking_definition",
+        "report",
+        "stix_domain_entity",
+        "stix_entity",
+        "stix_observable",
+        "tag",
+    )
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        # observable id -> value, value -> observable, report id -> refs
+        self.observables = {}
+        self.observables_by_value = {}
+        self.indicators = {}
+        self.references = {}
+        self.report_refs = {}
+        # (entity, name) -> tags and identities created
+        self.static = {}
+        for name in self.ENTITIES:
+            setattr(self, name, MockEntity(self, name))
+
+    def _record(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = Counter()
+
+    def log(self, level, message):
+        pass
+
+    def add_observable(self, value, observable_type="IPv4-Addr"):
+        """registering an existing observable, returning its id"""
+        observable_id = _stable_id("observable", value)
+        with self._lock:
+            observable = self.observables_by_value.get(value)
+            if observable is None:
+                observable = {
+                    "id": observable_id,
+                    "entity_type": observable_type,
+                    "observable_value": value,
+                    "indicatorsIds": [],
+                    "externalReferencesIds": [],
+                }
+                self.observables[observable_id] = observable
+                self.observables_by_value[value] = observable
+        return observable["id"]
+
+    # entity handlers
+    def _tag_create(self, **kwargs):
+        tag = {
+            "id": _stable_id("tag", kwargs["value"]),
+            "tag_type": kwargs["tag_type"],
+            "value": kwargs["value"],
+            "color": kwargs["color"],
+        }
+        with self._lock:
+            return self.static.setdefault(("tag", kwargs["value"]), tag)
+
+    def _tag_read(self, **kwargs):
+        value = kwargs["filters"][0]["values"][0]
+        with self._lock:
+            return self.static.get(("tag", value))
+
+    def _identity_create(self, **kwargs):
+        identity_id = _stable_id("identity", kwargs["name"])
+        identity = {
+            "id": identity_id,
+            "stix_id_key": identity_id,
+            "name": kwargs["name"],
+        }
+        with self._lock:
+            return self.static.setdefault(("identity", kwargs["name"]), identity)
+
+    def _identity_read(self, **kwargs):
+        name = kwargs["filters"][0]["values"][0]
+        with self._lock:
+            return self.static.get(("identity", name))
+
+    def _marking_definition_read(self, **kwargs):
+        # the TLP markings exist on every platform
+        filters = kwargs["filters"]
+        if isinstance(filters, dict):
+            filters = [filters]
+        definition = next(
+            item["values"][0] for item in filters if item["key"] == "definition"
+        )
+        return {"id": _stable_id("marking-definition", definition)}
+
+    def _marking_definition_create(self, **kwargs):
+        return {"id": _stable_id("marking-definition", kwargs["definition"])}
+
+    def _external_reference_create(self, **kwargs):
+        reference = {"id": _stable_id("external-reference", kwargs["url"])}
+        with self._lock:
+            self.references[reference["id"]] = kwargs["url"]
+        return reference
+
+    def _report_create(self, **kwargs):
+        report_id = _stable_id("report", kwargs["name"] + kwargs["published"])
+        return {
+            "id": report_id,
+            "stix_id_key": report_id,
+            "name": kwargs["name"],
+            "description": kwargs["description"],
+            "published": kwargs["published"],
+        }
+
+    def _report_read(self, **kwargs):
+        with self._lock:
+            refs = list(self.report_refs.get(kwargs["id"], ()))
+        return {"id": kwargs["id"], "objectRefsIds": refs}
+
+    def _stix_observable_create(self, **kwargs):
+        return {"id": self.add_observable(kwargs["observable_value"], kwargs["type"])}
+
+    def _stix_observable_list(self, **kwargs):
+        values = kwargs["filters"][0]["values"]
+        with self._lock:
+            return [
+                dict(self.observables_by_value[value])
+                for value in values
+                if value in self.observables_by_value
+            ]
+
+    def _stix_observable_delete(self, **kwargs):
+        with self._lock:
+            observable = self.observables.pop(kwargs["id"], None)
+            if observable is not None:
+                self.observables_by_value.pop(observable["observable_value"], None)
+        return True
+
+    def _indicator_create(self, **kwargs):
+        indicator_id = _stable_id("indicator", kwargs["indicator_pattern"])
+        with self._lock:
+            self.indicators[indicator_id] = kwargs["name"]
+        return {"id": indicator_id}
+
+    def _indicator_add_stix_observable(self, **kwargs):
+        with self._lock:
+            observable = self.observables.get(kwargs["stix_observable_id"])
+            if (
+                observable is not None
+                and kwargs["id"] not in observable["indicatorsIds"]
+            ):
+                observable["indicatorsIds"].append(kwargs["id"])
+        return True
+
+    def _stix_entity_add_external_reference(self, **kwargs):
+        with self._lock:
+            observable = self.observables.get(kwargs["id"])
+            reference_id = kwargs["external_reference_id"]
+            if (
+                observable is not None
+                and reference_id not in observable["externalReferencesIds"]
+            ):
+                observable["externalReferencesIds"].append(reference_id)
+        return True
+
+    def query(self, query, variables=None):
+        variables = variables or {}
+        if query == ENTITY_QUERY:
+            self._record(variables["method"])
+            entity, method = variables["method"].split(".")
+            handler = getattr(self, "_" + entity + "_" + method, None)
+            result = True if handler is None else handler(**variables["kwargs"])
+            return {"data": {"result": result}}
+        self._record("query")
+        data = {}
+        errors = []
+        if "reportEdit" in query:
+            with self._lock:
+                refs = self.report_refs.setdefault(variables["id"], set())
+                for key, value in variables.items():
+                    if not key.startswith("input"):
+                        continue
+                    alias = "add" + key[len("input") :]
+                    if (
+                        value["toId"] not in self.observables
+                        and value["toId"] not in self.indicators
+                    ):
+                        # like the platform, refs to deleted entities fail
+                        data[alias] = None
+                        errors.append(
+                            {"message": "Cannot find {}".format(value["toId"])}
+                        )
+                        continue
+                    refs.add(value["toId"])
+                    data[alias] = {"id": value["toId"]}
+        elif "connector(" in query:
+            data["connector"] = None
+        elif "stixObservable(" in query:
+            for alias, key in re.findall(
+                r"(\w+): stixObservable\(id: \$(\w+)\)", query
+            ):
+                with self._lock:
+                    observable = self.observables.get(variables[key])
+                    if observable is None:
+                        data[alias] = None
+                        continue
+                    data[alias] = {
+                        "id": observable["id"],
+                        "observable_value": observable["observable_value"],
+                        "externalReferences": {
+                            "edges": [
+                                {
+                                    "node": {
+                                        "id": reference_id,
+                                        "url": self.references.get(reference_id),
+                                    }
+                                }
+                                for reference_id in observable["externalReferencesIds"]
+                            ]
+                        },
+                    }
+        if len(errors) > 0:
+            return {"data": data, "errors": errors}
+        return {"data": data}
+
+
+class OpenCTIConnectorHelper:
+    """helper recording the connector state and the bundles it sends"""
+
+    def __init__(self, config):
+        self.config = config
+        self.api = MockApi(settings["latency"], settings["jitter"])
+        self.state = None
+        self.bundles = 0
+        self.bundle_objects = 0
+        self.errors = []
+        helpers.append(self)
+
+    def log_info(self, msg):
+        pass
+
+    def log_error(self, msg):
+        self.errors.append(msg)
+
+    def get_state(self):
+        return None if self.state is None else json.loads(self.state)
+
+    def set_state(self, state):
+        self.state = json.dumps(state)
+
+    def send_stix2_bundle(self, bundle, entities_types=None, update=False, split=True):
+        self.api._record("send_stix2_bundle")
+        self.bundles += 1
+        self.bundle_objects += len(json.loads(bundle)["objects"])
+        return [bundle]
+
+    def listen(self, message_callback):
+        raise NotImplementedError("messages are submitted by the benchmark")
+
+
+class OpenCTIApiClient(MockApi):
+    """api client built without a helper, like plans do"""
+
+    def __init__(self, url, token, log_level="info"):
+        super().__init__(settings["latency"], settings["jitter"])
+
+
+def install():
+    """registering the mock as the pycti package"""
+    pycti = types.ModuleType("pycti")
+    pycti.OpenCTIApiClient = OpenCTIApiClient
+    pycti.OpenCTIConnectorHelper = OpenCTIConnectorHelper
+    pycti.get_config_variable = get_config_variable
+    utils = types.ModuleType("pycti.utils")
+    constants = types.ModuleType("pycti.utils.constants")
+    constants.CustomProperties = CustomProperties
+    pycti.utils = utils
+    utils.constants = constants
+    sys.modules["pycti"] = pycti
+    sys.modules["pycti.utils"] = utils
+    sys.modules["pycti.utils.constants"] = constants
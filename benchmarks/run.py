@@ -0,0 +1,191 @@
+"""running the connector benchmarks against the mock OpenCTI api
+
+    python benchmarks/run.py --size 10000 --latency 0.002
+    python benchmarks/run.py --scenario talosip --churn 0.2 --json results.json
+
+Each scenario runs in its own process, so connectors sharing module names do
+not clash and peak memory is measured per scenario.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import mock_opencti  # noqa: E402
+import scenarios  # noqa: E402
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(scenarios.SCENARIOS),
+        help="scenario to run, may be repeated (default: all)",
+    )
+    parser.add_argument("--size", type=int, default=5000, help="IOCs per run")
+    parser.add_argument(
+        "--churn", type=float, default=0.1, help="share of the blacklist replaced"
+    )
+    parser.add_argument("--invalid-ratio", type=float, default=0.01)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.05)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to each API call"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="random extra seconds per call"
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--files", type=int, default=1, help="CSV files the rows are split into"
+    )
+    parser.add_argument(
+        "--file-workers", type=int, default=2, help="CSV files imported at once"
+    )
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument(
+        "--rate-limit", type=float, default=0, help="API calls per second, 0 for none"
+    )
+    parser.add_argument(
+        "--max-concurrency", type=int, default=0, help="AIMD limit, 0 for none"
+    )
+    parser.add_argument(
+        "--latency-target", type=float, default=0, help="seconds, 0 for none"
+    )
+    parser.add_argument(
+        "--report-rollover",
+        choices=("none", "day", "week", "month"),
+        default="none",
+        help="REPORT_ROLLOVER of the fireeye connector",
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=1,
+        help="CSV connector instances sharing the data folder",
+    )
+    parser.add_argument(
+        "--shard-rows", type=int, default=0, help="SHARD_ROWS of the CSV connectors"
+    )
+    parser.add_argument("--bundle-mode", action="store_true")
+    parser.add_argument(
+        "--density",
+        type=float,
+        default=0.0,
+        help="share of the talosip blacklist listed as contiguous ranges",
+    )
+    parser.add_argument("--aggregate", action="store_true")
+    parser.add_argument("--aggregate-observables", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-trace-memory",
+        dest="trace_memory",
+        action="store_false",
+        help="skip tracemalloc, which slows the run down",
+    )
+    parser.add_argument("--json", help="writing the results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def run_child(args):
+    mock_opencti.settings["latency"] = args.latency
+    mock_opencti.settings["jitter"] = args.jitter
+    mock_opencti.install()
+    with tempfile.TemporaryDirectory(prefix="opencti-bench-") as workdir:
+        results = scenarios.SCENARIOS[args.child](args, workdir)
+    sys.stdout.write(json.dumps(results) + "\n")
+
+
+def run_scenario(name, argv):
+    child_argv = [arg for arg in argv]
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", name] + child_argv,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if process.returncode != 0:
+        raise RuntimeError("scenario {} failed".format(name))
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def print_results(results):
+    header = "{:<22} {:<8} {:>8} {:>9} {:>10} {:>8} {:>9} {:>9} {:>8}".format(
+        "scenario",
+        "phase",
+        "rows",
+        "seconds",
+        "rows/sec",
+        "calls",
+        "calls/IOC",
+        "peak MB",
+        "RSS MB",
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            "{:<22} {:<8} {:>8} {:>9.2f} {:>10} {:>8} {:>9} {:>9} {:>8}".format(
+                result["scenario"],
+                result["phase"],
+                result["rows"],
+                result["seconds"],
+                result["rows_per_sec"],
+                result["api_calls"],
+                result["calls_per_ioc"],
+                "-" if result["peak_traced_mb"] is None else result["peak_traced_mb"],
+                result["max_rss_mb"],
+            )
+        )
+    for result in results:
+        print("\n{scenario} / {phase}".format(**result))
+        calls = sorted(result["calls"].items(), key=lambda item: -item[1])
+        print(
+            "  api calls: "
+            + ", ".join("{} {}".format(method, count) for method, count in calls)
+        )
+        stages = sorted(result["stages"].items(), key=lambda item: -item[1])
+        if stages:
+            print(
+                "  stage seconds: "
+                + ", ".join("{} {:.3f}".format(stage, total) for stage, total in stages)
+            )
+        if result["errors"]:
+            print("  {} errors logged by the connector".format(result["errors"]))
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.child is not None:
+        run_child(args)
+        return
+    passthrough = []
+    skip = False
+    for arg in argv:
+        # scenario selection and output stay in the parent
+        if skip:
+            skip = False
+            continue
+        if arg in ("--scenario", "--json"):
+            skip = True
+            continue
+        if arg.startswith(("--scenario=", "--json=")):
+            continue
+        passthrough.append(arg)
+    results = []
+    for name in args.scenario or sorted(scenarios.SCENARIOS):
+        results.extend(run_scenario(name, passthrough))
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,327 @@
+"""benchmark scenarios, each run in its own process by run.py"""
+
+import importlib.util
+import os
+import re
+import resource
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import generators
+import mock_opencti
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGE_SUM = re.compile(
+    r'^\w+_stage_seconds_sum\{(?:[^}]*,)?stage="([^"]+)"[^}]*\} (\S+)$'
+)
+# files written by previous runs of a connector, not copied to the work dir
+RUNTIME_FILES = (
+    "__pycache__",
+    "config.yml",
+    "cache.json",
+    "*.db",
+    "*.db-*",
+    "*.journal",
+    "feeds",
+    "archive",
+    "checkpoints",
+    "rejects",
+    "processing",
+    "shards",
+    "retries",
+)
+
+
+def load_connector(name, script, workdir):
+    """copying a connector to the work dir and importing its main module"""
+    target = os.path.join(workdir, name)
+    shutil.copytree(
+        os.path.join(REPO, name, "src"),
+        target,
+        ignore=shutil.ignore_patterns(*RUNTIME_FILES),
+    )
+    sys.path.insert(0, target)
+    spec = importlib.util.spec_from_file_location(
+        name.replace("-", "_"), os.path.join(target, script)
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, target
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(path):
+    handler = partial(QuietHandler, directory=path)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def stage_totals(connectors):
+    """seconds spent per stage so far, read from the connectors metrics"""
+    totals = {}
+    for connector in connectors:
+        metrics = getattr(connector, "metrics", None)
+        if metrics is None:
+            continue
+        for line in metrics.render().splitlines():
+            match = STAGE_SUM.match(line)
+            if match is not None:
+                stage = match.group(1)
+                totals[stage] = totals.get(stage, 0.0) + float(match.group(2))
+    return totals
+
+
+def measure(scenario, phase, rows, connectors, function, trace_memory=True):
+    """running one phase, returning its throughput, API calls and memory
+
+    connectors are the replicas run by function, the last ones created.
+    """
+    helpers = mock_opencti.helpers[-len(connectors) :]
+    for helper in helpers:
+        helper.api.reset_calls()
+    stages_before = stage_totals(connectors)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] / 1048576
+        tracemalloc.stop()
+    calls = {}
+    for helper in helpers:
+        for method, count in helper.api.calls.items():
+            calls[method] = calls.get(method, 0) + count
+    total_calls = sum(calls.values())
+    stages = {
+        stage: round(total - stages_before.get(stage, 0.0), 4)
+        for stage, total in stage_totals(connectors).items()
+        if total - stages_before.get(stage, 0.0) > 0
+    }
+    return {
+        "scenario": scenario,
+        "phase": phase,
+        "rows": rows,
+        "seconds": round(seconds, 4),
+        "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else None,
+        "api_calls": total_calls,
+        "calls_per_ioc": round(total_calls / rows, 3) if rows > 0 else None,
+        "calls": calls,
+        "stages": stages,
+        "peak_traced_mb": round(peak, 2) if peak is not None else None,
+        "max_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "errors": sum(len(helper.errors) for helper in helpers),
+    }
+
+
+def _set_env(args, values):
+    os.environ.pop("METRICS_PORT", None)
+    values = dict(
+        values,
+        API_RATE_LIMIT=args.rate_limit,
+        API_MAX_CONCURRENCY=args.max_concurrency,
+        API_LATENCY_TARGET=args.latency_target,
+    )
+    os.environ.update({key: str(value) for key, value in values.items()})
+
+
+def talosip(args, workdir):
+    www = os.path.join(workdir, "www")
+    os.makedirs(www)
+    blacklist = os.path.join(www, "ip-blacklist")
+    values = generators.ipv4_blacklist(args.size, args.seed, args.density)
+    generators.write_blacklist(blacklist, values)
+    server = serve_directory(www)
+    _set_env(
+        args,
+        {
+            "TALOSIP_URL": "http://127.0.0.1:{}/ip-blacklist".format(
+                server.server_address[1]
+            ),
+            "TALOSIP_INTERVAL": 1,
+            "TALOSIP_BUNDLE_MODE": "true" if args.bundle_mode else "false",
+            "TALOSIP_AGGREGATE": "true" if args.aggregate else "false",
+            "TALOSIP_AGGREGATE_OBSERVABLES": (
+                "true" if args.aggregate_observables else "false"
+            ),
+            "DELETE_OLD_DATA": "true",
+            "CONNECTOR_UPDATE_EXISTING_DATA": "false",
+        },
+    )
+    module, target = load_connector("talosip", "talosip.py", workdir)
+    connector = module.Talosip()
+    feed = connector.feeds[0]
+    results = [
+        measure(
+            "talosip",
+            "initial",
+            len(values),
+            [connector],
+            lambda: connector._process_file(feed),
+            args.trace_memory,
+        )
+    ]
+    updated = generators.churn(values, args.churn, seed=args.seed + 1)
+    generators.write_blacklist(blacklist, updated)
+    # a newer mtime, the server answers If-Modified-Since with seconds precision
+    later = time.time() + 10
+    os.utime(blacklist, (later, later))
+    results.append(
+        measure(
+            "talosip",
+            "update",
+            len(updated),
+            [connector],
+            lambda: connector._process_file(feed),
+            args.trace_memory,
+        )
+    )
+    server.shutdown()
+    return results
+
+
+def _csv_import(name, script, class_name, args, workdir, report_description):
+    _set_env(
+        args,
+        {
+            "INTERVAL_SCAN": 1,
+            "WORKERS": args.workers,
+            "MAX_REJECT_RATIO": 1,
+            "REPORT_ID": "report--benchmark",
+            "UPDATE_EXISTING_DATA": "false",
+            "FILE_WORKERS": args.file_workers,
+            "REPORT_ROLLOVER": args.report_rollover,
+            "SHARD_ROWS": args.shard_rows,
+        },
+    )
+    module, target = load_connector(name, script, workdir)
+    data = os.path.join(target, "data")
+    os.makedirs(os.path.join(data, "archive"), exist_ok=True)
+    rows = generators.ioc_rows(
+        args.size, args.invalid_ratio, args.duplicate_ratio, seed=args.seed
+    )
+    names = ["benchmark-{}.csv".format(index) for index in range(args.files)]
+
+    def _drop_files():
+        # a backlog of files of uneven sizes, dropped at once
+        start = 0
+        for index, file_name in enumerate(names):
+            end = (
+                len(rows) * (index + 1) * (index + 2) // (len(names) * (len(names) + 1))
+            )
+            generators.write_csv(
+                os.path.join(data, "files", file_name),
+                rows[start:end],
+                report_description,
+            )
+            start = end
+
+    def _submit(file_names):
+        # every replica sees every file, claims decide which one imports it
+        for connector in connectors:
+            connector.scheduler.start()
+            for file_name in file_names:
+                connector.scheduler.submit(file_name)
+        for connector in connectors:
+            connector.scheduler.join()
+
+    def _import():
+        _submit(names)
+        # shards of the files split by the first pass
+        _submit(
+            [
+                file_name
+                for file_name in sorted(os.listdir(os.path.join(data, "files")))
+                if file_name.split(".shard-")[0] in names
+            ]
+        )
+
+    _drop_files()
+    connectors = []
+    for index in range(args.replicas):
+        os.environ["WORKER_ID"] = "replica-{}".format(index)
+        connectors.append(getattr(module, class_name)())
+    results = [
+        measure(name, "import", len(rows), connectors, _import, args.trace_memory)
+    ]
+    # the same rows dropped again are known from the first import
+    _drop_files()
+    results.append(
+        measure(name, "replay", len(rows), connectors, _import, args.trace_memory)
+    )
+    return results
+
+
+def internal_import(args, workdir):
+    return _csv_import(
+        "internal-import",
+        "internal-import.py",
+        "InternalImport",
+        args,
+        workdir,
+        "benchmark report",
+    )
+
+
+def fireeye(args, workdir):
+    return _csv_import("fireeye", "fireeye.py", "InternalImport", args, workdir, None)
+
+
+def virustotal_reference(args, workdir):
+    _set_env(
+        args,
+        {
+            "VIRUSTOTAL_WORKERS": args.workers,
+            "VIRUSTOTAL_BATCH_SIZE": args.batch_size,
+        },
+    )
+    module, target = load_connector(
+        "virustotal-reference", "virustotal-reference.py", workdir
+    )
+    connector = module.VirustotalReference()
+    api = mock_opencti.helpers[-1].api
+    rows = generators.ioc_rows(
+        args.size, 0.0, args.duplicate_ratio, types=("ip", "domain"), seed=args.seed
+    )
+    messages = [{"entity_id": api.add_observable(row[0])} for row in rows]
+
+    def _enrich():
+        # the listen queue hands over the batch_size messages prefetched at once
+        for i in range(0, len(messages), connector.batch_size):
+            connector._process_messages(messages[i : i + connector.batch_size])
+
+    return [
+        measure(
+            "virustotal-reference",
+            phase,
+            len(messages),
+            [connector],
+            _enrich,
+            args.trace_memory,
+        )
+        # replaying the same messages hits the already referenced path
+        for phase in ("enrich", "replay")
+    ]
+
+
+SCENARIOS = {
+    "talosip": talosip,
+    "internal-import": internal_import,
+    "fireeye": fireeye,
+    "virustotal-reference": virustotal_reference,
+}
@@ -2,4 +2,4 @@
 
 cd /opt/opencti-connector-fireeye
 
-python3 fireeye.py
\ No newline at end of file
+python3 fireeye.py "$@"
\ No newline at end of file
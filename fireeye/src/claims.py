@@ -0,0 +1,346 @@
+import csv
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from datetime import datetime
+
+LEASE_FILE = ".lease"
+# folder of the shards of a file being split, in the claim folder
+SPLIT_PREFIX = ".split-"
+SHARD_NAME = re.compile(r"^(?P<source>.+)\.shard-(?P<index>\d+)-of-(?P<count>\d+)$")
+
+
+def shard_name(source, index, count):
+    return "{}.shard-{:04d}-of-{:04d}".format(source, index, count)
+
+
+def shard_source(name):
+    """the file a shard was split from, None for a file dropped as is"""
+    match = SHARD_NAME.match(name)
+    return match.group("source") if match is not None else None
+
+
+class ClaimStore:
+    """claims on the dropped files, shared by the replicas of a connector
+
+    Replicas watch the same files folder. A replica claims a file by renaming
+    it into its own processing/<worker_id> folder, which only one of them can
+    do, and holds a lease on its claims by touching the .lease file of that
+    folder. The files of a replica whose lease expired (a crashed container)
+    are renamed back into the files folder, claimed again by any replica and
+    resumed from their checkpoint.
+
+    Files of more than shard_rows rows are split into shards of shard_rows
+    rows, dropped back into the files folder and claimed like any file. The
+    manifest of the split (data/shards/<file>.json) is kept until the last
+    shard is archived.
+
+    A file whose import failed is renamed back into the files folder after
+    retry_delay seconds, doubled on each attempt, and moved to the rejects
+    folder after max_attempts attempts. Attempts are counted in
+    data/retries/<file>, so every replica sees them.
+    """
+
+    def __init__(
+        self,
+        data_path,
+        worker_id,
+        lease=300,
+        shard_rows=0,
+        metrics=None,
+        log=None,
+        read_only=False,
+        max_attempts=5,
+        retry_delay=60,
+    ):
+        self.files_path = data_path + "/files"
+        self.processing_path = data_path + "/processing"
+        self.shards_path = data_path + "/shards"
+        self.retries_path = data_path + "/retries"
+        self.rejects_path = data_path + "/rejects"
+        self.worker_id = worker_id
+        self.path = os.path.join(self.processing_path, worker_id)
+        self.lease = lease
+        self.shard_rows = shard_rows
+        self.metrics = metrics
+        self.log = log
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        if read_only:
+            # plan mode only counts the shards a file would be split into
+            return
+        for path in (self.path, self.shards_path, self.retries_path):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.renew()
+
+    def start(self):
+        """releasing the claims left by a previous run of this worker, then
+        renewing the lease and reclaiming expired ones in the background"""
+        released = self._release(self.path)
+        if released > 0 and self.log is not None:
+            self.log("Released {} files claimed before a restart".format(released))
+        self._start_lease(reclaim=True)
+
+    def hold(self):
+        """renewing the lease in the background, without releasing or
+        reclaiming any file, for a one-off run next to the replicas"""
+        self._start_lease(reclaim=False)
+
+    def _start_lease(self, reclaim):
+        thread = threading.Thread(target=self._run, args=(reclaim,))
+        thread.daemon = True
+        thread.start()
+
+    def renew(self):
+        lease_path = os.path.join(self.path, LEASE_FILE)
+        with open(lease_path, "a"):
+            os.utime(lease_path)
+
+    def claim(self, name):
+        """moving a dropped file into the claim folder, returning its new path,
+        or None when another replica claimed it first"""
+        path = os.path.join(self.path, name)
+        try:
+            os.rename(os.path.join(self.files_path, name), path)
+        except FileNotFoundError:
+            return None
+        self._count("claimed")
+        return path
+
+    def release(self, name):
+        """giving back a claimed file whose import failed, returning the
+        attempts made so far, or None when the file is no longer claimed
+
+        The file is renamed back into the files folder after a delay, or
+        moved to the rejects folder after max_attempts attempts.
+        """
+        path = os.path.join(self.path, name)
+        if not os.path.isfile(path):
+            # moved to rejects or archived by the failed import
+            self.forget(name)
+            return None
+        attempts = self.attempts(name) + 1
+        if attempts >= self.max_attempts:
+            if not os.path.isdir(self.rejects_path):
+                os.makedirs(self.rejects_path)
+            os.rename(path, os.path.join(self.rejects_path, name))
+            self.forget(name)
+            self._count("rejected")
+            return attempts
+        tmp_path = os.path.join(self.retries_path, name + ".tmp")
+        with open(tmp_path, "w") as output:
+            output.write(str(attempts))
+        os.replace(tmp_path, os.path.join(self.retries_path, name))
+        timer = threading.Timer(
+            self.retry_delay * 2 ** (attempts - 1), self._give_back, (name,)
+        )
+        timer.daemon = True
+        timer.start()
+        return attempts
+
+    def attempts(self, name):
+        """failed imports of a file so far"""
+        try:
+            with open(os.path.join(self.retries_path, name), "r") as data:
+                return int(data.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def forget(self, name):
+        """dropping the failed attempts of a file, once imported"""
+        try:
+            os.remove(os.path.join(self.retries_path, name))
+        except FileNotFoundError:
+            pass
+
+    def _give_back(self, name):
+        try:
+            os.rename(
+                os.path.join(self.path, name), os.path.join(self.files_path, name)
+            )
+        except FileNotFoundError:
+            # released by a lease expiry meanwhile
+            return
+        self._count("released")
+
+    def reclaim(self):
+        """releasing the claims of the replicas whose lease expired"""
+        now = time.time()
+        released = 0
+        for worker_id in os.listdir(self.processing_path):
+            path = os.path.join(self.processing_path, worker_id)
+            if worker_id == self.worker_id or not os.path.isdir(path):
+                continue
+            lease_path = os.path.join(path, LEASE_FILE)
+            try:
+                renewed = os.path.getmtime(
+                    lease_path if os.path.isfile(lease_path) else path
+                )
+            except FileNotFoundError:
+                # reclaimed by another replica meanwhile
+                continue
+            if now - renewed <= self.lease:
+                continue
+            count = self._release(path)
+            if count > 0 and self.log is not None:
+                self.log(
+                    "Lease of {} expired, released {} files".format(worker_id, count)
+                )
+            released += count
+            try:
+                os.remove(lease_path)
+                os.rmdir(path)
+            except OSError:
+                pass
+        return released
+
+    def _release(self, path):
+        """moving the files of a claim folder back into the files folder"""
+        released = 0
+        names = os.listdir(path)
+        for name in names:
+            if not name.startswith(SPLIT_PREFIX):
+                continue
+            source = name[len(SPLIT_PREFIX) :]
+            split_path = os.path.join(path, name)
+            if source in names:
+                # interrupted before the shards were published, split again
+                shutil.rmtree(split_path, ignore_errors=True)
+                continue
+            released += self._publish(split_path)
+        for name in names:
+            if name == LEASE_FILE or name.startswith(SPLIT_PREFIX):
+                continue
+            try:
+                os.rename(os.path.join(path, name), os.path.join(self.files_path, name))
+            except FileNotFoundError:
+                # released by another replica
+                continue
+            released += 1
+        self._count("released", released)
+        return released
+
+    def _publish(self, split_path):
+        """moving the shards of a split into the files folder"""
+        published = 0
+        for name in sorted(os.listdir(split_path)):
+            try:
+                os.rename(
+                    os.path.join(split_path, name), os.path.join(self.files_path, name)
+                )
+            except FileNotFoundError:
+                continue
+            published += 1
+        try:
+            os.rmdir(split_path)
+        except OSError:
+            pass
+        return published
+
+    def shard_count(self, name, rows):
+        """number of shards a file of rows rows is split into, 1 for none"""
+        if self.shard_rows <= 0 or shard_source(name) is not None:
+            return 1
+        return max(1, (rows + self.shard_rows - 1) // self.shard_rows)
+
+    def split(self, name, path, rows, count, archive_path):
+        """writing rows as count shards, archiving the file and dropping the
+        shards into the files folder, returning the shard names
+
+        The row starting with _report, if any, is kept in the manifest.
+        """
+        split_path = os.path.join(self.path, SPLIT_PREFIX + name)
+        shutil.rmtree(split_path, ignore_errors=True)
+        os.makedirs(split_path)
+        names = [shard_name(name, index, count) for index in range(1, count + 1)]
+        report = None
+        shard = None
+        shard_file = None
+        written = 0
+        try:
+            for row in rows:
+                if row[0] == "_report":
+                    report = row
+                    continue
+                if shard_file is None or written >= self.shard_rows:
+                    if shard_file is not None:
+                        shard_file.close()
+                    shard = 0 if shard is None else shard + 1
+                    shard_file = open(
+                        os.path.join(split_path, names[shard]), "w", newline=""
+                    )
+                    writer = csv.writer(shard_file, quoting=csv.QUOTE_ALL)
+                    written = 0
+                writer.writerow(row)
+                written += 1
+        finally:
+            if shard_file is not None:
+                shard_file.close()
+        manifest = {
+            "source": name,
+            "shards": names,
+            "published": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "report": report,
+        }
+        tmp_path = os.path.join(self.shards_path, name + ".json.tmp")
+        with open(tmp_path, "w") as output:
+            json.dump(manifest, output)
+        os.replace(tmp_path, os.path.join(self.shards_path, name + ".json"))
+        # once the file is archived, a release publishes the shards
+        shutil.move(path, archive_path)
+        self._publish(split_path)
+        self._count("split")
+        return names
+
+    def manifest(self, name):
+        """the manifest of the split a shard comes from, None if unknown"""
+        source = shard_source(name)
+        if source is None:
+            return None
+        try:
+            with open(os.path.join(self.shards_path, source + ".json"), "r") as data:
+                return json.load(data)
+        except (OSError, ValueError):
+            return None
+
+    def finished(self, name):
+        """removing the manifest of a split once its last shard is archived"""
+        source = shard_source(name)
+        if source is None:
+            return
+        prefix = source + ".shard-"
+        folders = [self.files_path]
+        for worker_id in os.listdir(self.processing_path):
+            path = os.path.join(self.processing_path, worker_id)
+            if os.path.isdir(path):
+                folders.append(path)
+                folders.append(os.path.join(path, SPLIT_PREFIX + source))
+        for folder in folders:
+            try:
+                if any(entry.startswith(prefix) for entry in os.listdir(folder)):
+                    return
+            except FileNotFoundError:
+                continue
+        try:
+            os.remove(os.path.join(self.shards_path, source + ".json"))
+        except FileNotFoundError:
+            pass
+
+    def _count(self, status, value=1):
+        if self.metrics is not None and value > 0:
+            self.metrics.inc("claims_total", {"status": status}, value)
+
+    def _run(self, reclaim):
+        while True:
+            time.sleep(max(1, self.lease / 3))
+            try:
+                self.renew()
+                if reclaim:
+                    self.reclaim()
+            except OSError as e:
+                if self.log is not None:
+                    self.log("Cannot renew the claims lease: " + str(e))
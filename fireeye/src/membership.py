@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from urllib.parse import quote
+
+# values per IN (...) lookup, below the sqlite variable limit
+LOOKUP_SIZE = 500
+ROLLOVERS = ("none", "day", "week", "month")
+
+
+def rollover_bucket(rollover, now=None):
+    """name and start date of the bucket now falls in"""
+    now = now or datetime.utcnow()
+    if rollover == "day":
+        return now.strftime("%Y-%m-%d"), now.strftime("%Y-%m-%dT00:00:00Z")
+    if rollover == "week":
+        year, week, weekday = now.isocalendar()
+        start = datetime.fromordinal(now.toordinal() - weekday + 1)
+        return ("{}-W{:02d}".format(year, week), start.strftime("%Y-%m-%dT00:00:00Z"))
+    if rollover == "month":
+        return now.strftime("%Y-%m"), now.strftime("%Y-%m-01T00:00:00Z")
+    raise ValueError("Report rollover must be one of " + ", ".join(ROLLOVERS))
+
+
+class ReportMembership:
+    """sqlite record of the refs attached to reports by this connector
+
+    Refs of a report are read from OpenCTI once, the first time the report is
+    used, then only refs missing from the local record are attached. Reports
+    created for rollover buckets are recorded with their bucket.
+    """
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self._lock = threading.Lock()
+        if read_only and os.path.isfile(path):
+            # plan mode reads the record without writing to it
+            self._db = sqlite3.connect(
+                "file:{}?mode=ro".format(quote(os.path.abspath(path))),
+                uri=True,
+                check_same_thread=False,
+            )
+            return
+        # nothing recorded yet, plan mode reads an empty record kept in memory
+        self._db = sqlite3.connect(
+            ":memory:" if read_only else path, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS members ("
+            "report_id TEXT NOT NULL, "
+            "ref_id TEXT NOT NULL, "
+            "PRIMARY KEY (report_id, ref_id)"
+            ") WITHOUT ROWID"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS reports ("
+            "report_id TEXT PRIMARY KEY, "
+            "bucket TEXT UNIQUE, "
+            "seeded INTEGER NOT NULL DEFAULT 0, "
+            "tagged INTEGER NOT NULL DEFAULT 0"
+            ")"
+        )
+        self._db.commit()
+
+    def _report(self, report_id):
+        return self._db.execute(
+            "SELECT seeded, tagged FROM reports WHERE report_id = ?", (report_id,)
+        ).fetchone()
+
+    def is_seeded(self, report_id):
+        with self._lock:
+            report = self._report(report_id)
+        return report is not None and report[0] == 1
+
+    def seed(self, report_id, ref_ids):
+        """recording the refs read from OpenCTI"""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO reports (report_id) VALUES (?)", (report_id,)
+            )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO members VALUES (?, ?)",
+                ((report_id, ref_id) for ref_id in ref_ids),
+            )
+            self._db.execute(
+                "UPDATE reports SET seeded = 1 WHERE report_id = ?", (report_id,)
+            )
+
+    def missing(self, report_id, ref_ids):
+        """returning the ids of ref_ids not attached yet, in order, once each"""
+        ref_ids = list(dict.fromkeys(ref_ids))
+        attached = set()
+        for i in range(0, len(ref_ids), LOOKUP_SIZE):
+            batch = ref_ids[i : i + LOOKUP_SIZE]
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT ref_id FROM members WHERE report_id = ? "
+                    "AND ref_id IN ({})".format(", ".join("?" * len(batch))),
+                    [report_id] + batch,
+                ).fetchall()
+            attached.update(row[0] for row in rows)
+        return [ref_id for ref_id in ref_ids if ref_id not in attached]
+
+    def add(self, report_id, ref_ids):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO members VALUES (?, ?)",
+                ((report_id, ref_id) for ref_id in ref_ids),
+            )
+
+    def count(self, report_id):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM members WHERE report_id = ?", (report_id,)
+            ).fetchone()[0]
+
+    def is_tagged(self, report_id):
+        with self._lock:
+            report = self._report(report_id)
+        return report is not None and report[1] == 1
+
+    def set_tagged(self, report_id):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO reports (report_id) VALUES (?)", (report_id,)
+            )
+            self._db.execute(
+                "UPDATE reports SET tagged = 1 WHERE report_id = ?", (report_id,)
+            )
+
+    def get_bucket(self, bucket):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT report_id FROM reports WHERE bucket = ?", (bucket,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_bucket(self, bucket, report_id):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO reports (report_id, bucket) VALUES (?, ?) "
+                "ON CONFLICT (report_id) DO UPDATE SET bucket = excluded.bucket",
+                (report_id, bucket),
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
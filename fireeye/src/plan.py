@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import sys
+from collections import Counter
+from datetime import datetime
+
+from pycti import OpenCTIApiClient, get_config_variable
+
+PLAN_VERSION = 1
+
+CONNECTOR_STATE_QUERY = """
+    query ConnectorState($id: String!) {
+        connector(id: $id) {
+            id
+            connector_state
+        }
+    }
+"""
+
+
+def chunks(count, size):
+    """number of requests sending count items size at a time"""
+    return (count + size - 1) // size if count > 0 else 0
+
+
+class CallPlan:
+    """API calls an import would issue, counted per client method
+
+    Calls whose number depends on what OpenCTI holds (entities of values
+    missing from the local index...) are counted as estimated.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.estimated = Counter()
+
+    def add(self, method, count=1, estimated=False):
+        if count > 0:
+            self.calls[method] += count
+            if estimated:
+                self.estimated[method] += count
+
+    def update(self, other):
+        self.calls.update(other.calls)
+        self.estimated.update(other.estimated)
+
+    def total(self):
+        return sum(self.calls.values())
+
+    def to_dict(self):
+        return {
+            "total": self.total(),
+            "estimated": sum(self.estimated.values()),
+            "per_method": dict(sorted(self.calls.items())),
+        }
+
+
+class PlanHelper:
+    """read-only stand-in for OpenCTIConnectorHelper while planning
+
+    The connector is neither registered nor pinged, so planning next to the
+    running connector leaves it alone; its state is read and never written.
+    """
+
+    def __init__(self, config):
+        self.connect_id = get_config_variable(
+            "CONNECTOR_ID", ["connector", "id"], config
+        )
+        log_level = get_config_variable(
+            "CONNECTOR_LOG_LEVEL", ["connector", "log_level"], config
+        )
+        numeric_level = getattr(logging, log_level.upper(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError("Invalid log level: " + log_level)
+        logging.basicConfig(level=numeric_level)
+        self.api = OpenCTIApiClient(
+            get_config_variable("OPENCTI_URL", ["opencti", "url"], config),
+            get_config_variable("OPENCTI_TOKEN", ["opencti", "token"], config),
+            log_level,
+        )
+
+    def get_state(self):
+        result = self.api.query(CONNECTOR_STATE_QUERY, {"id": self.connect_id})
+        connector = result["data"]["connector"]
+        if connector is None or not connector["connector_state"]:
+            return None
+        return json.loads(connector["connector_state"])
+
+    def set_state(self, state):
+        raise RuntimeError("A plan does not write the connector state")
+
+    def log_info(self, msg):
+        logging.info(msg)
+
+    def log_error(self, msg):
+        logging.error(msg)
+
+
+class StaticPlan:
+    """connector entities (identity, marking, tags) looked up while planning
+
+    They are read instead of created; a missing one is counted as a planned
+    creation and stood in for by a placeholder, so the plan goes on.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.calls = CallPlan()
+        self.creations = []
+        self._planned = {}
+
+    def get(self, key, method, read):
+        entity = self._planned.get(key) or self.cache.get(key)
+        if entity is None:
+            entity = read()
+        if entity is None:
+            self.calls.add(method)
+            self.creations.append(key)
+            entity = self._planned[key] = {"id": "planned:" + key}
+        return entity
+
+
+def estimate_seconds(total, rate_limiter, concurrency, call_seconds):
+    """import duration at call_seconds per call, bounded by the rate limit"""
+    if rate_limiter.concurrency is not None:
+        concurrency = min(concurrency, rate_limiter.concurrency.maximum)
+    seconds = total * call_seconds / max(1, concurrency)
+    if rate_limiter.bucket is not None:
+        seconds = max(seconds, total / rate_limiter.bucket.rate)
+    return round(seconds, 1)
+
+
+def build_plan(
+    connector, items, calls, rate_limiter, concurrency, call_seconds, creations=()
+):
+    return {
+        "version": PLAN_VERSION,
+        "connector": connector,
+        "created": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "calls": calls.to_dict(),
+        "estimated_seconds": estimate_seconds(
+            calls.total(), rate_limiter, concurrency, call_seconds
+        ),
+        "assumptions": {
+            "call_seconds": call_seconds,
+            "concurrency": concurrency,
+            "rate_limit": (
+                rate_limiter.bucket.rate if rate_limiter.bucket is not None else None
+            ),
+        },
+        "creations": list(creations),
+        "items": items,
+    }
+
+
+def write_plan(path, plan):
+    """writing a plan to path, or to the standard output for -"""
+    if path == "-":
+        json.dump(plan, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as output:
+        json.dump(plan, output, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_plan(path, connector):
+    with open(path, "r") as source:
+        plan = json.load(source)
+    if plan.get("version") != PLAN_VERSION:
+        raise ValueError("Unsupported plan version {}".format(plan.get("version")))
+    if plan.get("connector") != connector:
+        raise ValueError(
+            "Plan was made by {}, not {}".format(plan.get("connector"), connector)
+        )
+    return plan
@@ -0,0 +1,119 @@
+import fnmatch
+import itertools
+import os
+import queue
+import threading
+import time
+
+ORDERS = ("smallest", "largest", "oldest")
+
+
+class FileJob:
+    """one dropped file and the state of its import
+
+    A job is created for every file processed, so files imported at the same
+    time do not share anything but the connector's caches.
+    """
+
+    def __init__(self, name, path, tags=()):
+        self.name = name
+        self.path = path
+        self.tags = list(tags)
+        self.checkpoint = None
+        # rows already imported from another file, only linked to the report
+        self.known = 0
+        # rows imported with another description, only updated
+        self.updated = 0
+        # manifest of the file the job is a shard of
+        self.shard = None
+        # streams the validated rows of the file again
+        self.rows = None
+        self.started = time.time()
+
+
+def parse_priorities(value):
+    """reading "pattern:priority,..." into a list of (pattern, priority)"""
+    priorities = []
+    for item in (value or "").split(","):
+        item = item.strip()
+        if item == "":
+            continue
+        pattern, _, priority = item.rpartition(":")
+        if pattern == "":
+            raise ValueError("File priority must be pattern:priority, got " + item)
+        priorities.append((pattern, int(priority)))
+    return priorities
+
+
+class FileScheduler:
+    """importing queued files on a pool of workers
+
+    Files are taken by priority (first matching pattern, highest first), then
+    by size or age according to order. Each worker imports one file at a time
+    and calls done(name) when the file is finished, failed or not.
+    """
+
+    def __init__(
+        self, directory, process, workers=2, order="smallest", priorities=(), done=None
+    ):
+        if order not in ORDERS:
+            raise ValueError("File order must be one of " + ", ".join(ORDERS))
+        self.directory = directory
+        self.process = process
+        self.workers = workers
+        self.order = order
+        self.priorities = list(priorities)
+        self.done = done
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._threads = []
+
+    def priority(self, name):
+        for pattern, priority in self.priorities:
+            if fnmatch.fnmatch(name, pattern):
+                return priority
+        return 0
+
+    def _key(self, name):
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            # removed meanwhile, the worker reports it
+            return (-self.priority(name), 0)
+        if self.order == "smallest":
+            rank = stat.st_size
+        elif self.order == "largest":
+            rank = -stat.st_size
+        else:
+            rank = stat.st_mtime
+        return (-self.priority(name), rank)
+
+    def submit(self, name):
+        self._queue.put((self._key(name), next(self._counter), name))
+
+    def start(self):
+        for _ in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self):
+        """waiting until every submitted file is processed"""
+        self._queue.join()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            _, _, name = self._queue.get()
+            try:
+                self.process(name)
+            except Exception:
+                # the process function logs its own errors
+                pass
+            finally:
+                if self.done is not None:
+                    self.done(name)
+                self._queue.task_done()
@@ -2,4 +2,4 @@
 
 cd /opt/opencti-connector-internal-import
 
-python3 internal-import.py
\ No newline at end of file
+python3 internal-import.py "$@"
\ No newline at end of file
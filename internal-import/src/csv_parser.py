@@ -0,0 +1,224 @@
+import csv
+import hashlib
+import os
+import re
+import socket
+import sqlite3
+from urllib.parse import urlsplit
+
+HASH_FORMATS = {
+    "md5": re.compile(r"^[0-9a-f]{32}$"),
+    "sha1": re.compile(r"^[0-9a-f]{40}$"),
+    "sha256": re.compile(r"^[0-9a-f]{64}$"),
+}
+# fingerprints per IN (...) lookup, below the sqlite variable limit
+LOOKUP_SIZE = 500
+DOMAIN_FORMAT = re.compile(
+    r"^(?=.{1,253}$)([a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,62}$"
+)
+
+
+def _normalize_ip(value):
+    return socket.inet_ntop(socket.AF_INET, socket.inet_pton(socket.AF_INET, value))
+
+
+def _normalize_hash(value, type_key):
+    value = value.lower()
+    if HASH_FORMATS[type_key].match(value) is None:
+        raise ValueError("invalid " + type_key)
+    return value
+
+
+def _normalize_domain(value):
+    value = value.lower().rstrip(".")
+    if DOMAIN_FORMAT.match(value) is None:
+        raise ValueError("invalid domain")
+    return value
+
+
+def _normalize_url(value):
+    parts = urlsplit(value)
+    if parts.scheme.lower() not in ("http", "https", "ftp") or parts.netloc == "":
+        raise ValueError("invalid url")
+    return value
+
+
+def normalize(value, type_key):
+    """returning the canonical form of value, raising ValueError if invalid"""
+    value = value.strip()
+    if type_key == "ip":
+        try:
+            return _normalize_ip(value)
+        except OSError:
+            raise ValueError("invalid ip")
+    if type_key in HASH_FORMATS:
+        return _normalize_hash(value, type_key)
+    if type_key == "domain":
+        return _normalize_domain(value)
+    if type_key == "url":
+        return _normalize_url(value)
+    raise ValueError("Type must be url, ip, domain, md5, sha1 or sha256.")
+
+
+class SeenFingerprints:
+    """fingerprints of the rows parsed so far, used for deduplication
+
+    They are kept in a temporary sqlite database on disk, deleted once
+    closed, so memory does not grow with the number of rows.
+    """
+
+    def __init__(self):
+        # an empty name opens a private temporary database
+        self._db = sqlite3.connect("")
+        # nothing to recover, the database is dropped once closed
+        self._db.execute("PRAGMA journal_mode=OFF")
+        self._db.execute("PRAGMA synchronous=OFF")
+        # pages kept in memory, in KiB
+        self._db.execute("PRAGMA cache_size=-8192")
+        self._db.execute(
+            "CREATE TABLE seen (fingerprint INTEGER PRIMARY KEY) WITHOUT ROWID"
+        )
+
+    def add_new(self, fingerprints):
+        """adding fingerprints, returning the set of those not seen before"""
+        # in index order, pages are read and written once per batch
+        fingerprints = sorted(fingerprints)
+        new = set(fingerprints)
+        for i in range(0, len(fingerprints), LOOKUP_SIZE):
+            batch = fingerprints[i : i + LOOKUP_SIZE]
+            new.difference_update(
+                row[0]
+                for row in self._db.execute(
+                    "SELECT fingerprint FROM seen WHERE fingerprint IN ({})".format(
+                        ", ".join("?" * len(batch))
+                    ),
+                    batch,
+                )
+            )
+        self._db.executemany(
+            "INSERT INTO seen VALUES (?)",
+            ((fingerprint,) for fingerprint in sorted(new)),
+        )
+        return new
+
+    def close(self):
+        self._db.close()
+
+
+class CsvParser:
+    """validating and normalizing an IOC csv file before it is imported
+
+    validate() streams the whole file once, writing invalid rows to a
+    rejects file when rejects_path is set; rows() then streams the valid, deduplicated rows again
+    as [value, type, description]. Rows are held one chunk at a time, the
+    fingerprints used for deduplication are kept on disk.
+    """
+
+    def __init__(self, path, rejects_path, chunk_size=1000, report_rows=True):
+        self.path = path
+        self.rejects_path = rejects_path
+        self.chunk_size = chunk_size
+        self.report_rows = report_rows
+        self.valid = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    def _chunks(self):
+        with open(self.path, newline="") as csvfile:
+            reader = csv.reader(csvfile, delimiter=",")
+            chunk = []
+            for line_number, row in enumerate(reader, 1):
+                chunk.append((line_number, row))
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+            if len(chunk) > 0:
+                yield chunk
+
+    def _parse(self, on_reject=None, on_duplicate=None):
+        seen = SeenFingerprints()
+        try:
+            for chunk in self._chunks():
+                # (fingerprint, row), None for the report row
+                parsed = []
+                for line_number, row in chunk:
+                    # comments and blank lines
+                    if len(row) == 0 or row[0].strip() == "" or row[0].startswith("#"):
+                        continue
+                    if self.report_rows and row[0] == "_report":
+                        parsed.append((None, row))
+                        continue
+                    try:
+                        if len(row) < 2:
+                            raise ValueError("missing type")
+                        type_key = row[1].strip().lower()
+                        value = normalize(row[0], type_key)
+                    except ValueError as e:
+                        if on_reject is not None:
+                            on_reject(line_number, row, str(e))
+                        continue
+                    # signed, sqlite integers are 64-bit signed
+                    fingerprint = int.from_bytes(
+                        hashlib.blake2b(
+                            (type_key + ":" + value).encode(), digest_size=8
+                        ).digest(),
+                        "big",
+                        signed=True,
+                    )
+                    parsed.append((fingerprint, [value, type_key] + row[2:]))
+                new = seen.add_new(
+                    {
+                        fingerprint
+                        for fingerprint, _ in parsed
+                        if fingerprint is not None
+                    }
+                )
+                for fingerprint, row in parsed:
+                    if fingerprint is not None:
+                        # only the first row of a fingerprint is new
+                        if fingerprint not in new:
+                            if on_duplicate is not None:
+                                on_duplicate()
+                            continue
+                        new.discard(fingerprint)
+                    yield row
+        finally:
+            seen.close()
+
+    def validate(self):
+        """streaming the file once, returning the number of rejected rows"""
+        self.valid = 0
+        self.duplicates = 0
+        self.rejected = 0
+        rejects_file = None
+        rejects_writer = None
+
+        def _reject(line_number, row, reason):
+            nonlocal rejects_file, rejects_writer
+            self.rejected += 1
+            if self.rejects_path is None:
+                return
+            if rejects_writer is None:
+                directory = os.path.dirname(self.rejects_path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                rejects_file = open(self.rejects_path, "w", newline="")
+                rejects_writer = csv.writer(rejects_file)
+                rejects_writer.writerow(["line", "reason", "row"])
+            rejects_writer.writerow([line_number, reason] + row)
+
+        def _duplicate():
+            self.duplicates += 1
+
+        try:
+            for row in self._parse(_reject, _duplicate):
+                if row[0] != "_report":
+                    self.valid += 1
+        finally:
+            if rejects_file is not None:
+                rejects_file.close()
+        return self.rejected
+
+    def rows(self):
+        """streaming valid rows, validate() must have been called first"""
+        return self._parse()
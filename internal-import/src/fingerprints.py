@@ -0,0 +1,155 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+
+
+def _split(ids):
+    return ids.split(",") if ids else []
+
+
+def fingerprint(*fields):
+    """hash of the row fields written to OpenCTI besides its value and type"""
+    return hashlib.sha1("\0".join(str(field) for field in fields).encode()).hexdigest()
+
+
+class FingerprintStore:
+    """sqlite store of the rows already imported and the ids created for them
+
+    Rows are keyed by value and type. A row dropped again with the same
+    fingerprint is only linked to the new report, one with another
+    description is returned as changed so only its description is updated.
+    Entries expire ttl seconds after the
+    entities were created, so entities deleted from OpenCTI since then are
+    eventually created again; purge() drops them.
+    """
+
+    def __init__(self, path, ttl, read_only=False):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.changes = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if read_only and os.path.isfile(path):
+            # plan mode reads the store without writing to it
+            self._db = sqlite3.connect(
+                "file:{}?mode=ro".format(quote(os.path.abspath(path))),
+                uri=True,
+                check_same_thread=False,
+            )
+            return
+        # nothing recorded yet, plan mode reads an empty store kept in memory
+        self._db = sqlite3.connect(
+            ":memory:" if read_only else path, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            "value TEXT NOT NULL, "
+            "type TEXT NOT NULL, "
+            "fingerprint TEXT NOT NULL, "
+            "observable_id TEXT NOT NULL, "
+            "indicator_id TEXT NOT NULL, "
+            "tag_ids TEXT, "
+            "imported_at INTEGER NOT NULL, "
+            "PRIMARY KEY (value, type)"
+            ") WITHOUT ROWID"
+        )
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+
+    def get(self, value, _type, row_fingerprint):
+        """returning the record of a row imported before, changed when it was
+        imported with another fingerprint"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fingerprint, observable_id, indicator_id, tag_ids, "
+                "imported_at FROM fingerprints WHERE value = ? AND type = ?",
+                (value, _type),
+            ).fetchone()
+            if row is None or row[4] <= time.time() - self.ttl:
+                self.misses += 1
+                return None
+            if row[0] == row_fingerprint:
+                self.hits += 1
+            else:
+                self.changes += 1
+        return {
+            "fingerprint": row[0],
+            "observable_id": row[1],
+            "indicator_id": row[2],
+            "tag_ids": _split(row[3]),
+            "imported_at": row[4],
+            "changed": row[0] != row_fingerprint,
+        }
+
+    def record(self, entries):
+        """storing (value, type, fingerprint, observable_id, indicator_id,
+        tag_ids, imported_at) entries"""
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        value,
+                        _type,
+                        row_fingerprint,
+                        observable_id,
+                        indicator_id,
+                        ",".join(tag_ids),
+                        imported_at,
+                    )
+                    for value, _type, row_fingerprint, observable_id, indicator_id, tag_ids, imported_at in entries
+                ),
+            )
+
+    def forget(self, entity_ids):
+        """dropping the rows imported with any of entity_ids, returning their
+        (value, type, observable_id, indicator_id)"""
+        entity_ids = list(entity_ids)
+        forgotten = []
+        with self._lock, self._db:
+            # each id is bound twice, within the sqlite limit of variables
+            for i in range(0, len(entity_ids), 400):
+                chunk = entity_ids[i : i + 400]
+                marks = ",".join("?" * len(chunk))
+                forgotten.extend(
+                    self._db.execute(
+                        "SELECT value, type, observable_id, indicator_id "
+                        "FROM fingerprints WHERE observable_id IN ({0}) "
+                        "OR indicator_id IN ({0})".format(marks),
+                        chunk + chunk,
+                    ).fetchall()
+                )
+            self._db.executemany(
+                "DELETE FROM fingerprints WHERE value = ? AND type = ?",
+                [(value, _type) for value, _type, _, _ in forgotten],
+            )
+        return forgotten
+
+    def purge(self):
+        """dropping expired entries, returning how many"""
+        with self._lock, self._db:
+            return self._db.execute(
+                "DELETE FROM fingerprints WHERE imported_at <= ?",
+                (int(time.time() - self.ttl),),
+            ).rowcount
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "changes": self.changes,
+            "misses": self.misses,
+            "size": len(self),
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
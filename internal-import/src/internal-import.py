@@ -1,16 +1,41 @@
 import yaml
+import argparse
 import os
 import shutil
+import socket
 import time
-import csv
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from pycti import OpenCTIConnectorHelper, get_config_variable
 from pycti.utils.constants import CustomProperties
 
+from cache import LookupCache
+from checkpoint import Checkpoint, file_sha256
+from claims import ClaimStore, shard_source
+from csv_parser import CsvParser
+from fingerprints import FingerprintStore, fingerprint
+from metrics import Metrics
+from plan import (
+    CallPlan,
+    PlanHelper,
+    StaticPlan,
+    build_plan,
+    chunks,
+    read_plan,
+    write_plan,
+)
+from ratelimit import RateLimiter
+from report_linker import ReportLinker, ReportLinkError
+from scheduler import FileJob, FileScheduler, parse_priorities
+from watcher import FileWatcher
+
 
 class InternalImport:
-    def __init__(self):
+    def __init__(self, mode=None):
+        # mode is "plan" (read only) or "apply" for the one-off runs next to
+        # the running connector, which serve no metrics and leave its claims alone
         # get config variable
         config_file_path = os.path.dirname(os.path.abspath(__file__)) + "/config.yml"
         config = (
@@ -18,7 +43,23 @@ class InternalImport:
             if os.path.isfile(config_file_path)
             else {}
         )
-        self.helper = OpenCTIConnectorHelper(config)
+        self.helper = (
+            PlanHelper(config) if mode == "plan" else OpenCTIConnectorHelper(config)
+        )
+        self.metrics = Metrics("internal_import")
+        self.rate_limiter = RateLimiter.from_config(
+            config, self.metrics, self.helper.log_info
+        )
+        # client methods are counted by the metrics, the GraphQL requests
+        # they send are throttled and retried by the limiter
+        self.helper.api = self.metrics.instrument(
+            self.rate_limiter.install(self.helper.api)
+        )
+        metrics_port = get_config_variable(
+            "METRICS_PORT", ["connector", "metrics_port"], config, True
+        )
+        if metrics_port and mode is None:
+            self.metrics.serve(metrics_port)
 
         self.update_existing_data = get_config_variable(
             "UPDATE_EXISTING_DATA", ["connector", "update_existing_data"], config
@@ -26,41 +67,292 @@ class InternalImport:
         self.interval_scan = get_config_variable(
             "INTERVAL_SCAN", ["internal_import", "interval_scan"], config
         )
+        self.watch_mode = (
+            get_config_variable("WATCH_MODE", ["internal_import", "watch_mode"], config)
+            or "inotify"
+        )
+        self.workers = (
+            get_config_variable("WORKERS", ["internal_import", "workers"], config, True)
+            or 4
+        )
+        self.file_workers = (
+            get_config_variable(
+                "FILE_WORKERS", ["internal_import", "file_workers"], config, True
+            )
+            or 2
+        )
+        self.file_order = (
+            get_config_variable("FILE_ORDER", ["internal_import", "file_order"], config)
+            or "smallest"
+        )
+        self.file_priorities = parse_priorities(
+            get_config_variable(
+                "FILE_PRIORITIES", ["internal_import", "file_priorities"], config
+            )
+        )
+        self.checkpoint_size = (
+            get_config_variable(
+                "CHECKPOINT_SIZE", ["internal_import", "checkpoint_size"], config, True
+            )
+            or 500
+        )
+        self.max_reject_ratio = float(
+            get_config_variable(
+                "MAX_REJECT_RATIO", ["internal_import", "max_reject_ratio"], config
+            )
+            or 0.1
+        )
         self._data_path = os.path.dirname(os.path.abspath(__file__)) + "/data"
-        self.identity = self.helper.api.identity.create(
-            name="Internal Collector",
-            type="Organization",
-            description="Importing internal data from CSV file",
+        # replicas sharing the data folder claim files under their worker id
+        worker_id = (
+            get_config_variable("WORKER_ID", ["internal_import", "worker_id"], config)
+            or socket.gethostname()
+        )
+        if mode == "apply":
+            # claims of its own, the running replica keeps its claim folder
+            worker_id += ".apply-" + str(os.getpid())
+        self.claims = ClaimStore(
+            self._data_path,
+            worker_id,
+            get_config_variable(
+                "CLAIM_LEASE", ["internal_import", "claim_lease"], config, True
+            )
+            or 300,
+            get_config_variable(
+                "SHARD_ROWS", ["internal_import", "shard_rows"], config, True
+            )
+            or 0,
+            self.metrics,
+            self.helper.log_info,
+            read_only=mode == "plan",
+            max_attempts=get_config_variable(
+                "MAX_ATTEMPTS", ["internal_import", "max_attempts"], config, True
+            )
+            or 5,
+            retry_delay=get_config_variable(
+                "RETRY_DELAY", ["internal_import", "retry_delay"], config, True
+            )
+            or 60,
+        )
+        self.cache = LookupCache(
+            path=self._data_path + "/cache.json",
+            max_size=get_config_variable(
+                "CACHE_SIZE", ["connector", "cache_size"], config, True
+            )
+            or 100000,
+            ttl=get_config_variable(
+                "CACHE_TTL", ["connector", "cache_ttl"], config, True
+            )
+            or 86400,
+        )
+        fingerprint_ttl = get_config_variable(
+            "FINGERPRINT_TTL", ["internal_import", "fingerprint_ttl"], config, True
+        )
+        if fingerprint_ttl is None:
+            fingerprint_ttl = 604800
+        self.fingerprints = (
+            FingerprintStore(
+                self._data_path + "/fingerprints.db",
+                fingerprint_ttl,
+                read_only=mode == "plan",
+            )
+            if fingerprint_ttl > 0
+            else None
+        )
+        self.report_linker = ReportLinker(
+            self.helper.api,
+            get_config_variable(
+                "REPORT_CHUNK_SIZE", ["connector", "report_chunk_size"], config, True
+            )
+            or 100,
+        )
+        # a plan only reads the connector entities, missing ones are planned
+        self.static = StaticPlan(self.cache) if mode == "plan" else None
+        self.identity = self._get_static(
+            "identity:Internal Collector",
+            "identity.create",
+            lambda: self.helper.api.identity.create(
+                name="Internal Collector",
+                type="Organization",
+                description="Importing internal data from CSV file",
+            ),
+            lambda: self.helper.api.identity.read(
+                filters=[{"key": "name", "values": ["Internal Collector"]}]
+            ),
         )
-        self.markingDefinitions = self.helper.api.marking_definition.create(
-            definition_type="tlp", definition="TLP:WHITE"
+        self.markingDefinitions = self._get_static(
+            "marking:TLP:WHITE",
+            "marking_definition.create",
+            lambda: self.helper.api.marking_definition.create(
+                definition_type="tlp", definition="TLP:WHITE"
+            ),
+            lambda: self.helper.api.marking_definition.read(
+                filters=[
+                    {"key": "definition_type", "values": ["tlp"]},
+                    {"key": "definition", "values": ["TLP:WHITE"]},
+                ]
+            ),
         )
-        self.tag = self.helper.api.tag.create(
-            tag_type="Internal-Import", value="internal-importer", color="#2e99db"
+        self.tag = self._get_static(
+            "tag:internal-importer",
+            "tag.create",
+            lambda: self.helper.api.tag.create(
+                tag_type="Internal-Import", value="internal-importer", color="#2e99db"
+            ),
+            lambda: self.helper.api.tag.read(
+                filters=[{"key": "value", "values": ["internal-importer"]}]
+            ),
         )
-        self.tagFE = self.helper.api.tag.create(
-            tag_type="Internal-Import", value="FireEye", color="#fb4d28"
+        self.tagFE = self._get_static(
+            "tag:FireEye",
+            "tag.create",
+            lambda: self.helper.api.tag.create(
+                tag_type="Internal-Import", value="FireEye", color="#fb4d28"
+            ),
+            lambda: self.helper.api.tag.read(
+                filters=[{"key": "value", "values": ["FireEye"]}]
+            ),
         )
-        self.filename = ""
+        if mode != "plan":
+            self.cache.save()
+        self.scheduler = FileScheduler(
+            self._data_path + "/files",
+            self._import_file,
+            self.file_workers,
+            self.file_order,
+            self.file_priorities,
+        )
+
+    def _get_static(self, key, method, create, read):
+        """a connector entity from the cache, created on a miss, or only read
+        while planning"""
+        if self.static is not None:
+            return self.static.get(key, method, read)
+        return self.cache.get_or_create(key, create)
+
+    def _add_tag(self, entity_id, tag):
+        """adding a tag once, skipping entities already tagged by this connector"""
+        key = "tagged:" + entity_id + ":" + tag["id"]
+        if self.cache.get(key) is None:
+            with self.metrics.timer("tagging"):
+                self.helper.api.stix_entity.add_tag(id=entity_id, tag_id=tag["id"])
+            self.cache.set(key, True)
+
+    def _new_job(self, _file):
+        tags = [self.tag]
+        if "IOCsFromFE" in _file:
+            tags.append(self.tagFE)
+        return FileJob(_file, self._data_path + "/files/" + _file, tags)
 
-    def _read_file(self, data):
+    def _read_file(self, job):
         """reading data from a file"""
-        with open(data, newline="") as csvfile:
-            reader = csv.reader(csvfile, delimiter=",")
-            self._process_message(reader)
-
-    def _open_files(self):
-        """Listing all files in the folder"""
-        _list_files = os.listdir(self._data_path + "/files")
-        if _list_files.__len__() > 1:
-            self.helper.log_info("Reading all files in folder")
-            for _file in _list_files:
-                if _file != "sample.csv":
-                    self.filename = _file
-                    _file = self._data_path + "/files/" + _file
-                    self._read_file(_file)
+        # validating the whole file before any API call
+        parser = CsvParser(
+            job.path,
+            self._data_path + "/rejects/" + job.name + ".rejects.csv",
+            report_rows=True,
+        )
+        with self.metrics.timer("validate"):
+            rejected = parser.validate()
+        self.metrics.inc("rows_total", {"status": "valid"}, parser.valid)
+        self.metrics.inc("rows_total", {"status": "duplicate"}, parser.duplicates)
+        self.metrics.inc("rows_total", {"status": "rejected"}, rejected)
+        self.helper.log_info(
+            "{}: {} valid rows, {} duplicates, {} rejected".format(
+                job.name, parser.valid, parser.duplicates, rejected
+            )
+        )
+        if rejected > self.max_reject_ratio * (parser.valid + rejected):
+            shutil.move(job.path, self._data_path + "/rejects/" + job.name)
+            raise ValueError(
+                "Too many invalid rows in {}, file moved to rejects".format(job.name)
+            )
+        shards = self.claims.shard_count(job.name, parser.valid)
+        if shards > 1:
+            with self.metrics.timer("split"):
+                self.claims.split(
+                    job.name,
+                    job.path,
+                    parser.rows(),
+                    shards,
+                    self._archive_path(job.name),
+                )
+            self.helper.log_info(
+                "{} split into {} shards of {} rows".format(
+                    job.name, shards, self.claims.shard_rows
+                )
+            )
+            return "split"
+        job.shard = self.claims.manifest(job.name)
+        job.checkpoint = Checkpoint(
+            self._data_path + "/checkpoints/" + job.name + ".journal"
+        )
+        if job.checkpoint.begin(file_sha256(job.path)) > 0:
+            self.helper.log_info(
+                "Resuming {} after row {}".format(job.name, job.checkpoint.offset)
+            )
+        job.rows = parser.rows
+        self._process_message(job, job.rows())
+        return "imported"
+
+    def _archive_path(self, name):
+        return (
+            self._data_path
+            + "/archive/"
+            + name
+            + datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        )
+
+    def _open_file(self, _file):
+        """Reading a file dropped in the folder"""
+        job = self._new_job(_file)
+        job.path = self.claims.claim(_file)
+        if job.path is None:
+            self.helper.log_info("{} claimed by another worker".format(_file))
+            return
+        self.helper.log_info("Reading file {}".format(_file))
+        try:
+            with self.metrics.timer("file"):
+                status = self._read_file(job)
+        except Exception as e:
+            self.metrics.inc("files_total", {"status": "failed"})
+            self._release_failed(job, e)
+            raise
+        self.claims.forget(job.name)
+        self.metrics.inc("files_total", {"status": status})
+
+    def _release_failed(self, job, error):
+        """giving a file whose import failed back, or rejecting it"""
+        try:
+            attempts = self.claims.release(job.name)
+        except OSError as e:
+            self.helper.log_error(
+                "Cannot release {}: {}, kept until the claims are released".format(
+                    job.name, str(e)
+                )
+            )
+            return
+        if attempts is None:
+            return
+        if attempts >= self.claims.max_attempts:
+            self.helper.log_error(
+                "{} failed {} times ({}), file moved to rejects".format(
+                    job.name, attempts, str(error)
+                )
+            )
         else:
-            self.helper.log_info("No files.")
+            self.helper.log_info(
+                "{} failed ({}), retry {}/{} later".format(
+                    job.name, str(error), attempts, self.claims.max_attempts - 1
+                )
+            )
+
+    def _import_file(self, _file):
+        try:
+            self._open_file(_file)
+        except Exception as e:
+            self.helper.log_error("Cannot import {}: {}".format(_file, str(e)))
+        self.metrics.set("files_pending", self.scheduler.pending())
 
     def _get_type(self, data):
         _dict = {
@@ -77,121 +369,532 @@ class InternalImport:
         else:
             raise ValueError("[] Type must be url, ip, domain, md5, sha1 or sha256.")
 
-    def _indicator_create(self, data, observable_id):
+    def _indicator_create(self, job, data, observable_id):
         _type = self._get_type(data[1]).lower()
         _value = data[0]
         try:
             observable_description = data[2]
         except:
             observable_description = "from fireeye"
-        _indicator = self.helper.api.indicator.create(
-            name=_value,
-            indicator_pattern="[" + _type + ":value = '" + _value + "']",
-            description=observable_description,
-            update=self.update_existing_data,
-            main_observable_type=_type,
-            markingDefinitions=self.markingDefinitions["id"],
-        )
+        with self.metrics.timer("indicator_create"):
+            _indicator = self.helper.api.indicator.create(
+                name=_value,
+                indicator_pattern="[" + _type + ":value = '" + _value + "']",
+                description=observable_description,
+                update=self.update_existing_data,
+                main_observable_type=_type,
+                markingDefinitions=self.markingDefinitions["id"],
+            )
         # adding to observable
         self.helper.log_info("Link to observable")
-        self.helper.api.indicator.add_stix_observable(
-            id=_indicator["id"], stix_observable_id=observable_id
-        )
+        with self.metrics.timer("indicator_link"):
+            self.helper.api.indicator.add_stix_observable(
+                id=_indicator["id"], stix_observable_id=observable_id
+            )
         # adding tag
         self.helper.log_info("Adding tag")
-        self.helper.api.stix_entity.add_tag(id=_indicator["id"], tag_id=self.tag["id"])
-        if "IOCsFromFE" in self.filename:
-            self.helper.api.stix_entity.add_tag(
-                id=_indicator["id"], tag_id=self.tagFE["id"]
-            )
+        for tag in job.tags:
+            self._add_tag(_indicator["id"], tag)
         return _indicator
 
-    def _process_message(self, data):
+    def _link_known_row(self, job, value, observable_type, record, status="known"):
+        """reusing the entities of a row imported before, adding missing tags"""
+        tag_ids = list(record["tag_ids"])
+        for tag in job.tags:
+            if tag["id"] not in tag_ids:
+                self._add_tag(record["observable_id"], tag)
+                self._add_tag(record["indicator_id"], tag)
+                tag_ids.append(tag["id"])
+        self.metrics.inc("rows_total", {"status": status})
+        # observable and indicator creation and their link, updates replace
+        # the creations
+        self.metrics.inc("api_calls_avoided_total", value=3 if status == "known" else 1)
+        entry = None
+        if status == "updated" or len(tag_ids) > len(record["tag_ids"]):
+            entry = [
+                value,
+                observable_type,
+                record["fingerprint"],
+                record["observable_id"],
+                record["indicator_id"],
+                tag_ids,
+                record["imported_at"],
+            ]
+        return record["observable_id"], record["indicator_id"], entry, status
+
+    def _update_known_row(
+        self, job, value, observable_type, description, row_fingerprint, record
+    ):
+        """writing the new description of a row imported with another one
+
+        The marking of the connector is fixed, so the description is the only
+        field of the entities that differs.
+        """
+        if not self.update_existing_data:
+            # creating the entities again would not change them either
+            return self._link_known_row(job, value, observable_type, record)
+        with self.metrics.timer("update"):
+            self.helper.api.stix_observable.update_field(
+                id=record["observable_id"], key="description", value=description
+            )
+            self.helper.api.stix_domain_entity.update_field(
+                id=record["indicator_id"], key="description", value=description
+            )
+        return self._link_known_row(
+            job,
+            value,
+            observable_type,
+            dict(record, fingerprint=row_fingerprint),
+            "updated",
+        )
+
+    def _row_fields(self, row):
+        """returning the observable type, description and fingerprint of a row"""
+        observable_type = self._get_type(row[1])
+        try:
+            observable_description = row[2]
+        except:
+            observable_description = "from fireeye"
+        row_fingerprint = fingerprint(
+            observable_description, self.markingDefinitions["id"]
+        )
+        return observable_type, observable_description, row_fingerprint
+
+    def _process_row(self, job, row):
+        """creating observable, indicator and tags of a single row
+
+        Rows reach this point validated, so an error here comes from the
+        platform: it fails the file instead of dropping the row.
+        """
+        # creating observable
+        observable_type, observable_description, row_fingerprint = self._row_fields(row)
+        if self.fingerprints is not None:
+            record = self.fingerprints.get(row[0], observable_type, row_fingerprint)
+            if record is not None and record["changed"]:
+                return self._update_known_row(
+                    job,
+                    row[0],
+                    observable_type,
+                    observable_description,
+                    row_fingerprint,
+                    record,
+                )
+            if record is not None:
+                return self._link_known_row(job, row[0], observable_type, record)
+        self.helper.log_info("Creating Observale...")
+        with self.metrics.timer("observable_create"):
+            created_observable = self.helper.api.stix_observable.create(
+                type=observable_type,
+                observable_value=row[0],
+                createdByRef=self.identity["id"],
+                markingDefinitions=self.markingDefinitions["id"],
+                description=observable_description,
+            )
+        # create external references
+        # attach external references to observable
+        # adding tag
+        for tag in job.tags:
+            self._add_tag(created_observable["id"], tag)
+        created_indicator = self._indicator_create(job, row, created_observable["id"])
+        # this should be stix_id_key
+        self.metrics.inc("rows_total", {"status": "imported"})
+        entry = [
+            row[0],
+            observable_type,
+            row_fingerprint,
+            created_observable["id"],
+            created_indicator["id"],
+            [tag["id"] for tag in job.tags],
+            int(time.time()),
+        ]
+        return created_observable["id"], created_indicator["id"], entry, "imported"
+
+    def _attach_refs(self, job, report_id, observable_ids, indicator_ids, **kwargs):
+        """attaching refs to a report, importing again the known rows whose
+        entities were deleted from OpenCTI since they were recorded"""
+        try:
+            return self.report_linker.attach(
+                report_id, observable_ids, indicator_ids, **kwargs
+            )
+        except ReportLinkError as e:
+            rows = self._stale_rows(job, e.ref_ids)
+            if rows is None:
+                # resuming from the checkpoint would link the same refs again
+                job.checkpoint.clear()
+                raise
+            self.helper.log_info(
+                "{}: {} known rows deleted from OpenCTI, importing them again".format(
+                    job.name, len(rows)
+                )
+            )
+            observable_ids = []
+            indicator_ids = []
+            entries = []
+            for row in rows:
+                observable_id, indicator_id, entry, status = self._process_row(job, row)
+                observable_ids.append(observable_id)
+                indicator_ids.append(indicator_id)
+                entries.append(entry)
+            self.fingerprints.record(entries)
+            return e.attached + self.report_linker.attach(
+                report_id, observable_ids, indicator_ids, **kwargs
+            )
+
+    def _stale_rows(self, job, ref_ids):
+        """forgetting the known rows imported with ref_ids, returning them
+
+        None when some of the refs do not come from a known row.
+        """
+        if self.fingerprints is None:
+            return None
+        forgotten = self.fingerprints.forget(ref_ids)
+        stale = set()
+        forgotten_ids = set()
+        for value, _type, observable_id, indicator_id in forgotten:
+            stale.add((value, _type))
+            forgotten_ids.update((observable_id, indicator_id))
+        if len(forgotten) == 0 or not forgotten_ids.issuperset(ref_ids):
+            return None
+        rows = []
+        for row in job.rows():
+            if row[0] == "_report":
+                continue
+            if (row[0], self._get_type(row[1])) in stale:
+                stale.discard((row[0], self._get_type(row[1])))
+                rows.append(row)
+        return rows
+
+    def _save_cache(self):
+        """saving the lookup cache, a failure does not fail the imported file"""
+        try:
+            self.cache.save()
+        except OSError as e:
+            self.helper.log_error("Cannot save the lookup cache: " + str(e))
+
+    def _process_message(self, job, data):
         """doing things with data here"""
+        checkpoint = job.checkpoint
         created_observables_id = []
         created_indicators_id = []
+        fingerprint_entries = []
+        collected = checkpoint.offset
         self.helper.log_info("Creating Observable data")
         _report = ("_report", "Descrition autogeneration")
-        for row in data:
-            if row[0] == "_report":
-                _report = row
-            else:
-                # creating observable
-                observable_type = self._get_type(row[1])
-                try:
-                    observable_description = row[2]
-                except:
-                    observable_description = "from fireeye"
-                self.helper.log_info("Creating Observale...")
-                created_observable = self.helper.api.stix_observable.create(
-                    type=observable_type,
-                    observable_value=row[0],
-                    createdByRef=self.identity["id"],
-                    markingDefinitions=self.markingDefinitions["id"],
-                    description=observable_description,
+        report_name = job.name
+        published = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        if job.shard is not None:
+            # shards of a file link to the report of the file
+            report_name = job.shard["source"]
+            published = job.shard["published"]
+            if job.shard["report"] is not None:
+                _report = job.shard["report"]
+
+        def _record_fingerprints():
+            if self.fingerprints is not None and len(fingerprint_entries) > 0:
+                self.fingerprints.record(fingerprint_entries)
+            del fingerprint_entries[:]
+
+        def _collect(future):
+            nonlocal collected
+            result = future.result()
+            collected += 1
+            created_observables_id.append(result[0])
+            created_indicators_id.append(result[1])
+            if result[2] is not None:
+                fingerprint_entries.append(result[2])
+            if result[3] == "known":
+                job.known += 1
+            elif result[3] == "updated":
+                job.updated += 1
+            if collected % self.checkpoint_size == 0:
+                _record_fingerprints()
+                checkpoint.commit(
+                    collected, created_observables_id, created_indicators_id
                 )
-                # create external references
-                # attach external references to observable
-                # adding tag
-                self.helper.api.stix_entity.add_tag(
-                    id=created_observable["id"], tag_id=self.tag["id"]
+                del created_observables_id[:]
+                del created_indicators_id[:]
+
+        # rows are processed concurrently, results are collected in file order
+        pending = deque()
+        row_index = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                for row in data:
+                    if row[0] == "_report":
+                        _report = row
+                        continue
+                    row_index += 1
+                    # rows before the checkpoint are already imported
+                    if row_index <= checkpoint.offset:
+                        continue
+                    pending.append(executor.submit(self._process_row, job, row))
+                    if len(pending) > self.workers * 2:
+                        _collect(pending.popleft())
+                while pending:
+                    _collect(pending.popleft())
+            except Exception:
+                # the rows collected so far are imported, the next attempt
+                # resumes from the first row that failed
+                for future in pending:
+                    future.cancel()
+                _record_fingerprints()
+                checkpoint.commit(
+                    collected, created_observables_id, created_indicators_id
                 )
-                if "IOCsFromFE" in self.filename:
-                    self.helper.api.stix_entity.add_tag(
-                        id=created_observable["id"], tag_id=self.tagFE["id"]
-                    )
-                # this should be stix_id_key
-                created_observables_id.append(created_observable["id"])
-                created_indicator = self._indicator_create(
-                    row, created_observable["id"]
+                self.helper.log_error(
+                    "{}: import stopped at row {}".format(job.name, collected + 1)
                 )
-                created_indicators_id.append(created_indicator["id"])
+                raise
+        _record_fingerprints()
+        checkpoint.commit(collected, created_observables_id, created_indicators_id)
+        if job.known + job.updated > 0:
+            self.helper.log_info(
+                "{}: {} rows already imported, {} updated, {} unchanged skipped, "
+                "{} API calls avoided".format(
+                    job.name,
+                    job.known + job.updated,
+                    job.updated,
+                    job.known,
+                    job.known * 3 + job.updated,
+                )
+            )
         # Creating report
         self.helper.log_info("Generating report...")
-        created_report = self.helper.api.report.create(
-            name="Data imported from {}".format(self.filename),
-            published=datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-            createdByRef=self.identity["id"],
-            markingDefinitions=self.markingDefinitions["id"],
-            description=_report[1],
-            report_class="Internal Report",
-        )
-        # adding observable
-        self.helper.log_info("Attaching observables to report")
-        for observable_id in created_observables_id:
-            self.helper.api.report.add_stix_observable(
-                id=created_report["id"], stix_observable_id=observable_id
+        with self.metrics.timer("report_create"):
+            created_report = self.helper.api.report.create(
+                name="Data imported from {}".format(report_name),
+                published=published,
+                createdByRef=self.identity["id"],
+                markingDefinitions=self.markingDefinitions["id"],
+                description=_report[1],
+                report_class="Internal Report",
             )
+        # adding observables and indicators
+        self.helper.log_info("Attaching observables and indicators to report")
+        with self.metrics.timer("report_linking"):
+            attached = self._attach_refs(
+                job,
+                created_report["id"],
+                checkpoint.observable_ids,
+                checkpoint.indicator_ids,
+            )
+        self.helper.log_info("{} refs attached to report".format(attached))
         # adding tag
-        self.helper.api.stix_entity.add_tag(
-            id=created_report["id"], tag_id=self.tag["id"]
+        self._add_tag(created_report["id"], self.tag)
+        if not os.path.isfile(job.path):
+            # the lease expired meanwhile, another worker imports the file again
+            self.metrics.inc("claims_total", {"status": "lost"})
+            raise ValueError("Claim on {} lost, not archived".format(job.name))
+        shutil.move(job.path, self._archive_path(job.name))
+        self.claims.finished(job.name)
+        self.helper.log_info(
+            "{} archived after {:.1f}s".format(job.name, time.time() - job.started)
         )
-        # adding indicator
-        self.helper.log_info("Adding indicators to report")
-        for indicator_id in created_indicators_id:
-            self.helper.api.report.add_stix_entity(
-                id=created_report["id"], entity_id=indicator_id
+        checkpoint.clear()
+        self._save_cache()
+        self.helper.log_info(
+            "Lookup cache: {hits} hits, {misses} misses, {size} entries".format(
+                **self.cache.stats()
             )
-        _src = self._data_path + "/files/" + self.filename
-        _dest = (
-            self._data_path
-            + "/archive/"
-            + self.filename
-            + datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
         )
-        shutil.move(_src, _dest)
-        self.helper.log_info("Files achived...")
+
+    def _plan_file(self, _file, planned):
+        """validating a file and counting the calls its import would issue"""
+        job = self._new_job(_file)
+        calls = CallPlan()
+        # rows are only counted, no rejects file is written
+        parser = CsvParser(job.path, None, report_rows=True)
+        rejected = parser.validate()
+        item = {
+            "file": _file,
+            "sha256": file_sha256(job.path),
+            "rows": {
+                "valid": parser.valid,
+                "duplicates": parser.duplicates,
+                "rejected": rejected,
+            },
+        }
+        if rejected > self.max_reject_ratio * (parser.valid + rejected):
+            item["status"] = "rejected"
+            return item, calls
+        created = []
+        linked = []
+        updated = []
+        tags = 0
+        # rows of each shard, linked to the report shard by shard
+        shards = self.claims.shard_count(_file, parser.valid)
+        shard_rows = [0] * shards
+        index = -1
+        for row in parser.rows():
+            if row[0] == "_report":
+                continue
+            index += 1
+            shard_rows[index // self.claims.shard_rows if shards > 1 else 0] += 1
+            observable_type, observable_description, row_fingerprint = self._row_fields(
+                row
+            )
+            key = (row[0], observable_type)
+            record = None
+            if self.fingerprints is not None:
+                record = self.fingerprints.get(row[0], observable_type, row_fingerprint)
+                # rows of earlier files are known once these are imported,
+                # when files are imported one at a time
+                if (
+                    (record is None or record["changed"])
+                    and self.file_workers == 1
+                    and planned.get(key) == row_fingerprint
+                ):
+                    linked.append([row[0], observable_type])
+                    continue
+            if record is None:
+                created.append([row[0], observable_type])
+                # entities are upserted by value, tagged when first created
+                if key not in planned:
+                    tags += 2 * len(job.tags)
+                planned[key] = row_fingerprint
+                continue
+            if record["changed"] and self.update_existing_data:
+                updated.append([row[0], observable_type])
+                planned[key] = row_fingerprint
+            else:
+                linked.append([row[0], observable_type])
+            tags += 2 * sum(1 for tag in job.tags if tag["id"] not in record["tag_ids"])
+        calls.add("stix_observable.create", len(created))
+        calls.add("indicator.create", len(created))
+        calls.add("indicator.add_stix_observable", len(created))
+        calls.add("stix_observable.update_field", len(updated))
+        calls.add("stix_domain_entity.update_field", len(updated))
+        calls.add("stix_entity.add_tag", tags)
+        # every file gets a new report, tagged once, upserted by each shard
+        calls.add("report.create", shards)
+        calls.add("report.read", shards)
+        rows = len(created) + len(linked) + len(updated)
+        calls.add(
+            "query",
+            sum(
+                chunks(2 * count, self.report_linker.chunk_size) for count in shard_rows
+            ),
+        )
+        calls.add("stix_entity.add_tag")
+        item.update(
+            {
+                "status": "import",
+                "shards": shards,
+                "counts": {
+                    "observables": len(created),
+                    "indicators": len(created),
+                    "tags": tags,
+                    "links": 2 * rows,
+                    "known": len(linked),
+                    "updated": len(updated),
+                },
+                "calls": calls.to_dict(),
+                "created": created,
+                "linked": linked,
+                "updated": updated,
+            }
+        )
+        return item, calls
+
+    def plan(self, call_seconds):
+        """computing the calls the import of the dropped files would issue"""
+        watcher = FileWatcher(self._data_path + "/files", int(self.interval_scan))
+        items = []
+        calls = CallPlan()
+        planned = {}
+        for _file in watcher.pending_files():
+            item, file_calls = self._plan_file(_file, planned)
+            self.helper.log_info(
+                "{} planned: {} calls".format(_file, file_calls.total())
+            )
+            items.append(item)
+            calls.update(file_calls)
+        # the connector entities missing from OpenCTI are created at startup
+        for key in self.static.creations:
+            self.helper.log_info("{} planned for creation".format(key))
+        calls.update(self.static.calls)
+        return build_plan(
+            "internal-import",
+            items,
+            calls,
+            self.rate_limiter,
+            self.workers * self.file_workers,
+            call_seconds,
+            self.static.creations,
+        )
+
+    def apply_plan(self, plan):
+        """importing the files of a plan, skipping files changed since"""
+        self.claims.hold()
+        self.scheduler.start()
+        submitted = set()
+        for item in plan["items"]:
+            if item["status"] != "import":
+                continue
+            path = self._data_path + "/files/" + item["file"]
+            if not os.path.isfile(path) or file_sha256(path) != item["sha256"]:
+                self.helper.log_error(
+                    "{} changed since the plan was made, skipping".format(item["file"])
+                )
+                continue
+            self.scheduler.submit(item["file"])
+            submitted.add(item["file"])
+        self.scheduler.join()
+        # large files were split, their shards are imported with them
+        watcher = FileWatcher(self._data_path + "/files", int(self.interval_scan))
+        for _file in watcher.pending_files():
+            if shard_source(_file) in submitted:
+                self.scheduler.submit(_file)
+        self.scheduler.join()
 
     def start(self):
+        watcher = FileWatcher(
+            self._data_path + "/files",
+            int(self.interval_scan),
+            self.watch_mode,
+            log=self.helper.log_error,
+        )
+        self.helper.log_info("Watching for new files with {}".format(watcher.start()))
+        self.claims.start()
+        if self.fingerprints is not None:
+            self.helper.log_info(
+                "{} expired fingerprints purged".format(self.fingerprints.purge())
+            )
+        # files are released once imported, so they can be dropped again
+        self.scheduler.done = watcher.done
+        self.scheduler.start()
         while True:
-            self._open_files()
-            time.sleep(int(self.interval_scan))
-            self.helper.log_info("Sleeping for {} sec.".format(self.interval_scan))
+            self.scheduler.submit(watcher.queue.get())
+            self.metrics.set("files_pending", self.scheduler.pending())
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Internal CSV import connector")
+    parser.add_argument(
+        "--plan",
+        metavar="FILE",
+        help="write the calls importing the dropped files would issue to FILE (- for stdout) and exit",
+    )
+    parser.add_argument(
+        "--apply", metavar="FILE", help="import the plan written to FILE and exit"
+    )
+    parser.add_argument(
+        "--call-seconds",
+        type=float,
+        default=0.05,
+        help="assumed duration of an API call for the plan estimate",
+    )
+    args = parser.parse_args()
     try:
-        importInstance = InternalImport()
+        importInstance = InternalImport(
+            "plan" if args.plan else "apply" if args.apply else None
+        )
+        if args.plan:
+            write_plan(args.plan, importInstance.plan(args.call_seconds))
+            exit(0)
+        if args.apply:
+            importInstance.apply_plan(read_plan(args.apply, "internal-import"))
+            exit(0)
         importInstance.start()
     except Exception as e:
         print(e)
@@ -0,0 +1,164 @@
+from ratelimit import ApiError, check_result, is_transient
+
+REPORT_REFS_ATTRIBUTES = """
+    id
+    objectRefs {
+        edges {
+            node {
+                id
+            }
+        }
+    }
+    observableRefs {
+        edges {
+            node {
+                id
+            }
+        }
+    }
+    relationRefs {
+        edges {
+            node {
+                id
+            }
+        }
+    }
+"""
+
+
+class ReportLinkError(Exception):
+    """refs the platform did not confirm as attached
+
+    ref_ids are the ids left out, attached the number of refs added with them.
+    """
+
+    def __init__(self, message, ref_ids=(), attached=0):
+        super().__init__(message)
+        self.ref_ids = list(ref_ids)
+        self.attached = attached
+
+
+class ReportLinker:
+    """attaching observables and entities to a report in chunked mutations"""
+
+    def __init__(self, api, chunk_size=100):
+        self.api = api
+        self.chunk_size = chunk_size
+
+    def get_refs(self, report_id):
+        """returning the ids already attached to the report"""
+        report = self.api.report.read(
+            id=report_id, customAttributes=REPORT_REFS_ATTRIBUTES
+        )
+        if report is None:
+            return set()
+        return set(
+            report.get("objectRefsIds", [])
+            + report.get("observableRefsIds", [])
+            + report.get("relationRefsIds", [])
+        )
+
+    def attach(
+        self,
+        report_id,
+        observable_ids,
+        entity_ids,
+        existing_refs=None,
+        on_attached=None,
+    ):
+        """attaching missing refs, returning the number of refs added
+
+        on_attached is called with the ids of each chunk once the platform
+        confirmed them. The refs it did not confirm are raised together in a
+        ReportLinkError once every chunk was sent.
+        """
+        if existing_refs is None:
+            existing_refs = self.get_refs(report_id)
+        inputs = []
+        seen = set(existing_refs)
+        for observable_id in observable_ids:
+            if observable_id not in seen:
+                seen.add(observable_id)
+                inputs.append(
+                    {
+                        "fromRole": "observables_aggregation",
+                        "toId": observable_id,
+                        "toRole": "soo",
+                        "through": "observable_refs",
+                    }
+                )
+        for entity_id in entity_ids:
+            if entity_id not in seen:
+                seen.add(entity_id)
+                inputs.append(
+                    {
+                        "fromRole": "knowledge_aggregation",
+                        "toId": entity_id,
+                        "toRole": "so",
+                        "through": "object_refs",
+                    }
+                )
+        missing = []
+        for i in range(0, len(inputs), self.chunk_size):
+            attached, left_out = self._send_chunk(
+                report_id, inputs[i : i + self.chunk_size]
+            )
+            if on_attached is not None and len(attached) > 0:
+                on_attached(attached)
+            missing.extend(left_out)
+        if len(missing) > 0:
+            raise ReportLinkError(
+                "{} of {} refs not attached to report {}".format(
+                    len(missing), len(inputs), report_id
+                ),
+                missing,
+                len(inputs) - len(missing),
+            )
+        return len(inputs)
+
+    def _send_chunk(self, report_id, inputs):
+        """returning the ids attached and the ids left out
+
+        A chunk the platform rejects with a GraphQL error, e.g. for a ref
+        deleted meanwhile, is sent again ref by ref to find the refs at fault.
+        """
+        # one aliased reportEdit per ref, all sent in a single request
+        arguments = []
+        mutations = []
+        variables = {"id": report_id}
+        for index, relation_input in enumerate(inputs):
+            arguments.append("$input" + str(index) + ": RelationAddInput")
+            mutations.append(
+                "add{0}: reportEdit(id: $id) {{ relationAdd(input: $input{0}) {{ id }} }}".format(
+                    index
+                )
+            )
+            variables["input" + str(index)] = relation_input
+        query = "mutation ReportLink($id: ID!, {}) {{ {} }}".format(
+            ", ".join(arguments), " ".join(mutations)
+        )
+        try:
+            result = check_result(self.api.query(query, variables))
+        except ApiError as e:
+            if e.status is not None or is_transient(e):
+                raise
+            if len(inputs) == 1:
+                return [], [inputs[0]["toId"]]
+            attached = []
+            missing = []
+            for relation_input in inputs:
+                ref_attached, ref_missing = self._send_chunk(
+                    report_id, [relation_input]
+                )
+                attached.extend(ref_attached)
+                missing.extend(ref_missing)
+            return attached, missing
+        data = result.get("data") or {}
+        attached = []
+        missing = []
+        for index, relation_input in enumerate(inputs):
+            if data.get("add" + str(index)) is None:
+                missing.append(relation_input["toId"])
+            else:
+                attached.append(relation_input["toId"])
+        return attached, missing
@@ -0,0 +1,189 @@
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import threading
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+EVENT_HEADER = struct.Struct("iIII")
+# files modified more recently than this may still be written
+SETTLE_TIME = 2
+
+
+class FileWatcher:
+    """queueing files dropped in a folder once they are completely written
+
+    inotify reports files as soon as their writer closes them (or once they
+    are renamed into the folder). When inotify is not available, the folder
+    is polled and a file is queued after its size and mtime stayed the same
+    across two scans. When the inotify queue overflows, the folder is scanned
+    again. An error in a scan is logged and the next one goes on, so the
+    watching thread never stops.
+    """
+
+    def __init__(
+        self, path, interval, mode="inotify", ignore=("sample.csv",), log=None
+    ):
+        self.path = path
+        self.interval = interval
+        self.mode = mode
+        self.ignore = set(ignore)
+        self.log = log
+        self.queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.mode == "inotify":
+            try:
+                fd = self._inotify_fd()
+            except OSError:
+                self.mode = "poll"
+            else:
+                target = self._run_inotify
+                args = (fd,)
+        if self.mode != "inotify":
+            target = self._run_polling
+            args = ()
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return self.mode
+
+    def done(self, name):
+        """releasing a processed file so it can be queued again"""
+        with self._lock:
+            self._queued.discard(name)
+
+    def pending_files(self):
+        """files in the folder that would be imported, by name"""
+        return sorted(
+            name
+            for name in os.listdir(self.path)
+            if self._accept(name) and os.path.isfile(os.path.join(self.path, name))
+        )
+
+    def _accept(self, name):
+        return (
+            name not in self.ignore
+            and not name.startswith(".")
+            and not name.endswith((".tmp", ".part"))
+        )
+
+    def _enqueue(self, name):
+        with self._lock:
+            if name in self._queued:
+                return
+            self._queued.add(name)
+        self.queue.put(name)
+
+    def _inotify_fd(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        wd = libc.inotify_add_watch(
+            fd, self.path.encode(), IN_CLOSE_WRITE | IN_MOVED_TO
+        )
+        if wd < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        return fd
+
+    def _run_inotify(self, fd):
+        # files dropped before the watch was set up, the ones still settling
+        # are checked again on every tick until they are old enough
+        settling = None
+        while True:
+            try:
+                if settling is None:
+                    settling = self._queue_settled(os.listdir(self.path))
+                if settling:
+                    readable, _, _ = select.select([fd], [], [], self.interval)
+                    settling = self._queue_settled(settling)
+                    if not readable:
+                        continue
+                for mask, name in self._read_events(fd):
+                    if mask & IN_Q_OVERFLOW:
+                        # events were dropped, scanning the folder again
+                        settling |= self._queue_settled(os.listdir(self.path))
+                    elif name and self._accept(name):
+                        settling.discard(name)
+                        self._enqueue(name)
+            except Exception as e:
+                self._error(e)
+                # events may have been lost with the error
+                settling = None
+
+    def _read_events(self, fd):
+        data = os.read(fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            # file names are bytes, undecodable ones map as os.listdir does
+            name = (
+                data[offset : offset + length]
+                .rstrip(b"\0")
+                .decode(errors="surrogateescape")
+            )
+            offset += length
+            events.append((mask, name))
+        return events
+
+    def _error(self, error):
+        if self.log is not None:
+            self.log("Cannot watch {}: {}".format(self.path, str(error)))
+        time.sleep(self.interval)
+
+    def _queue_settled(self, names):
+        """queueing the files not modified for SETTLE_TIME, returning the others"""
+        now = time.time()
+        settling = set()
+        for name in sorted(names):
+            file_path = os.path.join(self.path, name)
+            if not self._accept(name):
+                continue
+            try:
+                if not os.path.isfile(file_path):
+                    continue
+                mtime = os.path.getmtime(file_path)
+            except OSError:
+                # already claimed or removed
+                continue
+            if now - mtime > SETTLE_TIME:
+                self._enqueue(name)
+            else:
+                settling.add(name)
+        return settling
+
+    def _run_polling(self):
+        previous = {}
+        while True:
+            try:
+                current = {}
+                for name in os.listdir(self.path):
+                    file_path = os.path.join(self.path, name)
+                    if not self._accept(name):
+                        continue
+                    try:
+                        if not os.path.isfile(file_path):
+                            continue
+                        stat = os.stat(file_path)
+                    except OSError:
+                        # already claimed or removed
+                        continue
+                    current[name] = (stat.st_size, stat.st_mtime)
+                    if previous.get(name) == current[name]:
+                        self._enqueue(name)
+                previous = current
+            except Exception as e:
+                self._error(e)
+                continue
+            time.sleep(self.interval)
@@ -2,4 +2,4 @@
 
 cd /opt/opencti-connector-talosip
 
-python3 talosip.py
\ No newline at end of file
+python3 talosip.py "$@"
\ No newline at end of file
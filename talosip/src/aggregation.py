@@ -0,0 +1,34 @@
+from diff_engine import int_to_ipv4
+
+
+def _runs(values):
+    """contiguous runs of sorted integers, as (first, last)"""
+    first = last = None
+    for value in values:
+        if last is not None and value == last + 1:
+            last = value
+            continue
+        if first is not None:
+            yield first, last
+        first = last = value
+    if first is not None:
+        yield first, last
+
+
+def collapse(values):
+    """minimal CIDR blocks covering exactly the sorted IPv4 integers values,
+    as (first, last) ranges"""
+    blocks = []
+    for first, last in _runs(values):
+        while first <= last:
+            # largest block aligned on first which ends within the run
+            size = first & -first if first > 0 else 1 << 32
+            while size > last - first + 1:
+                size >>= 1
+            blocks.append((first, first + size - 1))
+            first += size
+    return blocks
+
+
+def block_cidr(first, last):
+    return "{}/{}".format(int_to_ipv4(first), 33 - (last - first + 1).bit_length())
@@ -0,0 +1,94 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class LookupCache:
+    """LRU cache with TTL for OpenCTI lookups, persisted to a local json file"""
+
+    def __init__(self, path=None, max_size=100000, ttl=86400):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as cache_file:
+                entries = json.load(cache_file)
+        except ValueError:
+            # corrupted cache file, starting from scratch
+            return
+        now = time.time()
+        for key, (expires_at, value) in entries.items():
+            if expires_at > now:
+                self._entries[key] = (expires_at, value)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                entries = dict(self._entries)
+            # a temporary file of its own, other instances and replicas sharing
+            # the data folder save the same file
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.path) or ".",
+                prefix=os.path.basename(self.path) + ".",
+                suffix=".tmp",
+            )
+            try:
+                with os.fdopen(fd, "w") as cache_file:
+                    json.dump(entries, cache_file)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_or_create(self, key, create):
+        """returning the cached value of key, calling create() on a miss"""
+        value = self.get(key)
+        if value is None:
+            value = create()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+
+
+def file_sha256(path):
+    """hashing a file without loading it in memory"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """append-only journal of an import in progress
+
+    The first line records the hash of the source being imported, every
+    following line one committed chunk: the offset reached and the ids
+    created by the chunk. A journal left by a crash is resumed only if the
+    source hash is unchanged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.source_hash = None
+        self.offset = 0
+        self.observable_ids = []
+        self.indicator_ids = []
+
+    def begin(self, source_hash):
+        """loading a matching journal or starting a new one, returning the offset"""
+        self.source_hash = source_hash
+        self.offset = 0
+        self.observable_ids = []
+        self.indicator_ids = []
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as journal:
+                entries = []
+                for line in journal:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # last line may be cut by a crash
+                        break
+            if len(entries) > 0 and entries[0].get("hash") == source_hash:
+                for entry in entries[1:]:
+                    self.offset = entry["offset"]
+                    self.observable_ids.extend(entry["observables"])
+                    self.indicator_ids.extend(entry["indicators"])
+                return self.offset
+        directory = os.path.dirname(self.path)
+        if directory != "" and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path, "w") as journal:
+            journal.write(json.dumps({"hash": source_hash}) + "\n")
+        return self.offset
+
+    def commit(self, offset, observable_ids, indicator_ids):
+        """recording a finished chunk, durable once this returns"""
+        self.offset = offset
+        self.observable_ids.extend(observable_ids)
+        self.indicator_ids.extend(indicator_ids)
+        with open(self.path, "a") as journal:
+            journal.write(
+                json.dumps(
+                    {
+                        "offset": offset,
+                        "observables": observable_ids,
+                        "indicators": indicator_ids,
+                    }
+                )
+                + "\n"
+            )
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -0,0 +1,265 @@
+import bisect
+import heapq
+import os
+import re
+import socket
+import struct
+import tempfile
+from array import array
+
+# number of entries sorted in memory at once before being merged, also the
+# number of entries read back at once from a chunk spilled to disk
+CHUNK_SIZE = 65536
+# number of malformed lines kept as samples for logging
+MALFORMED_SAMPLES = 10
+DOMAIN_FORMAT = re.compile(
+    r"^(?=.{1,253}$)([a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,62}$"
+)
+
+
+def ipv4_to_int(value):
+    """packing a dotted IPv4 string into a 32-bit integer"""
+    return struct.unpack("!I", socket.inet_pton(socket.AF_INET, value))[0]
+
+
+def int_to_ipv4(value):
+    """unpacking a 32-bit integer into a dotted IPv4 string"""
+    return socket.inet_ntop(socket.AF_INET, struct.pack("!I", value))
+
+
+def normalize_domain(value):
+    """lowercasing a domain name, raising ValueError if it is not one"""
+    value = value.lower().rstrip(".")
+    if DOMAIN_FORMAT.match(value) is None:
+        raise ValueError("invalid domain")
+    return value
+
+
+def merge_unique(*sources):
+    """merging sorted sources into one sorted stream without duplicates"""
+    previous = None
+    for value in heapq.merge(*sources):
+        if value != previous:
+            yield value
+            previous = value
+
+
+class PackedValues:
+    """sequence of encoded values, decoded when they are read
+
+    Slices are lists of decoded values, so the values of a run only exist as
+    strings one chunk at a time while the whole sequence stays packed.
+    """
+
+    def __init__(self, values, decode):
+        self.values = values
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.decode(value) for value in self.values[index]]
+        return self.decode(self.values[index])
+
+    def __iter__(self):
+        return (self.decode(value) for value in self.values)
+
+
+class DiffResult:
+    def __init__(
+        self, added, deleted, unchanged, total, malformed, samples, decode=int_to_ipv4
+    ):
+        # added and deleted are sorted sequences of encoded values
+        self.added = added
+        self.deleted = deleted
+        self.unchanged = unchanged
+        self.total = total
+        self.malformed = malformed
+        self.malformed_samples = samples
+        self.decode = decode
+
+    def added_values(self):
+        return (self.decode(value) for value in self.added)
+
+    def deleted_values(self):
+        return (self.decode(value) for value in self.deleted)
+
+
+class IPv4Set:
+    """sorted, deduplicated set of IPv4 addresses stored as packed 32-bit integers"""
+
+    def __init__(self):
+        self.values = self.empty()
+        self.malformed = 0
+        self.malformed_samples = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, value):
+        try:
+            value = self.encode(value)
+        except ValueError:
+            return False
+        index = bisect.bisect_left(self.values, value)
+        return index < len(self.values) and self.values[index] == value
+
+    @staticmethod
+    def empty():
+        return array("I")
+
+    @staticmethod
+    def encode(value):
+        try:
+            return ipv4_to_int(value)
+        except OSError:
+            raise ValueError("invalid ip")
+
+    @staticmethod
+    def decode(value):
+        return int_to_ipv4(value)
+
+    def _sorted_chunk(self, chunk):
+        return array("I", sorted(set(chunk)))
+
+    @staticmethod
+    def _spill(chunk):
+        """writing a sorted chunk to a temporary file, returned rewound"""
+        spilled = tempfile.TemporaryFile()
+        chunk.tofile(spilled)
+        spilled.seek(0)
+        return spilled
+
+    @staticmethod
+    def _read_spilled(spilled):
+        while True:
+            block = array("I")
+            try:
+                block.fromfile(spilled, CHUNK_SIZE)
+            except EOFError:
+                # the last block is shorter, what was read is kept
+                pass
+            if len(block) == 0:
+                return
+            yield from block
+
+    @classmethod
+    def from_lines(cls, lines):
+        """streaming lines into the set, ignoring blanks and comments
+
+        Sorted chunks wait on disk until the last line is read, so only the
+        merged set and one chunk are held in memory.
+        """
+        value_set = cls()
+        spilled = []
+        chunk = []
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8", "replace")
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            try:
+                chunk.append(cls.encode(line))
+            except ValueError:
+                value_set.malformed += 1
+                if len(value_set.malformed_samples) < MALFORMED_SAMPLES:
+                    value_set.malformed_samples.append(line)
+                continue
+            if len(chunk) >= CHUNK_SIZE:
+                spilled.append(value_set._spill(value_set._sorted_chunk(chunk)))
+                chunk = []
+        chunk = value_set._sorted_chunk(chunk)
+        try:
+            sources = [
+                value_set._read_spilled(spilled_chunk) for spilled_chunk in spilled
+            ]
+            value_set.values.extend(merge_unique(chunk, *sources))
+        finally:
+            for spilled_chunk in spilled:
+                spilled_chunk.close()
+        return value_set
+
+    def values_as_strings(self):
+        return (self.decode(value) for value in self.values)
+
+    def save(self, path):
+        """writing the set as a plain text blacklist"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as output:
+            for ip in self.values_as_strings():
+                output.write(ip + "\n")
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_file(cls, path):
+        try:
+            with open(path, "r") as lines:
+                return cls.from_lines(lines)
+        except FileNotFoundError:
+            return cls()
+
+
+class DomainSet(IPv4Set):
+    """sorted, deduplicated set of domain names, for feeds that are not IPv4"""
+
+    @staticmethod
+    def empty():
+        return []
+
+    @staticmethod
+    def encode(value):
+        return normalize_domain(value)
+
+    @staticmethod
+    def decode(value):
+        return value
+
+    def _sorted_chunk(self, chunk):
+        return sorted(set(chunk))
+
+    @staticmethod
+    def _spill(chunk):
+        spilled = tempfile.TemporaryFile("w+")
+        spilled.writelines(value + "\n" for value in chunk)
+        spilled.seek(0)
+        return spilled
+
+    @staticmethod
+    def _read_spilled(spilled):
+        return (line.rstrip("\n") for line in spilled)
+
+
+def diff(new_set, old_set):
+    """computing added/deleted/unchanged entries with a single merge walk"""
+    added = new_set.empty()
+    deleted = new_set.empty()
+    unchanged = 0
+    new_values = new_set.values
+    old_values = old_set.values
+    i = 0
+    j = 0
+    while i < len(new_values) and j < len(old_values):
+        if new_values[i] == old_values[j]:
+            unchanged += 1
+            i += 1
+            j += 1
+        elif new_values[i] < old_values[j]:
+            added.append(new_values[i])
+            i += 1
+        else:
+            deleted.append(old_values[j])
+            j += 1
+    added.extend(new_values[i:])
+    deleted.extend(old_values[j:])
+    return DiffResult(
+        added,
+        deleted,
+        unchanged,
+        len(new_values),
+        new_set.malformed,
+        new_set.malformed_samples,
+        new_set.decode,
+    )
@@ -0,0 +1,169 @@
+import os
+
+from stix2.v20 import TLP_AMBER, TLP_GREEN, TLP_RED, TLP_WHITE
+
+from aggregation import block_cidr
+from checkpoint import Checkpoint
+from diff_engine import DomainSet, IPv4Set, PackedValues, int_to_ipv4
+from fetcher import FeedFetcher
+from ioc_index import IocIndex
+
+OBSERVABLE_TYPES = {
+    "ipv4": {
+        "observable_type": "IPv4-Addr",
+        "pattern_type": "ipv4-addr",
+        "main_observable_type": "ipv4-addr",
+        "set": IPv4Set,
+    },
+    "domain": {
+        "observable_type": "Domain",
+        "pattern_type": "domain-name",
+        "main_observable_type": "domain",
+        "set": DomainSet,
+    },
+}
+TLP_MARKINGS = {
+    "white": TLP_WHITE,
+    "green": TLP_GREEN,
+    "amber": TLP_AMBER,
+    "red": TLP_RED,
+}
+DEFAULT_TAG_COLOR = "#fc036b"
+
+
+class Feed:
+    """one plain-text blocklist with its own schedule, files and diff state"""
+
+    def __init__(
+        self,
+        name,
+        url,
+        interval,
+        directory,
+        observable_type="ipv4",
+        tags=None,
+        tlp="white",
+        author=None,
+        author_description="",
+        report_name=None,
+        report_description=None,
+        report_source=None,
+        report_url=None,
+        snapshot_file="snapshot.txt",
+        journal_file="import.journal",
+        published_file="published_time.txt",
+        index_file="index.db",
+        aggregate=False,
+        aggregate_observables=False,
+        read_only=False,
+    ):
+        if observable_type not in OBSERVABLE_TYPES:
+            raise ValueError(
+                "Feed {}: type must be one of {}".format(
+                    name, ", ".join(OBSERVABLE_TYPES)
+                )
+            )
+        tlp = tlp.lower().replace("tlp:", "")
+        if tlp not in TLP_MARKINGS:
+            raise ValueError(
+                "Feed {}: tlp must be one of {}".format(name, ", ".join(TLP_MARKINGS))
+            )
+        if aggregate and observable_type != "ipv4":
+            raise ValueError(
+                "Feed {}: aggregate is only supported for ipv4 feeds".format(name)
+            )
+        self.name = name
+        self.url = url
+        self.interval = float(interval)
+        self.observable_type = observable_type
+        self.types = OBSERVABLE_TYPES[observable_type]
+        self.tags = [
+            tag if isinstance(tag, dict) else {"value": tag} for tag in tags or []
+        ]
+        for tag in self.tags:
+            tag.setdefault("color", DEFAULT_TAG_COLOR)
+        self.tlp = tlp
+        self.stix_marking = TLP_MARKINGS[tlp]
+        self.author = author or name
+        self.author_description = author_description
+        self.report_name = report_name or name + " blacklist"
+        self.report_description = report_description or (
+            "This report represents the blacklist provided by " + self.author
+        )
+        self.report_source = report_source or self.author
+        self.report_url = report_url or url
+        # adjacent addresses share one indicator per CIDR block
+        self.aggregate = bool(aggregate)
+        self.aggregate_observables = bool(aggregate_observables)
+        if not read_only and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # files written before the index, migrated on the first run
+        self.snapshot_path = os.path.join(directory, snapshot_file)
+        self.published_path = os.path.join(directory, published_file)
+        self.index = IocIndex(os.path.join(directory, index_file), read_only)
+        self.checkpoint = Checkpoint(os.path.join(directory, journal_file))
+        self.fetcher = FeedFetcher(url)
+        # resolved by the connector: tag, identity and marking entities
+        self.tag_entities = []
+        self.identity = None
+        self.marking = None
+        # fingerprint of the content written to the entities of the feed
+        self.content_fingerprint = None
+        # blocks holding deleted values, replaced by the run in progress
+        self.replaced_blocks = []
+        # diff state of the run in progress
+        self.being_added = []
+        self.being_deleted = []
+
+    @classmethod
+    def from_config(cls, feed_config, directory, read_only=False):
+        """building a feed from one entry of the feeds list"""
+        options = dict(feed_config, read_only=read_only)
+        for key in ("name", "url", "interval"):
+            if key not in options:
+                raise ValueError("Feed is missing the {} key".format(key))
+        if "type" in options:
+            options["observable_type"] = options.pop("type")
+        options["directory"] = os.path.join(directory, options["name"])
+        return cls(**options)
+
+    def get_interval(self):
+        return int(self.interval * 60 * 60 * 24)
+
+    def empty_set(self):
+        return self.types["set"]()
+
+    def load_set(self, lines):
+        return self.types["set"].from_lines(lines)
+
+    def load_indexed(self):
+        """building the set of values imported by the previous runs"""
+        value_set = self.empty_set()
+        value_set.values.extend(self.index.values())
+        return value_set
+
+    def encode(self, value):
+        return self.types["set"].encode(value)
+
+    def pack(self, values):
+        """sorted, packed sequence of the valid values"""
+        return PackedValues(self.load_set(values).values, self.types["set"].decode)
+
+    def pattern(self, value):
+        return "[" + self.types["pattern_type"] + ":value = '" + value + "']"
+
+    def block_name(self, first, last):
+        if first == last:
+            return int_to_ipv4(first)
+        return block_cidr(first, last)
+
+    def block_pattern(self, first, last):
+        if first == last:
+            return self.pattern(int_to_ipv4(first))
+        return (
+            "["
+            + self.types["pattern_type"]
+            + ":value ISSUBSET '"
+            + block_cidr(first, last)
+            + "']"
+        )
@@ -0,0 +1,62 @@
+import hashlib
+
+import requests
+
+
+class FetchResult:
+    def __init__(self, response):
+        self.response = response
+        self.not_modified = response.status_code == 304
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        self._hash = hashlib.sha256()
+
+    @property
+    def sha256(self):
+        """hash of the body, complete once lines() has been consumed"""
+        return self._hash.hexdigest()
+
+    def validators(self):
+        return {
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "sha256": self.sha256,
+        }
+
+    def lines(self):
+        """streaming the body line by line while hashing it"""
+        pending = b""
+        try:
+            for chunk in self.response.iter_content(chunk_size=65536):
+                self._hash.update(chunk)
+                pending += chunk
+                lines = pending.split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    yield line
+            if pending:
+                yield pending
+        finally:
+            self.response.close()
+
+
+class FeedFetcher:
+    """conditional HTTP fetcher using ETag/Last-Modified validators"""
+
+    def __init__(self, url, session=None, timeout=60):
+        self.url = url
+        self.session = session if session is not None else requests.Session()
+        self.timeout = timeout
+
+    def fetch(self, etag=None, last_modified=None):
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        response = self.session.get(
+            self.url, headers=headers, stream=True, timeout=self.timeout
+        )
+        if response.status_code != 304:
+            response.raise_for_status()
+        return FetchResult(response)
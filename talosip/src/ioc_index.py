@@ -0,0 +1,255 @@
+import os
+import sqlite3
+import threading
+from urllib.parse import quote
+
+# values per IN (...) lookup, below the sqlite variable limit
+LOOKUP_SIZE = 500
+# rows read at once when iterating the whole index
+FETCH_SIZE = 65536
+
+
+def _split(ids):
+    return ids.split(",") if ids else []
+
+
+class IocIndex:
+    """sqlite index of the values imported from a feed
+
+    Every value listed by the feed maps to the ids created for it in OpenCTI
+    and to the first and last time it was listed. Values are stored encoded
+    (IPv4 addresses as integers) in a table without rowid, which keeps the
+    file compact and lets values() return them in the order used by the diff.
+    Values recorded by an import in progress are only listed once touch()
+    marks the import as complete, so a resumed import computes the same diff.
+    The fingerprint of the content written to the entities of a value is kept
+    with its ids, so only entities imported with another content are updated.
+    Aggregated IPv4 feeds also record the CIDR blocks sharing an indicator.
+    """
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self._lock = threading.Lock()
+        if read_only and os.path.isfile(path):
+            # plan mode reads the index without writing to it
+            self._db = sqlite3.connect(
+                "file:{}?mode=ro".format(quote(os.path.abspath(path))),
+                uri=True,
+                check_same_thread=False,
+            )
+            return
+        # nothing recorded yet, plan mode reads an empty index kept in memory
+        self._db = sqlite3.connect(
+            ":memory:" if read_only else path, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS iocs ("
+            "value PRIMARY KEY, "
+            "observable_id TEXT, "
+            "indicator_ids TEXT, "
+            "external_reference_ids TEXT, "
+            "first_seen INTEGER NOT NULL, "
+            "last_seen INTEGER NOT NULL, "
+            "listed INTEGER NOT NULL DEFAULT 0, "
+            "fingerprint TEXT"
+            ") WITHOUT ROWID"
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(iocs)")]
+        if "fingerprint" not in columns:
+            # index written before fingerprints were recorded
+            self._db.execute("ALTER TABLE iocs ADD COLUMN fingerprint TEXT")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS blocks ("
+            "first INTEGER PRIMARY KEY, "
+            "last INTEGER NOT NULL, "
+            "indicator_id TEXT NOT NULL"
+            ")"
+        )
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM iocs").fetchone()[0]
+
+    def values(self):
+        """streaming the values of the last complete import in ascending order"""
+        cursor = self._db.execute(
+            "SELECT value FROM iocs WHERE listed = 1 ORDER BY value"
+        )
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(FETCH_SIZE)
+            if len(rows) == 0:
+                return
+            for row in rows:
+                yield row[0]
+
+    def get_many(self, values):
+        """returning value -> record for the indexed values among values"""
+        records = {}
+        values = list(values)
+        for i in range(0, len(values), LOOKUP_SIZE):
+            batch = values[i : i + LOOKUP_SIZE]
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT value, observable_id, indicator_ids, "
+                    "external_reference_ids, first_seen, last_seen FROM iocs "
+                    "WHERE value IN ({})".format(", ".join("?" * len(batch))),
+                    batch,
+                ).fetchall()
+            for row in rows:
+                records[row[0]] = {
+                    "id": row[1],
+                    "indicatorsIds": _split(row[2]),
+                    "externalReferencesIds": _split(row[3]),
+                    "first_seen": row[4],
+                    "last_seen": row[5],
+                }
+        return records
+
+    def record(self, entries, timestamp, fingerprint=None):
+        """storing the ids created for (value, observable_id, indicator_ids,
+        external_reference_ids) entries"""
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO iocs VALUES (?, ?, ?, ?, ?, ?, 0, ?) "
+                "ON CONFLICT (value) DO UPDATE SET "
+                "observable_id = excluded.observable_id, "
+                "indicator_ids = excluded.indicator_ids, "
+                "external_reference_ids = excluded.external_reference_ids, "
+                "last_seen = excluded.last_seen, "
+                "fingerprint = excluded.fingerprint",
+                (
+                    (
+                        value,
+                        observable_id,
+                        ",".join(indicator_ids),
+                        ",".join(external_reference_ids),
+                        timestamp,
+                        timestamp,
+                        fingerprint,
+                    )
+                    for value, observable_id, indicator_ids, external_reference_ids in entries
+                ),
+            )
+
+    def touch(self, values, timestamp):
+        """marking values as listed, adding the ones not indexed yet"""
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO iocs (value, first_seen, last_seen, listed) "
+                "VALUES (?, ?, ?, 1) "
+                "ON CONFLICT (value) DO UPDATE SET "
+                "last_seen = excluded.last_seen, listed = 1",
+                ((value, timestamp, timestamp) for value in values),
+            )
+
+    def remove(self, values):
+        with self._lock, self._db:
+            self._db.executemany(
+                "DELETE FROM iocs WHERE value = ?", ((value,) for value in values)
+            )
+
+    def stale(self, fingerprint, after=None, limit=LOOKUP_SIZE):
+        """returning (value, record, fingerprint) of listed values imported
+        with another fingerprint, in ascending order after the value after"""
+        query = (
+            "SELECT value, observable_id, indicator_ids, external_reference_ids, "
+            "fingerprint FROM iocs WHERE listed = 1 AND observable_id IS NOT NULL "
+            "AND fingerprint IS NOT NULL AND fingerprint != ?"
+        )
+        parameters = [fingerprint]
+        if after is not None:
+            query += " AND value > ?"
+            parameters.append(after)
+        with self._lock:
+            rows = self._db.execute(
+                query + " ORDER BY value LIMIT ?", parameters + [limit]
+            ).fetchall()
+        return [
+            (
+                row[0],
+                {
+                    "id": row[1],
+                    "indicatorsIds": _split(row[2]),
+                    "externalReferencesIds": _split(row[3]),
+                },
+                row[4],
+            )
+            for row in rows
+        ]
+
+    def count_fingerprint(self, fingerprint):
+        """number of listed values imported with fingerprint"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM iocs WHERE listed = 1 "
+                "AND observable_id IS NOT NULL AND fingerprint = ?",
+                (fingerprint,),
+            ).fetchone()[0]
+
+    def set_fingerprint(self, values, fingerprint):
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE iocs SET fingerprint = ? WHERE value = ?",
+                ((fingerprint, value) for value in values),
+            )
+
+    def fill_fingerprint(self, fingerprint):
+        """setting the fingerprint of values indexed without one"""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE iocs SET fingerprint = ? WHERE fingerprint IS NULL",
+                (fingerprint,),
+            )
+
+    def blocks_of(self, values):
+        """returning the (first, last, indicator_id) blocks holding values"""
+        blocks = {}
+        with self._lock:
+            for value in values:
+                row = self._db.execute(
+                    "SELECT first, last, indicator_id FROM blocks WHERE first <= ? "
+                    "ORDER BY first DESC LIMIT 1",
+                    (value,),
+                ).fetchone()
+                if row is not None and row[1] >= value:
+                    blocks[row[0]] = row
+        return [blocks[first] for first in sorted(blocks)]
+
+    def record_blocks(self, blocks):
+        """storing (first, last, indicator_id) blocks"""
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?)", blocks
+            )
+
+    def remove_blocks(self, blocks):
+        """dropping (first, last, indicator_id) blocks not replaced since"""
+        with self._lock, self._db:
+            self._db.executemany(
+                "DELETE FROM blocks WHERE first = ? AND indicator_id = ?",
+                ((first, indicator_id) for first, _, indicator_id in blocks),
+            )
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key, value):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value))
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
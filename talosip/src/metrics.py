@@ -0,0 +1,176 @@
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# api client methods that are not calls to the platform
+UNCOUNTED_METHODS = ("log",)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(key, str(value).replace('"', '\\"'))
+            for key, value in sorted(labels.items())
+        )
+        + "}"
+    )
+
+
+class Metrics:
+    """counters and timings of a connector, rendered in the Prometheus text format
+
+    Counters count events (API calls, errors, imported IOCs), gauges hold the
+    last value set (concurrency limit), summaries accumulate the count, total
+    and maximum of durations (stages, API call latency). serve() exposes them
+    on /metrics from a background thread.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._summaries = {}
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, seconds, labels=None):
+        key = (name, _labels(labels))
+        with self._lock:
+            summary = self._summaries.setdefault(key, [0, 0.0, 0.0])
+            summary[0] += 1
+            summary[1] += seconds
+            summary[2] = max(summary[2], seconds)
+
+    @contextmanager
+    def timer(self, stage, labels=None):
+        """timing a stage of the import"""
+        labels = dict(labels or {}, stage=stage)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.monotonic() - start, labels)
+
+    def instrument(self, api):
+        """wrapping an api client to count and time its calls"""
+        return ApiProxy(api, self)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            summaries = sorted(self._summaries.items())
+        declared = set()
+        for (name, labels), value in counters:
+            metric = self.prefix + "_" + name
+            if metric not in declared:
+                lines.append("# TYPE {} counter".format(metric))
+                declared.add(metric)
+            lines.append("{}{} {}".format(metric, labels, value))
+        for (name, labels), value in gauges:
+            metric = self.prefix + "_" + name
+            if metric not in declared:
+                lines.append("# TYPE {} gauge".format(metric))
+                declared.add(metric)
+            lines.append("{}{} {}".format(metric, labels, value))
+        for (name, labels), (count, total, maximum) in summaries:
+            metric = self.prefix + "_" + name
+            if metric not in declared:
+                lines.append("# TYPE {} summary".format(metric))
+                declared.add(metric)
+            lines.append("{}_count{} {}".format(metric, labels, count))
+            lines.append("{}_sum{} {:.6f}".format(metric, labels, total))
+            lines.append("{}_max{} {:.6f}".format(metric, labels, maximum))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="0.0.0.0"):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, int(port)), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class ApiProxy:
+    """forwarding attribute access to an api client, counting and timing calls
+
+    Entity helpers (api.stix_observable, api.report...) are wrapped as well, so
+    api.stix_observable.create() is recorded as "stix_observable.create".
+    """
+
+    def __init__(self, target, metrics, path=None):
+        self._target = target
+        self._metrics = metrics
+        self._path = path
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        method = name if self._path is None else self._path + "." + name
+        if name in UNCOUNTED_METHODS or name.startswith("_"):
+            return attribute
+        if inspect.isroutine(attribute):
+            return self._wrap(attribute, method)
+        if attribute is None or isinstance(
+            attribute, (str, bytes, int, float, bool, dict, list, tuple)
+        ):
+            return attribute
+        return ApiProxy(attribute, self._metrics, method)
+
+    def __call__(self, *args, **kwargs):
+        return self._wrap(self._target, self._path)(*args, **kwargs)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._target, name, value)
+
+    def _wrap(self, function, method):
+        metrics = self._metrics
+
+        def call(*args, **kwargs):
+            labels = {"method": method}
+            metrics.inc("api_calls_total", labels)
+            start = time.monotonic()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                metrics.inc("api_errors_total", labels)
+                raise
+            finally:
+                metrics.observe("api_call_seconds", time.monotonic() - start, labels)
+
+        return call
@@ -0,0 +1,129 @@
+import queue
+import threading
+import time
+
+# seconds between checks of the stop event while waiting on a queue
+POLL_INTERVAL = 0.5
+# marks the end of the items of a queue
+_DONE = object()
+
+
+class Pipeline:
+    """chains of stages running in their own threads, linked by bounded queues
+
+    Each chain reads the items of a source and passes them through its
+    stages, every stage handing what it returns to the next one (None drops
+    the item). A full queue blocks the stage feeding it, so a slow stage
+    holds back the ones before it instead of buffering their output, and at
+    most queue_size items wait between two stages. Chains run concurrently;
+    the first error stops every stage and is raised by run().
+    """
+
+    def __init__(self, metrics, labels=None, queue_size=4):
+        self.metrics = metrics
+        self.labels = labels or {}
+        self.queue_size = queue_size
+        self._threads = []
+        self._stop = threading.Event()
+        self._errors = []
+
+    def chain(self, source_name, source, stages):
+        """adding a chain reading source through stages, a list of
+        (name, function) pairs"""
+        inbox = self._queue(stages[0][0])
+        self._thread(source_name, self._feed, source_name, source, inbox)
+        for index, (name, function) in enumerate(stages):
+            outbox = None
+            if index + 1 < len(stages):
+                outbox = self._queue(stages[index + 1][0])
+            self._thread(name, self._work, name, function, inbox, outbox)
+            inbox = outbox
+
+    def run(self):
+        for thread in self._threads:
+            thread.start()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+    def _queue(self, stage):
+        inbox = queue.Queue(maxsize=self.queue_size)
+        inbox.stage = stage
+        return inbox
+
+    def _thread(self, name, target, *args):
+        thread = threading.Thread(
+            target=self._guard,
+            args=(target,) + args,
+            name="pipeline-" + name,
+            daemon=True,
+        )
+        self._threads.append(thread)
+
+    def _guard(self, target, *args):
+        try:
+            target(*args)
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+
+    def _depth(self, inbox):
+        self.metrics.set(
+            "pipeline_queue_depth", inbox.qsize(), dict(self.labels, stage=inbox.stage)
+        )
+
+    def _put(self, stage, outbox, item):
+        """waiting for room in outbox, returning False once stopped"""
+        start = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                outbox.put(item, timeout=POLL_INTERVAL)
+            except queue.Full:
+                continue
+            self._depth(outbox)
+            # time lost waiting on the next stage
+            self.metrics.observe(
+                "pipeline_blocked_seconds",
+                time.monotonic() - start,
+                dict(self.labels, stage=stage),
+            )
+            return True
+        return False
+
+    def _get(self, inbox):
+        """next item of inbox, _DONE once its feeder finished or stopped"""
+        while not self._stop.is_set():
+            try:
+                item = inbox.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            self._depth(inbox)
+            return item
+        return _DONE
+
+    def _feed(self, name, source, outbox):
+        for item in source:
+            self.metrics.inc("pipeline_items_total", dict(self.labels, stage=name))
+            if not self._put(name, outbox, item):
+                return
+        self._put(name, outbox, _DONE)
+
+    def _work(self, name, function, inbox, outbox):
+        labels = dict(self.labels, stage=name)
+        while True:
+            item = self._get(inbox)
+            if item is _DONE:
+                break
+            start = time.monotonic()
+            result = function(item)
+            self.metrics.observe(
+                "pipeline_busy_seconds", time.monotonic() - start, labels
+            )
+            self.metrics.inc("pipeline_items_total", labels)
+            if outbox is not None and result is not None:
+                if not self._put(name, outbox, result):
+                    return
+        if outbox is not None:
+            self._put(name, outbox, _DONE)
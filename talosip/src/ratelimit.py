@@ -0,0 +1,307 @@
+import random
+import threading
+import time
+
+import requests
+from pycti import get_config_variable
+
+RETRY_STATUS = (429, 502, 503, 504)
+# error messages of the platform worth another try
+TRANSIENT_MESSAGES = (
+    "timeout",
+    "timed out",
+    "too many requests",
+    "temporarily unavailable",
+    "connection reset",
+    "connection aborted",
+    "bad gateway",
+    "service unavailable",
+)
+
+
+class ApiError(Exception):
+    """a GraphQL request answered with an HTTP error status or GraphQL errors"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def is_transient(error):
+    """whether an API call failing with error can be tried again"""
+    if isinstance(
+        error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    ):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUS
+    if isinstance(error, ApiError) and error.status is not None:
+        return error.status in RETRY_STATUS
+    message = str(error).lower()
+    return any(transient in message for transient in TRANSIENT_MESSAGES)
+
+
+def check_result(result):
+    """returning a GraphQL result, raising ApiError if it carries no data"""
+    if result is None:
+        raise ApiError("no result, the request failed")
+    errors = result.get("errors")
+    if errors:
+        error = errors[0]
+        reason = (error.get("data") or {}).get("reason")
+        raise ApiError(reason or error.get("message") or str(error))
+    return result
+
+
+def _has_files(variables):
+    # pycti File variables are sent as a multipart upload by api.query
+    for value in variables.values():
+        values = value if isinstance(value, list) else [value]
+        if any(type(item).__name__ == "File" for item in values):
+            return True
+    return False
+
+
+def retry(function, retries=5, base=0.5, cap=30.0, on_retry=None):
+    """calling function, retrying transient errors with jittered exponential backoff
+
+    The n-th retry waits a random delay between 0 and min(cap, base * 2**n), so
+    workers failing together do not hit the platform again at the same time.
+    """
+    attempt = 0
+    while True:
+        try:
+            return function()
+        except Exception as e:
+            if attempt >= retries or not is_transient(e):
+                raise
+            delay = random.uniform(0, min(cap, base * 2**attempt))
+            attempt += 1
+            if on_retry is not None:
+                on_retry(e, attempt, delay)
+            time.sleep(delay)
+
+
+class TokenBucket:
+    """allowing rate calls per second on average, with bursts of burst calls"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(self.rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """taking one token, returning the seconds waited for it"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdaptiveConcurrency:
+    """AIMD limit of the API calls in flight
+
+    The limit grows by one after a full window of calls answered within the
+    latency target, and is halved on a transient error or a slower call. It is
+    halved at most once per cooldown, so a burst of failures counts once.
+    """
+
+    def __init__(self, maximum, minimum=1, latency_target=None, cooldown=5.0):
+        self.maximum = maximum
+        self.minimum = max(1, min(minimum, maximum))
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.limit = float(maximum)
+        self._in_flight = 0
+        self._successes = 0
+        self._decreased = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """waiting for a free slot, returning the seconds waited"""
+        start = time.monotonic()
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+        return time.monotonic() - start
+
+    def release(self, latency=None, overloaded=False):
+        with self._condition:
+            self._in_flight -= 1
+            slow = (
+                self.latency_target is not None
+                and latency is not None
+                and latency > self.latency_target
+            )
+            if overloaded or slow:
+                now = time.monotonic()
+                if now - self._decreased >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._decreased = now
+                    self._successes = 0
+            elif latency is not None:
+                self._successes += 1
+                if self._successes >= int(self.limit):
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self._successes = 0
+            self._condition.notify_all()
+
+
+class RateLimiter:
+    """token bucket, AIMD concurrency and retries applied to every API call"""
+
+    def __init__(
+        self,
+        rate=None,
+        burst=None,
+        max_concurrency=None,
+        min_concurrency=1,
+        latency_target=None,
+        timeout=60.0,
+        retries=5,
+        backoff=0.5,
+        backoff_cap=30.0,
+        metrics=None,
+        log=None,
+    ):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.concurrency = (
+            AdaptiveConcurrency(max_concurrency, min_concurrency, latency_target)
+            if max_concurrency
+            else None
+        )
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.metrics = metrics
+        self.log = log
+
+    @classmethod
+    def from_config(cls, config, metrics=None, log=None):
+        retries = get_config_variable(
+            "API_RETRIES", ["connector", "api_retries"], config, True
+        )
+        latency_target = get_config_variable(
+            "API_LATENCY_TARGET", ["connector", "api_latency_target"], config
+        )
+        return cls(
+            rate=float(
+                get_config_variable(
+                    "API_RATE_LIMIT", ["connector", "api_rate_limit"], config
+                )
+                or 0
+            ),
+            burst=get_config_variable(
+                "API_BURST", ["connector", "api_burst"], config, True
+            ),
+            max_concurrency=get_config_variable(
+                "API_MAX_CONCURRENCY",
+                ["connector", "api_max_concurrency"],
+                config,
+                True,
+            ),
+            min_concurrency=get_config_variable(
+                "API_MIN_CONCURRENCY",
+                ["connector", "api_min_concurrency"],
+                config,
+                True,
+            )
+            or 1,
+            latency_target=float(latency_target or 0) or None,
+            timeout=float(
+                get_config_variable("API_TIMEOUT", ["connector", "api_timeout"], config)
+                or 60
+            ),
+            retries=5 if retries is None else retries,
+            backoff=float(
+                get_config_variable("API_BACKOFF", ["connector", "api_backoff"], config)
+                or 0.5
+            ),
+            metrics=metrics,
+            log=log,
+        )
+
+    def install(self, api):
+        """routing the GraphQL requests of an api client through the limiter
+
+        pycti entity helpers all end in api.query, which logs HTTP and GraphQL
+        errors and returns None. The query patched on the client raises
+        ApiError instead, so failed calls are retried, lower the concurrency
+        and reach the caller. Each HTTP request takes one token and one slot.
+        """
+        original = api.query
+
+        def query(query, variables={}):
+            return self.call("query", self._query, api, original, query, variables)
+
+        api.query = query
+        return api
+
+    def _query(self, api, original, query, variables):
+        if _has_files(variables) or not hasattr(api, "api_url"):
+            return check_result(original(query, variables))
+        response = requests.post(
+            api.api_url,
+            json={"query": query, "variables": variables},
+            headers=api.request_headers,
+            verify=api.ssl_verify,
+            timeout=self.timeout,
+        )
+        if response.status_code != 200:
+            raise ApiError(
+                "HTTP {}: {}".format(response.status_code, response.text[:200]),
+                response.status_code,
+            )
+        return check_result(response.json())
+
+    def call(self, method, function, *args, **kwargs):
+        def attempt():
+            waited = 0.0
+            if self.bucket is not None:
+                waited += self.bucket.acquire()
+            if self.concurrency is not None:
+                waited += self.concurrency.acquire()
+            if self.metrics is not None and waited > 0:
+                self.metrics.observe("api_throttle_seconds", waited, {"method": method})
+            start = time.monotonic()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if self.concurrency is not None:
+                    self.concurrency.release(overloaded=is_transient(e))
+                raise
+            if self.concurrency is not None:
+                self.concurrency.release(latency=time.monotonic() - start)
+            return result
+
+        def on_retry(error, number, delay):
+            if self.metrics is not None:
+                self.metrics.inc("api_retries_total", {"method": method})
+            if self.log is not None:
+                self.log(
+                    "{} failed ({}), retry {}/{} in {:.1f}s".format(
+                        method, str(error), number, self.retries, delay
+                    )
+                )
+
+        try:
+            return retry(
+                attempt, self.retries, self.backoff, self.backoff_cap, on_retry
+            )
+        finally:
+            if self.metrics is not None and self.concurrency is not None:
+                self.metrics.set("api_concurrency_limit", int(self.concurrency.limit))
@@ -1,17 +1,104 @@
 import yaml
+import argparse
+import hashlib
+import json
 import os
+import threading
 import time
-import wget
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import shutil
 
 from pycti import OpenCTIConnectorHelper, get_config_variable
-from stix2 import TLP_WHITE
+from stix2.v20 import Bundle, Identity, Indicator, Report
 from pycti.utils.constants import CustomProperties
 
+from aggregation import collapse
+from cache import LookupCache
+from diff_engine import PackedValues, diff, int_to_ipv4, merge_unique
+from feed import Feed
+from metrics import Metrics
+from pipeline import Pipeline
+from plan import (
+    CallPlan,
+    PlanHelper,
+    StaticPlan,
+    build_plan,
+    chunks,
+    read_plan,
+    write_plan,
+)
+from ratelimit import RateLimiter, retry
+from report_linker import ReportLinker
+
+OBSERVABLE_DELETE_ATTRIBUTES = """
+    id
+    observable_value
+    indicators {
+        edges {
+            node {
+                id
+            }
+        }
+    }
+    externalReferences {
+        edges {
+            node {
+                id
+            }
+        }
+    }
+"""
+# relations of an entity to its markings and tags, with the relation ids
+ENTITY_RELATIONS_QUERY = """
+    query EntityRelations($id: String!) {
+        stixEntity(id: $id) {
+            id
+            markingDefinitions {
+                edges {
+                    node {
+                        id
+                    }
+                    relation {
+                        id
+                    }
+                }
+            }
+            tags {
+                edges {
+                    node {
+                        id
+                    }
+                    relation {
+                        id
+                    }
+                }
+            }
+        }
+    }
+"""
+RELATION_DELETE_MUTATION = """
+    mutation EntityRelationDelete($id: ID!, $relationId: ID!) {
+        stixEntityEdit(id: $id) {
+            relationDelete(relationId: $relationId) {
+                id
+            }
+        }
+    }
+"""
+# state keys written by the single feed versions
+LEGACY_STATE_KEYS = ("etag", "last_modified", "sha256", "last_run")
+
+
+def content_fingerprint(content):
+    """hash of the fields written to an entity besides its value"""
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
 
 class Talosip:
-    def __init__(self):
+    def __init__(self, mode=None):
+        # mode is "plan" (read only) or "apply" for the one-off runs next to
+        # the running connector, which serve no metrics
         config_file_path = os.path.dirname(os.path.abspath(__file__)) + "/config.yml"
         config = (
             yaml.load(open(config_file_path), Loader=yaml.FullLoader)
@@ -32,257 +119,1363 @@ class Talosip:
         self.delete_old_data = get_config_variable(
             "DELETE_OLD_DATA", ["connector", "delete_old_data"], config
         )
-        self.helper = OpenCTIConnectorHelper(config)
-        # get tag
-        self.talos_tag = self.helper.api.tag.create(
-            tag_type="Event", value="TalosIntelligence", color="#fc036b"
+        self.delete_batch_size = (
+            get_config_variable(
+                "DELETE_BATCH_SIZE", ["talosip", "delete_batch_size"], config, True
+            )
+            or 100
+        )
+        self.delete_workers = (
+            get_config_variable(
+                "DELETE_WORKERS", ["talosip", "delete_workers"], config, True
+            )
+            or 4
+        )
+        self.checkpoint_size = (
+            get_config_variable(
+                "CHECKPOINT_SIZE", ["talosip", "checkpoint_size"], config, True
+            )
+            or 500
+        )
+        self.bundle_mode = get_config_variable(
+            "TALOSIP_BUNDLE_MODE", ["talosip", "bundle_mode"], config
+        )
+        self.bundle_size = (
+            get_config_variable(
+                "TALOSIP_BUNDLE_SIZE", ["talosip", "bundle_size"], config, True
+            )
+            or 1000
+        )
+        self.pipeline_queue_size = (
+            get_config_variable(
+                "TALOSIP_PIPELINE_QUEUE_SIZE",
+                ["talosip", "pipeline_queue_size"],
+                config,
+                True,
+            )
+            or 4
+        )
+        self.aggregate = get_config_variable(
+            "TALOSIP_AGGREGATE", ["talosip", "aggregate"], config
         )
-        self.ipv4_tag = self.helper.api.tag.create(
-            tag_type="Event", value="ipv4-blacklist", color="#1c100b"
+        self.aggregate_observables = get_config_variable(
+            "TALOSIP_AGGREGATE_OBSERVABLES",
+            ["talosip", "aggregate_observables"],
+            config,
+        )
+        self.cache = LookupCache(
+            path=os.path.dirname(os.path.abspath(__file__)) + "/cache.json",
+            max_size=get_config_variable(
+                "CACHE_SIZE", ["connector", "cache_size"], config, True
+            )
+            or 100000,
+            ttl=get_config_variable(
+                "CACHE_TTL", ["connector", "cache_ttl"], config, True
+            )
+            or 86400,
+        )
+        self.feed_workers = (
+            get_config_variable(
+                "TALOSIP_FEED_WORKERS", ["talosip", "feed_workers"], config, True
+            )
+            or 4
+        )
+        self.helper = (
+            PlanHelper(config) if mode == "plan" else OpenCTIConnectorHelper(config)
+        )
+        self.metrics = Metrics("talosip")
+        self.rate_limiter = RateLimiter.from_config(
+            config, self.metrics, self.helper.log_info
+        )
+        # client methods are counted by the metrics, the GraphQL requests
+        # they send are throttled and retried by the limiter
+        self.helper.api = self.metrics.instrument(
+            self.rate_limiter.install(self.helper.api)
+        )
+        metrics_port = get_config_variable(
+            "METRICS_PORT", ["connector", "metrics_port"], config, True
+        )
+        if metrics_port and mode is None:
+            self.metrics.serve(metrics_port)
+        self.state_lock = threading.Lock()
+        self.report_linker = ReportLinker(
+            self.helper.api,
+            get_config_variable(
+                "REPORT_CHUNK_SIZE", ["connector", "report_chunk_size"], config, True
+            )
+            or 100,
+        )
+        self.read_only = mode == "plan"
+        # a plan only reads the feed entities, missing ones are planned
+        self.static = StaticPlan(self.cache) if self.read_only else None
+        self.feeds = self._load_feeds(config)
+        if self.bundle_mode and any(feed.aggregate for feed in self.feeds):
+            raise ValueError("Aggregated feeds are not supported in bundle mode")
+        for feed in self.feeds:
+            self._resolve_feed_entities(feed)
+        if not self.read_only:
+            self.cache.save()
+
+    def _load_feeds(self, config):
+        """building the feeds list, or the single Talos feed when none is set"""
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        feeds_config = get_config_variable(
+            "TALOSIP_FEEDS", ["talosip", "feeds"], config
         )
+        if isinstance(feeds_config, str):
+            feeds_config = yaml.safe_load(feeds_config)
+        if feeds_config:
+            feeds = [
+                Feed.from_config(feed_config, src_dir + "/feeds", self.read_only)
+                for feed_config in feeds_config
+            ]
+            names = [feed.name for feed in feeds]
+            if len(set(names)) != len(names):
+                raise ValueError("Feed names must be unique")
+            return feeds
+        # files are kept where previous versions wrote them
+        return [
+            Feed(
+                name="talosip",
+                url=self.talosip_url,
+                interval=self.talosip_interval or 1,
+                directory=src_dir,
+                observable_type="ipv4",
+                tags=[
+                    {"value": "TalosIntelligence", "color": "#fc036b"},
+                    {"value": "ipv4-blacklist", "color": "#1c100b"},
+                ],
+                tlp="white",
+                author="Cisco Talos",
+                author_description="Talosintilligence IP Blacklist",
+                report_name="Talos Intelligence IP Blacklist",
+                report_description="This report represents the blacklist provided by Cisco Talos",
+                report_source="Talos Intelligence",
+                report_url="https://talosintelligence.com/",
+                snapshot_file="old_ip_blacklist.txt",
+                aggregate=self.aggregate,
+                aggregate_observables=self.aggregate_observables,
+                read_only=self.read_only,
+            )
+        ]
+
+    def _get_static(self, key, method, create, read):
+        """a feed entity from the cache, created on a miss, or only read
+        while planning"""
+        if self.static is not None:
+            return self.static.get(key, method, read)
+        return self.cache.get_or_create(key, create)
+
+    def _resolve_feed_entities(self, feed):
+        # get tags
+        feed.tag_entities = [
+            self._get_static(
+                "tag:" + tag["value"],
+                "tag.create",
+                lambda tag=tag: self.helper.api.tag.create(
+                    tag_type="Event", value=tag["value"], color=tag["color"]
+                ),
+                lambda tag=tag: self.helper.api.tag.read(
+                    filters=[{"key": "value", "values": [tag["value"]]}]
+                ),
+            )
+            for tag in feed.tags
+        ]
         # create identity
         self.helper.log_info("Creating an Identity...")
-        self.entity_identity = self.helper.api.identity.create(
-            name="Cisco Talos",
-            type="Organization",
-            description="Talosintilligence IP Blacklist",
+        feed.identity = self._get_static(
+            "identity:" + feed.author,
+            "identity.create",
+            lambda: self.helper.api.identity.create(
+                name=feed.author,
+                type="Organization",
+                description=feed.author_description,
+            ),
+            lambda: self.helper.api.identity.read(
+                filters=[{"key": "name", "values": [feed.author]}]
+            ),
         )
         # create marking definition
-        self.tlp_white_marking_definition = self.helper.api.marking_definition.read(
-            filters={"key": "definition", "values": ["TLP:WHITE"]}
-        )
-        # report published time
-        self.published_report = None
-        self.being_added = []
-        self.being_deleted = []
-
-    def delete_old_entity(self):
-        if len(self.being_deleted) > 0:
-            self.helper.log_info("Deleting old entity")
-            for ip in self.being_deleted:
-                # listing being deleted
-                object_result = self.helper.api.stix_observable.read(
-                    filters=[{"key": "observable_value", "values": [ip]}],
+        definition = "TLP:" + feed.tlp.upper()
+        feed.marking = self.cache.get_or_create(
+            "marking:" + definition,
+            lambda: self.helper.api.marking_definition.read(
+                filters={"key": "definition", "values": [definition]}
+            ),
+        )
+
+    def _get_feed_state(self, feed):
+        with self.state_lock:
+            state = self.helper.get_state() or {}
+        feeds_state = state.get("feeds")
+        if feeds_state is None:
+            # state written before feeds were introduced belongs to the Talos feed
+            if feed.name != "talosip":
+                return {}
+            return {key: state[key] for key in LEGACY_STATE_KEYS if key in state}
+        return dict(feeds_state.get(feed.name, {}))
+
+    def _set_feed_state(self, feed, values):
+        with self.state_lock:
+            state = self.helper.get_state() or {}
+            if "feeds" not in state:
+                legacy = {
+                    key: state.pop(key) for key in LEGACY_STATE_KEYS if key in state
+                }
+                state["feeds"] = {"talosip": legacy} if legacy else {}
+            state["feeds"].setdefault(feed.name, {}).update(values)
+            self.helper.set_state(state)
+
+    def _resolve_observables(self, values):
+        """resolving observables of many values with batched filter queries"""
+        resolved = {}
+        for i in range(0, len(values), self.delete_batch_size):
+            batch = values[i : i + self.delete_batch_size]
+            try:
+                observables = self.helper.api.stix_observable.list(
+                    filters=[{"key": "observable_value", "values": batch}],
+                    first=len(batch),
+                    customAttributes=OBSERVABLE_DELETE_ATTRIBUTES,
                 )
-                # deleting observable
-                self.helper.api.stix_observable.delete(id=object_result["id"])
-                # deleting indicators
-                for indicator_id in object_result["indicatorsIds"]:
-                    self.helper.api.stix_domain_entity.delete(id=indicator_id)
-                # deleting external references
-                for external_ref_id in object_result["externalReferencesIds"]:
-                    self.helper.api.stix_domain_entity.delete(id=external_ref_id)
-        else:
-            self.helper.log_info("Nothing to delete")
+            except Exception as e:
+                self.helper.log_error("Cannot resolve observables: " + str(e))
+                continue
+            for observable in observables:
+                resolved[observable["observable_value"]] = observable
+        return resolved
 
-    def _get_published_report(self):
-        published_time = (
-            os.path.dirname(os.path.abspath(__file__)) + "/published_time.txt"
+    def _delete_observable(self, value, object_result):
+        """deleting an observable with its indicators and external references"""
+        # deleting indicators
+        for indicator_id in object_result["indicatorsIds"]:
+            self.helper.api.stix_domain_entity.delete(id=indicator_id)
+        # deleting external references
+        for external_ref_id in object_result["externalReferencesIds"]:
+            self.helper.api.stix_domain_entity.delete(id=external_ref_id)
+        # deleting observable
+        self.helper.api.stix_observable.delete(id=object_result["id"])
+        return len(object_result["indicatorsIds"]), len(
+            object_result["externalReferencesIds"]
         )
-        # Set and store published time to file. If file exists, get published time from file --> Avoid create new report
-        if os.path.isfile(published_time):
-            self.helper.log_info("Getting published time from file")
-            read = open("published_time.txt", "r")
-            published = read.read()
+
+    def _shared_values(self, feed, values):
+        """values still listed by another feed, which must not be deleted"""
+        shared = set()
+        for other in self.feeds:
+            if other is feed or other.observable_type != feed.observable_type:
+                continue
+            listed = other.index.get_many(feed.encode(value) for value in values)
+            shared.update(value for value in values if feed.encode(value) in listed)
+        return shared
+
+    def _delete_chunks(self, feed, summary):
+        """chunks of the values to delete, the replaced blocks deleted first"""
+        self.helper.log_info("Deleting {} old entities".format(len(feed.being_deleted)))
+        if len(feed.replaced_blocks) > 0:
+            with self.metrics.timer("delete", {"feed": feed.name}):
+                self._delete_blocks(feed, summary)
+        for i in range(0, len(feed.being_deleted), self.checkpoint_size):
+            yield feed.being_deleted[i : i + self.checkpoint_size]
+
+    def _delete_entities(self, feed, values, summary, executor):
+        """deleting the entities of a chunk of values no longer listed"""
+        with self.metrics.timer("delete", {"feed": feed.name}):
+            shared = self._shared_values(feed, values)
+            summary["shared"] += len(shared)
+            being_deleted = [value for value in values if value not in shared]
+            block_ids = {indicator_id for _, _, indicator_id in feed.replaced_blocks}
+            # ids recorded in the index are deleted without looking them up
+            indexed = feed.index.get_many(feed.encode(value) for value in being_deleted)
+            resolved = {}
+            unindexed = []
+            in_blocks = 0
+            for value in being_deleted:
+                record = indexed.get(feed.encode(value))
+                if record is not None and block_ids.intersection(
+                    record["indicatorsIds"]
+                ):
+                    # the block indicator is deleted with its block
+                    if record["id"] is None:
+                        in_blocks += 1
+                    else:
+                        resolved[value] = dict(
+                            record,
+                            indicatorsIds=[
+                                indicator_id
+                                for indicator_id in record["indicatorsIds"]
+                                if indicator_id not in block_ids
+                            ],
+                        )
+                elif record is not None and record["id"] is not None:
+                    resolved[value] = record
+                else:
+                    unindexed.append(value)
+            summary["indexed"] += len(resolved)
+            summary["looked_up"] += len(unindexed)
+            resolved.update(self._resolve_observables(unindexed))
+            summary["missing"] += len(being_deleted) - len(resolved) - in_blocks
+            futures = {
+                executor.submit(self._delete_observable, value, object_result): value
+                for value, object_result in resolved.items()
+            }
+            for future in as_completed(futures):
+                try:
+                    indicators, external_references = future.result()
+                except Exception as e:
+                    summary["failed"] += 1
+                    self.helper.log_error(
+                        "Cannot delete {}: {}".format(futures[future], str(e))
+                    )
+                    continue
+                summary["observables"] += 1
+                summary["indicators"] += indicators
+                summary["external_references"] += external_references
+
+    def _log_deletions(self, feed, summary):
+        if summary["shared"] > 0:
+            self.helper.log_info(
+                "{} IOCs are still listed by other feeds, kept them".format(
+                    summary["shared"]
+                )
+            )
+        for key in ("observables", "indicators", "external_references", "failed"):
+            self.metrics.inc(
+                "deleted_total", {"feed": feed.name, "kind": key}, summary[key]
+            )
+        self.helper.log_info(
+            "{indexed} entities found in the index, {looked_up} looked up. Deleted "
+            "{observables} observables, {indicators} indicators and "
+            "{external_references} external references, {missing} not found, "
+            "{failed} failed.".format(**summary)
+        )
+
+    def _delete_blocks(self, feed, summary):
+        """deleting the indicators of the blocks replaced by smaller ones"""
+        for first, last, indicator_id in feed.replaced_blocks:
+            try:
+                self.helper.api.stix_domain_entity.delete(id=indicator_id)
+            except Exception as e:
+                summary["failed"] += 1
+                self.helper.log_error(
+                    "Cannot delete block {}: {}".format(
+                        feed.block_name(first, last), str(e)
+                    )
+                )
+                continue
+            summary["indicators"] += 1
+        feed.index.remove_blocks(feed.replaced_blocks)
+
+    def _add_tag(self, entity_id, tag):
+        """adding a tag once, skipping entities already tagged by this connector"""
+        key = "tagged:" + entity_id + ":" + tag["id"]
+        if self.cache.get(key) is None:
+            with self.metrics.timer("tagging"):
+                self.helper.api.stix_entity.add_tag(id=entity_id, tag_id=tag["id"])
+            self.cache.set(key, True)
+
+    def _get_published_report(self, feed):
+        # the published time is kept in the index --> Avoid create new report
+        published = feed.index.get_meta("published")
+        if published is not None:
+            self.helper.log_info("Getting published time from index")
         else:
             self.helper.log_info("Setting new time")
             published = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-            write = open("published_time.txt", "w")
-            write.write(published)
+            feed.index.set_meta("published", published)
         return published
 
-    def check_diff(self, newfile, oldfile):
-        # should use try except
-        try:
-            old_iplist = open(oldfile, "r")
-        except:
-            old_iplist = []
-        new_iplist = open(newfile, "r")
-        parsed_old_list = []
-        parsed_new_list = []
-        for ip in old_iplist:
-            ip = ip.strip("\n")
-            parsed_old_list.append(ip)
-        for ip in new_iplist:
-            ip = ip.strip("\n")
-            parsed_new_list.append(ip)
-        self.being_added = [ip for ip in parsed_new_list if ip not in parsed_old_list]
-        self.being_deleted = [ip for ip in parsed_old_list if ip not in parsed_new_list]
+    def _legacy_snapshot(self, feed):
+        """the snapshot file of the last import of previous versions, or None"""
+        if feed.name == "talosip":
+            # blacklist downloaded by previous versions is the last imported one
+            legacy_black_list_file = (
+                os.path.dirname(os.path.abspath(__file__)) + "/ip_blacklist.txt"
+            )
+            if os.path.isfile(legacy_black_list_file):
+                return legacy_black_list_file
+        if os.path.isfile(feed.snapshot_path):
+            return feed.snapshot_path
+        return None
+
+    def _migrate_files(self, feed):
+        """moving the snapshot and published time files into the index"""
+        legacy_snapshot = self._legacy_snapshot(feed)
+        if legacy_snapshot is not None and legacy_snapshot != feed.snapshot_path:
+            os.replace(legacy_snapshot, feed.snapshot_path)
+        if os.path.isfile(feed.snapshot_path):
+            if len(feed.index) == 0:
+                self.helper.log_info(
+                    "Importing {} into the index".format(feed.snapshot_path)
+                )
+                feed.index.touch(
+                    feed.types["set"].from_file(feed.snapshot_path).values,
+                    int(time.time()),
+                )
+            os.remove(feed.snapshot_path)
+        if os.path.isfile(feed.published_path):
+            if feed.index.get_meta("published") is None:
+                with open(feed.published_path, "r") as read:
+                    feed.index.set_meta("published", read.read().strip())
+            os.remove(feed.published_path)
+
+    def check_diff(self, feed, new_set, old_set):
+        result = diff(new_set, old_set)
+        # values are decoded chunk by chunk as they are imported
+        feed.being_added = PackedValues(result.added, result.decode)
+        feed.being_deleted = PackedValues(result.deleted, result.decode)
+        for status, count in (
+            ("added", len(feed.being_added)),
+            ("deleted", len(feed.being_deleted)),
+            ("unchanged", result.unchanged),
+            ("malformed", result.malformed),
+        ):
+            self.metrics.inc(
+                "values_total", {"feed": feed.name, "status": status}, count
+            )
+        if result.malformed > 0:
+            self.helper.log_info(
+                "{} malformed lines ignored (e.g. {}).".format(
+                    result.malformed, ", ".join(result.malformed_samples)
+                )
+            )
         self.helper.log_info(
-            "{}/{} IOCs that are new will be added.".format(
-                len(self.being_added), len(parsed_new_list)
+            "{}/{} IOCs that are new will be added, {} unchanged.".format(
+                len(feed.being_added), result.total, result.unchanged
             )
         )
         self.helper.log_info(
             "{} IOCs that are no longer in the list can be deleted.".format(
-                len(self.being_deleted)
+                len(feed.being_deleted)
             )
         )
+        return result
 
-    def get_interval(self):
-        return int(self.talosip_interval) * 60 * 60 * 24
+    def _feed_content(self, feed):
+        """fields written to the entities of every value of a feed"""
+        content = {
+            "description": "from " + feed.name,
+            "marking": feed.marking["id"],
+            "tags": sorted(tag["id"] for tag in feed.tag_entities),
+        }
+        feed.content_fingerprint = content_fingerprint(content)
+        return content
 
-    def _create_observable(self, ip):
-        # creating observable
-        created_observable = self.helper.api.stix_observable.create(
-            type="IPv4-Addr",
-            observable_value=ip,
-            createdByRef=self.entity_identity["id"],
-            description="from talosip",
-            markingDefinitions=self.tlp_white_marking_definition["id"],
-            createIndicator=False,
-            update=self.update_existing_data,
+    def _entity_updates(self, feed, record, previous, content):
+        """(method, arguments) of the calls bringing the entities of a value
+        from previous to content"""
+        updates = []
+        entity_ids = [record["id"]] + record["indicatorsIds"]
+        if previous.get("description") != content["description"]:
+            updates.append(
+                (
+                    "stix_observable.update_field",
+                    {
+                        "id": record["id"],
+                        "key": "description",
+                        "value": content["description"],
+                    },
+                )
+            )
+            updates.extend(
+                (
+                    "stix_domain_entity.update_field",
+                    {
+                        "id": indicator_id,
+                        "key": "description",
+                        "value": content["description"],
+                    },
+                )
+                for indicator_id in record["indicatorsIds"]
+            )
+        if previous.get("marking") != content["marking"]:
+            for entity_id in entity_ids:
+                # the previous marking is removed first, it is replaced
+                if previous.get("marking") is not None:
+                    updates.append(
+                        (
+                            "stix_entity.remove_marking_definition",
+                            {
+                                "id": entity_id,
+                                "marking_definition_id": previous["marking"],
+                            },
+                        )
+                    )
+                updates.append(
+                    (
+                        "stix_entity.add_marking_definition",
+                        {"id": entity_id, "marking_definition_id": content["marking"]},
+                    )
+                )
+        for tag_id in previous.get("tags", ()):
+            if tag_id in content["tags"]:
+                continue
+            updates.extend(
+                ("stix_entity.remove_tag", {"id": entity_id, "tag_id": tag_id})
+                for entity_id in entity_ids
+            )
+        for tag in feed.tag_entities:
+            if tag["id"] in previous.get("tags", ()):
+                continue
+            updates.extend(
+                ("stix_entity.add_tag", {"id": entity_id, "tag_id": tag["id"]})
+                for entity_id in entity_ids
+                if self.cache.get("tagged:" + entity_id + ":" + tag["id"]) is None
+            )
+        return updates
+
+    def _remove_relation(self, entity_id, field, to_id):
+        """deleting the relations of an entity to to_id, listed under field"""
+        result = self.helper.api.query(ENTITY_RELATIONS_QUERY, {"id": entity_id})
+        entity = (result.get("data") or {}).get("stixEntity")
+        if entity is None:
+            return
+        for edge in entity[field]["edges"]:
+            if edge["node"]["id"] == to_id:
+                self.helper.api.query(
+                    RELATION_DELETE_MUTATION,
+                    {"id": entity_id, "relationId": edge["relation"]["id"]},
+                )
+
+    def _update_entity(self, method, arguments):
+        # pycti 3.x has no helper removing a marking or a tag
+        if method == "stix_entity.remove_marking_definition":
+            self._remove_relation(
+                arguments["id"],
+                "markingDefinitions",
+                arguments["marking_definition_id"],
+            )
+            return
+        if method == "stix_entity.remove_tag":
+            self._remove_relation(arguments["id"], "tags", arguments["tag_id"])
+            self.cache.delete("tagged:" + arguments["id"] + ":" + arguments["tag_id"])
+            return
+        entity, name = method.split(".")
+        getattr(getattr(self.helper.api, entity), name)(**arguments)
+        if method == "stix_entity.add_tag":
+            self.cache.set(
+                "tagged:" + arguments["id"] + ":" + arguments["tag_id"], True
+            )
+
+    def _stale_entities(self, feed, content):
+        """streaming the values imported with another content and the calls
+        updating their entities, chunk by chunk"""
+        contents = {}
+        after = None
+        while True:
+            chunk = feed.index.stale(feed.content_fingerprint, after)
+            if len(chunk) == 0:
+                return
+            updates = []
+            for value, record, previous in chunk:
+                if previous not in contents:
+                    stored = feed.index.get_meta("content:" + previous)
+                    # fields of an unknown content are all written again
+                    contents[previous] = json.loads(stored) if stored else {}
+                updates.extend(
+                    self._entity_updates(feed, record, contents[previous], content)
+                )
+            yield [value for value, _, _ in chunk], updates
+            after = chunk[-1][0]
+
+    def _refresh_entities(self, feed):
+        """updating the changed fields of entities imported with another content"""
+        content = self._feed_content(feed)
+        feed.index.set_meta("content:" + feed.content_fingerprint, json.dumps(content))
+        # entities indexed before fingerprints were recorded are assumed current
+        feed.index.fill_fingerprint(feed.content_fingerprint)
+        updated = 0
+        if self.update_existing_data:
+            for values, updates in self._stale_entities(feed, content):
+                for method, arguments in updates:
+                    self._update_entity(method, arguments)
+                feed.index.set_fingerprint(values, feed.content_fingerprint)
+                updated += len(values)
+        skipped = feed.index.count_fingerprint(feed.content_fingerprint) - updated
+        self.metrics.inc(
+            "entities_total", {"feed": feed.name, "status": "updated"}, updated
         )
-        # adding tag to created observable
-        self.helper.api.stix_entity.add_tag(
-            id=created_observable["id"], tag_id=self.talos_tag["id"]
+        self.metrics.inc(
+            "entities_total", {"feed": feed.name, "status": "skipped"}, skipped
         )
-        self.helper.api.stix_entity.add_tag(
-            id=created_observable["id"], tag_id=self.ipv4_tag["id"]
+        self.helper.log_info(
+            "{} indexed IOCs updated, {} unchanged skipped.".format(updated, skipped)
         )
-        # create external references
-        # adding external references
+
+    def _create_observable(self, feed, value):
+        # creating observable
+        with self.metrics.timer("observable_create", {"feed": feed.name}):
+            created_observable = self.helper.api.stix_observable.create(
+                type=feed.types["observable_type"],
+                observable_value=value,
+                createdByRef=feed.identity["id"],
+                description="from " + feed.name,
+                markingDefinitions=feed.marking["id"],
+                createIndicator=False,
+                update=self.update_existing_data,
+            )
+        # adding tag to created observable
+        for tag in feed.tag_entities:
+            self._add_tag(created_observable["id"], tag)
         return created_observable
 
-    def _create_indicator(self, ip, observable_id):
+    def _create_indicator(self, feed, value, observable_id):
         # create indicator
-        created_indicator = self.helper.api.indicator.create(
-            name=ip,
-            indicator_pattern="[ipv4-addr:value = '" + ip + "']",
-            markingDefinitions=self.tlp_white_marking_definition["id"],
-            update=self.update_existing_data,
-            main_observable_type="ipv4-addr",
-            description="from talosip",
-        )
+        with self.metrics.timer("indicator_create", {"feed": feed.name}):
+            created_indicator = self.helper.api.indicator.create(
+                name=value,
+                indicator_pattern=feed.pattern(value),
+                markingDefinitions=feed.marking["id"],
+                update=self.update_existing_data,
+                main_observable_type=feed.types["main_observable_type"],
+                description="from " + feed.name,
+            )
         # add tags
-        self.helper.api.stix_entity.add_tag(
-            id=created_indicator["id"], tag_id=self.ipv4_tag["id"]
-        )
-        self.helper.api.stix_entity.add_tag(
-            id=created_indicator["id"], tag_id=self.talos_tag["id"]
-        )
+        for tag in feed.tag_entities:
+            self._add_tag(created_indicator["id"], tag)
         # link to observable
         self.helper.log_info("Adding observable...")
-        self.helper.api.indicator.add_stix_observable(
-            id=created_indicator["id"], stix_observable_id=observable_id
-        )
+        with self.metrics.timer("indicator_link", {"feed": feed.name}):
+            self.helper.api.indicator.add_stix_observable(
+                id=created_indicator["id"], stix_observable_id=observable_id
+            )
 
         return created_indicator
 
-    def _process_file(self):
-        created_observable_id = []
-        created_indicator_id = []
-        new_black_list_file = (
-            os.path.dirname(os.path.abspath(__file__)) + "/ip_blacklist.txt"
-        )
-        old_black_list_file = (
-            os.path.dirname(os.path.abspath(__file__)) + "/old_ip_blacklist.txt"
-        )
-
-        # always fetch new file
-        if os.path.isfile(new_black_list_file):
-            self.helper.log_info(
-                "[196] File IP blacklist existing, changing name to old file"
-            )
-            # deleting file....
-            shutil.move(new_black_list_file, old_black_list_file)
-            self.helper.log_info("[200] File name changed.")
-
-        self.helper.log_info("Downloading file from {}".format(self.talosip_url))
-        wget.download(self.talosip_url, out="ip_blacklist.txt")
-        # processing message...
-        self.helper.log_info("[205] File downloaded. Processing data...")
-        self.check_diff(new_black_list_file, old_black_list_file)
-        for ip in self.being_added:
-            created_observable = self._create_observable(ip)
-            created_indicator = self._create_indicator(ip, created_observable["id"])
-            created_observable_id.append(created_observable["id"])
-            created_indicator_id.append(created_indicator["id"])
-            # create a report
-            # create external reference
+    def _create_report(self, feed):
         self.helper.log_info("Creating external reference...")
         _report_external_reference = self.helper.api.external_reference.create(
-            source_name="Talos Intelligence", url="https://talosintelligence.com/",
+            source_name=feed.report_source, url=feed.report_url
         )
         self.helper.log_info("Creating report...")
+        published = self._get_published_report(feed)
+        report_fingerprint = content_fingerprint(
+            [
+                feed.report_name,
+                published,
+                feed.marking["id"],
+                feed.report_description,
+                feed.identity["id"],
+                _report_external_reference["id"],
+            ]
+        )
+        # an unchanged report is only looked up, not rewritten
+        update = (
+            self.update_existing_data
+            and feed.index.get_meta("report_fingerprint") != report_fingerprint
+        )
         # create report
         created_report = self.helper.api.report.create(
-            name="Talos Intelligence IP Blacklist",
-            published=self._get_published_report(),
-            markingDefinitions=self.tlp_white_marking_definition["id"],
-            description="This report represents the blacklist provided by Cisco Talos",
+            name=feed.report_name,
+            published=published,
+            markingDefinitions=feed.marking["id"],
+            description=feed.report_description,
             report_class="Threat Report",
-            createdByRef=self.entity_identity["id"],
+            createdByRef=feed.identity["id"],
             external_reference_id=_report_external_reference["id"],
-            update=self.update_existing_data,
+            update=update,
             modified=datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
         )
+        feed.index.set_meta("report_fingerprint", report_fingerprint)
         # add tag to report
-        self.helper.api.stix_entity.add_tag(
-            id=created_report["id"], tag_id=self.talos_tag["id"]
+        if len(feed.tag_entities) > 0:
+            self._add_tag(created_report["id"], feed.tag_entities[0])
+        return created_report
+
+    def _create_bundle(self, feed, values, report):
+        """building one STIX2 bundle holding the indicators of a chunk of values"""
+        identity = Identity(
+            id=feed.identity["stix_id_key"],
+            name=feed.identity["name"],
+            identity_class="organization",
+        )
+        tags = [
+            {
+                "id": tag["id"],
+                "tag_type": tag["tag_type"],
+                "value": tag["value"],
+                "color": tag["color"],
+            }
+            for tag in feed.tag_entities
+        ]
+        indicators = []
+        for value in values:
+            # the observable is created and linked by the worker, it is not
+            # referenced by the report
+            indicators.append(
+                Indicator(
+                    name=value,
+                    description="from " + feed.name,
+                    pattern=feed.pattern(value),
+                    labels=["malicious-activity"],
+                    created_by_ref=identity,
+                    object_marking_refs=[feed.stix_marking],
+                    custom_properties={
+                        CustomProperties.OBSERVABLE_TYPE: feed.types["observable_type"],
+                        CustomProperties.OBSERVABLE_VALUE: value,
+                        CustomProperties.CREATE_OBSERVABLES: True,
+                        CustomProperties.TAG_TYPE: tags,
+                    },
+                )
+            )
+        # re-upserting the report adds the chunk to its object_refs
+        report_object = Report(
+            id=report["stix_id_key"],
+            name=report["name"],
+            description=report["description"],
+            published=report["published"],
+            labels=["threat-report"],
+            created_by_ref=identity,
+            object_marking_refs=[feed.stix_marking],
+            object_refs=indicators,
+            custom_properties={CustomProperties.REPORT_CLASS: "Threat Report"},
+        )
+        return Bundle(
+            objects=[identity, feed.stix_marking] + indicators + [report_object],
+            allow_custom=True,
         )
-        # add observables to report from id list
-        self.helper.log_info("Adding observables to report...")
-        for observable_id in created_observable_id:
-            self.helper.api.report.add_stix_observable(
-                id=created_report["id"], stix_observable_id=observable_id
+
+    def _bundle_chunks(self, feed):
+        self.helper.log_info(
+            "Sending {} IOCs in bundles of {}...".format(
+                len(feed.being_added) - feed.checkpoint.offset, self.bundle_size
+            )
+        )
+        for i in range(feed.checkpoint.offset, len(feed.being_added), self.bundle_size):
+            yield feed.being_added[i : i + self.bundle_size]
+
+    def _send_bundle(self, feed, report, chunk):
+        with self.metrics.timer("bundle_send", {"feed": feed.name}):
+            bundle = self._create_bundle(feed, chunk, report)
+            self.helper.send_stix2_bundle(
+                bundle.serialize(), None, self.update_existing_data, False
+            )
+        feed.checkpoint.commit(feed.checkpoint.offset + len(chunk), [], [])
+
+    def _value_chunks(self, feed):
+        for i in range(
+            feed.checkpoint.offset, len(feed.being_added), self.checkpoint_size
+        ):
+            yield feed.being_added[i : i + self.checkpoint_size]
+
+    def _create_chunk(self, feed, chunk, timestamp):
+        """creating the entities of a chunk, committing it to the journal and
+        returning the created ids"""
+        created_observable_id = []
+        created_indicator_id = []
+        entries = []
+        for value in chunk:
+            created_observable = self._create_observable(feed, value)
+            created_indicator = self._create_indicator(
+                feed, value, created_observable["id"]
+            )
+            created_observable_id.append(created_observable["id"])
+            created_indicator_id.append(created_indicator["id"])
+            entries.append(
+                (
+                    feed.encode(value),
+                    created_observable["id"],
+                    [created_indicator["id"]],
+                    [],
+                )
+            )
+        feed.index.record(entries, timestamp, feed.content_fingerprint)
+        feed.checkpoint.commit(
+            feed.checkpoint.offset + len(chunk),
+            created_observable_id,
+            created_indicator_id,
+        )
+        return created_observable_id, created_indicator_id
+
+    def _attach_refs(self, feed, report_id, refs, observable_ids, indicator_ids):
+        """attaching the ids missing from refs, the ids already on the report"""
+        observable_ids = [value for value in observable_ids if value not in refs]
+        indicator_ids = [value for value in indicator_ids if value not in refs]
+        with self.metrics.timer("report_linking", {"feed": feed.name}):
+            return self.report_linker.attach(
+                report_id,
+                observable_ids,
+                indicator_ids,
+                existing_refs=(),
+                on_attached=refs.update,
+            )
+
+    def _fetch(self, feed, state):
+        """conditional download, validators are stored in the connector state"""
+        self.helper.log_info("Downloading file from {}".format(feed.url))
+        with self.metrics.timer("download", {"feed": feed.name}):
+            fetched = retry(
+                lambda: feed.fetcher.fetch(
+                    state.get("etag"), state.get("last_modified")
+                ),
+                self.rate_limiter.retries,
+                self.rate_limiter.backoff,
+                on_retry=lambda error, attempt, delay: self.helper.log_info(
+                    "Download of {} failed ({}), retry {} in {:.1f}s".format(
+                        feed.name, str(error), attempt, delay
+                    )
+                ),
+            )
+            new_set = None if fetched.not_modified else feed.load_set(fetched.lines())
+        return fetched, new_set
+
+    def _import_diff(self, feed, sha256):
+        """importing feed.being_added and deleting feed.being_deleted
+
+        Chunks of values flow from the diff through the creation and the
+        report linking stages while deletions run alongside, see Pipeline.
+        """
+        if feed.aggregate:
+            self._replace_blocks(feed, sha256)
+        offset = feed.checkpoint.begin(sha256)
+        if offset > 0:
+            self.helper.log_info(
+                "Resuming interrupted import at {}/{}".format(
+                    offset, len(feed.being_added)
+                )
+            )
+        timestamp = int(time.time())
+        pipeline = Pipeline(self.metrics, {"feed": feed.name}, self.pipeline_queue_size)
+        created_report = self._create_report(feed)
+        attached = []
+        if self.bundle_mode:
+            pipeline.chain(
+                "diff",
+                self._bundle_chunks(feed),
+                [
+                    (
+                        "send",
+                        lambda chunk: self._send_bundle(feed, created_report, chunk),
+                    )
+                ],
             )
-            # add indicators to report from id list
-        self.helper.log_info("Adding entity...")
-        for indicator_id in created_indicator_id:
-            self.helper.api.report.add_stix_entity(
-                id=created_report["id"], entity_id=indicator_id
+        else:
+            if feed.aggregate:
+                source = self._block_chunks(feed)
+                create = self._create_block_chunk
+            else:
+                source = self._value_chunks(feed)
+                create = self._create_chunk
+            refs = self.report_linker.get_refs(created_report["id"])
+            # chunks committed before an interruption may not be linked yet
+            attached.append(
+                self._attach_refs(
+                    feed,
+                    created_report["id"],
+                    refs,
+                    feed.checkpoint.observable_ids,
+                    feed.checkpoint.indicator_ids,
+                )
+            )
+            pipeline.chain(
+                "diff",
+                source,
+                [
+                    ("create", lambda chunk: create(feed, chunk, timestamp)),
+                    (
+                        "link",
+                        lambda ids: attached.append(
+                            self._attach_refs(feed, created_report["id"], refs, *ids)
+                        ),
+                    ),
+                ],
             )
         self.helper.log_info(
             "Delete old data is set to {}".format(self.delete_old_data)
         )
-        if self.delete_old_data:
-            self.delete_old_entity()
+        summary = None
+        if self.delete_old_data and len(feed.being_deleted) > 0:
+            summary = dict.fromkeys(
+                (
+                    "observables",
+                    "indicators",
+                    "external_references",
+                    "missing",
+                    "failed",
+                    "shared",
+                    "indexed",
+                    "looked_up",
+                ),
+                0,
+            )
+            executor = ThreadPoolExecutor(max_workers=self.delete_workers)
+            pipeline.chain(
+                "old_values",
+                self._delete_chunks(feed, summary),
+                [
+                    (
+                        "delete",
+                        lambda chunk: self._delete_entities(
+                            feed, chunk, summary, executor
+                        ),
+                    )
+                ],
+            )
+        elif self.delete_old_data:
+            self.helper.log_info("Nothing to delete")
+        try:
+            pipeline.run()
+        finally:
+            if summary is not None:
+                executor.shutdown()
+        if not self.bundle_mode:
+            self.helper.log_info("{} refs attached to report.".format(sum(attached)))
+        if summary is not None:
+            self._log_deletions(feed, summary)
+
+    def _finish_import(self, feed, validators):
+        self._set_feed_state(feed, validators)
+        feed.checkpoint.clear()
+        if feed.aggregate:
+            feed.index.set_meta("replaced_blocks", "{}")
+            feed.replaced_blocks = []
+        feed.being_added = []
+        feed.being_deleted = []
+        self.cache.save()
+        self.helper.log_info(
+            "Lookup cache: {hits} hits, {misses} misses, {size} entries".format(
+                **self.cache.stats()
+            )
+        )
+
+    def _shrunk_blocks(self, feed, deleted):
+        """blocks holding deleted values and the listed values left in them"""
+        deleted = sorted(feed.encode(value) for value in deleted)
+        blocks = feed.index.blocks_of(deleted)
+        deleted = set(deleted)
+        candidates = [
+            value
+            for first, last, _ in blocks
+            for value in range(first, last + 1)
+            if value not in deleted
+        ]
+        return [list(block) for block in blocks], sorted(
+            feed.index.get_many(candidates)
+        )
+
+    def _replace_blocks(self, feed, sha256):
+        """adding the values left in blocks holding deleted values to the
+        values to create, so these blocks are replaced by smaller ones"""
+        feed.replaced_blocks = []
+        if not self.delete_old_data or len(feed.being_deleted) == 0:
+            return
+        stored = json.loads(feed.index.get_meta("replaced_blocks") or "{}")
+        if stored.get("sha256") == sha256:
+            # resumed import, some blocks may already be replaced in the index
+            blocks, survivors = stored["blocks"], stored["survivors"]
         else:
-            pass
+            blocks, survivors = self._shrunk_blocks(feed, feed.being_deleted)
+            feed.index.set_meta(
+                "replaced_blocks",
+                json.dumps(
+                    {"sha256": sha256, "blocks": blocks, "survivors": survivors}
+                ),
+            )
+        feed.replaced_blocks = [tuple(block) for block in blocks]
+        if len(survivors) > 0:
+            self.helper.log_info(
+                "{} blocks hold deleted IPs, {} IPs left in them are aggregated "
+                "again".format(len(blocks), len(survivors))
+            )
+        feed.being_added = PackedValues(
+            array("I", merge_unique(feed.being_added.values, survivors)),
+            int_to_ipv4,
+        )
 
-    def start(self):
-        self.helper.log_info("[256] Fetching Talos IP database...")
-        while True:
-            try:
-                timestamp = int(time.time())
-                current_state = self.helper.get_state()
-                if current_state is not None and "last_run" in current_state:
-                    last_run = current_state["last_run"]
-                    self.helper.log_info(
-                        "[258] Connector last run: "
-                        + datetime.utcfromtimestamp(last_run).strftime(
-                            "%Y-%m-%d %H:%M:%S"
+    def _create_block_indicator(self, feed, first, last):
+        with self.metrics.timer("indicator_create", {"feed": feed.name}):
+            created_indicator = self.helper.api.indicator.create(
+                name=feed.block_name(first, last),
+                indicator_pattern=feed.block_pattern(first, last),
+                markingDefinitions=feed.marking["id"],
+                update=self.update_existing_data,
+                main_observable_type=feed.types["main_observable_type"],
+                description="from " + feed.name,
+            )
+        for tag in feed.tag_entities:
+            self._add_tag(created_indicator["id"], tag)
+        return created_indicator
+
+    def _block_chunks(self, feed):
+        """blocks of the added values, grouped by checkpoint_size values"""
+        # chunks end on blocks, the remaining values collapse into the same blocks
+        values = feed.being_added.values[feed.checkpoint.offset :]
+        blocks = collapse(values)
+        ratio = len(values) / len(blocks) if len(blocks) > 0 else 1.0
+        self.metrics.set("aggregation_ratio", round(ratio, 2), {"feed": feed.name})
+        self.helper.log_info(
+            "{} IPs aggregated into {} blocks ({:.1f}x)".format(
+                len(values), len(blocks), ratio
+            )
+        )
+        return self._group_blocks(blocks)
+
+    def _group_blocks(self, blocks):
+        chunk = []
+        size = 0
+        for first, last in blocks:
+            chunk.append((first, last))
+            size += last - first + 1
+            if size >= self.checkpoint_size:
+                yield chunk
+                chunk = []
+                size = 0
+        if len(chunk) > 0:
+            yield chunk
+
+    def _create_block_chunk(self, feed, blocks, timestamp):
+        """creating one indicator per block, with the observables of its
+        addresses when aggregate_observables is set"""
+        created_blocks = []
+        created_observable_id = []
+        created_indicator_id = []
+        entries = []
+        for first, last in blocks:
+            created_indicator = self._create_block_indicator(feed, first, last)
+            known = {}
+            if feed.aggregate_observables:
+                # addresses left from a replaced block keep their observable
+                known = feed.index.get_many(range(first, last + 1))
+            for value in range(first, last + 1):
+                observable_id = None
+                if feed.aggregate_observables:
+                    record = known.get(value)
+                    if record is not None and record["id"] is not None:
+                        observable_id = record["id"]
+                    else:
+                        created_observable = self._create_observable(
+                            feed, int_to_ipv4(value)
                         )
+                        observable_id = created_observable["id"]
+                        created_observable_id.append(observable_id)
+                    with self.metrics.timer("indicator_link", {"feed": feed.name}):
+                        self.helper.api.indicator.add_stix_observable(
+                            id=created_indicator["id"], stix_observable_id=observable_id
+                        )
+                entries.append((value, observable_id, [created_indicator["id"]], []))
+            created_indicator_id.append(created_indicator["id"])
+            created_blocks.append((first, last, created_indicator["id"]))
+        feed.index.record(entries, timestamp, feed.content_fingerprint)
+        feed.index.record_blocks(created_blocks)
+        feed.checkpoint.commit(
+            feed.checkpoint.offset + len(entries),
+            created_observable_id,
+            created_indicator_id,
+        )
+        return created_observable_id, created_indicator_id
+
+    def _process_file(self, feed):
+        self._migrate_files(feed)
+        with self.metrics.timer("refresh", {"feed": feed.name}):
+            self._refresh_entities(feed)
+        state = self._get_feed_state(feed)
+        fetched, new_set = self._fetch(feed, state)
+        if fetched.not_modified:
+            self.helper.log_info(
+                "[205] Feed {} not modified, nothing to do.".format(feed.name)
+            )
+            return
+        if fetched.sha256 == state.get("sha256"):
+            self.helper.log_info(
+                "[205] Feed {} content unchanged, nothing to do.".format(feed.name)
+            )
+            self._set_feed_state(feed, fetched.validators())
+            return
+        # processing message...
+        self.helper.log_info(
+            "[205] Feed {} downloaded. Processing data...".format(feed.name)
+        )
+        with self.metrics.timer("diff", {"feed": feed.name}):
+            result = self.check_diff(feed, new_set, feed.load_indexed())
+        self._import_diff(feed, fetched.sha256)
+        # the index only moves to the new list once everything is imported
+        feed.index.touch(new_set.values, int(time.time()))
+        feed.index.remove(result.deleted)
+        self._finish_import(feed, fetched.validators())
+
+    def _plan_deletions(self, feed, deleted, calls, block_ids):
+        """counting the deletion calls, returning the values kept for other feeds"""
+        shared = self._shared_values(feed, deleted)
+        being_deleted = [value for value in deleted if value not in shared]
+        indexed = feed.index.get_many(feed.encode(value) for value in being_deleted)
+        unindexed = 0
+        # deleted values are looked up chunk by chunk, like they are deleted
+        for i in range(0, len(deleted), self.checkpoint_size):
+            chunk_unindexed = 0
+            for value in deleted[i : i + self.checkpoint_size]:
+                if value in shared:
+                    continue
+                record = indexed.get(feed.encode(value))
+                in_block = record is not None and block_ids.intersection(
+                    record["indicatorsIds"]
+                )
+                if record is not None and record["id"] is not None:
+                    calls.add(
+                        "stix_domain_entity.delete",
+                        len(set(record["indicatorsIds"]) - block_ids)
+                        + len(record["externalReferencesIds"]),
                     )
-                else:
-                    last_run = None
-                    self.helper.log_info("[265] Connector has never run")
-                if last_run is None or (
-                    (timestamp - last_run)
-                    > ((int(self.talosip_interval)) * 60 * 60 * 24)
-                ):
-                    self.helper.log_info("[270] Connector will run!")
-                    self._process_file()
-                    self.helper.log_info(
-                        "[273] Connector successfully run, storing last_run as "
-                        + str(timestamp)
-                    )
-                    self.helper.set_state({"last_run": timestamp})
-                    self.helper.log_info(
-                        "[278] Last_run stored, next run in: "
-                        + str(round(self.get_interval() / 60 / 60 / 24, 2))
-                        + " days"
+                    calls.add("stix_observable.delete")
+                elif not in_block:
+                    chunk_unindexed += 1
+            calls.add(
+                "stix_observable.list", chunks(chunk_unindexed, self.delete_batch_size)
+            )
+            unindexed += chunk_unindexed
+        # entities of values missing from the index are only known once looked up
+        calls.add("stix_domain_entity.delete", unindexed, estimated=True)
+        calls.add("stix_observable.delete", unindexed, estimated=True)
+        return [value for value in deleted if value in shared], unindexed
+
+    def _plan_refresh(self, feed, calls):
+        """counting the calls updating the entities imported with another
+        content, returning the number of values to update"""
+        content = self._feed_content(feed)
+        updated = 0
+        if self.update_existing_data:
+            for values, updates in self._stale_entities(feed, content):
+                for method, _ in updates:
+                    calls.add(method)
+                updated += len(values)
+        return updated
+
+    def _planned_indexed(self, feed):
+        """the values of the last import, read from the snapshot of previous
+        versions while it is not migrated into the index"""
+        legacy_snapshot = self._legacy_snapshot(feed)
+        if legacy_snapshot is not None and len(feed.index) == 0:
+            return feed.types["set"].from_file(legacy_snapshot)
+        return feed.load_indexed()
+
+    def _plan_feed(self, feed):
+        """diffing a feed against its index without importing anything or
+        writing to the index, the state or the journals"""
+        calls = CallPlan()
+        updated = self._plan_refresh(feed, calls)
+        state = self._get_feed_state(feed)
+        fetched, new_set = self._fetch(feed, state)
+        item = {"feed": feed.name, "base_sha256": state.get("sha256")}
+        if fetched.not_modified or fetched.sha256 == state.get("sha256"):
+            item.update(
+                {
+                    "status": "unchanged",
+                    "counts": {"updated": updated},
+                    "calls": calls.to_dict(),
+                }
+            )
+            return item, calls
+        result = diff(new_set, self._planned_indexed(feed))
+        added = list(result.added_values())
+        deleted = list(result.deleted_values())
+        tags = len(feed.tag_entities)
+        calls.add("external_reference.create")
+        calls.add("report.create")
+        # the report keeps its id across runs and is tagged once
+        calls.add("stix_entity.add_tag", min(tags, 1), estimated=True)
+        observables = indicators = links = len(added)
+        # refs attached to the report per created chunk
+        refs = [
+            2 * len(added[i : i + self.checkpoint_size])
+            for i in range(0, len(added), self.checkpoint_size)
+        ]
+        aggregation = {}
+        block_ids = set()
+        if self.bundle_mode:
+            calls.add("send_stix2_bundle", chunks(len(added), self.bundle_size))
+        else:
+            if feed.aggregate:
+                replaced, survivors = [], []
+                if self.delete_old_data and len(deleted) > 0:
+                    replaced, survivors = self._shrunk_blocks(feed, deleted)
+                values = {feed.encode(value) for value in added}
+                values.update(survivors)
+                blocks = collapse(sorted(values))
+                indicators = len(blocks)
+                observables = links = 0
+                reused = set()
+                if feed.aggregate_observables:
+                    reused = {
+                        value
+                        for value, record in feed.index.get_many(survivors).items()
+                        if record["id"] is not None
+                    }
+                    observables, links = len(values) - len(reused), len(values)
+                refs = [
+                    len(group)
+                    + (
+                        sum(
+                            1
+                            for first, last in group
+                            for value in range(first, last + 1)
+                            if value not in reused
+                        )
+                        if feed.aggregate_observables
+                        else 0
                     )
-                    time.sleep(60)
-                else:
-                    new_interval = self.get_interval() - (timestamp - last_run)
-                    self.helper.log_info(
-                        "[286] Connector will not run, next run in: "
-                        + str(round(new_interval / 60 / 60 / 24, 2))
-                        + " days"
+                    for group in self._group_blocks(blocks)
+                ]
+                block_ids = {indicator_id for _, _, indicator_id in replaced}
+                calls.add("stix_domain_entity.delete", len(replaced))
+                aggregation = {
+                    "blocks": indicators,
+                    "replaced_blocks": len(replaced),
+                    "compression": (
+                        round(len(values) / indicators, 2) if indicators > 0 else 1.0
+                    ),
+                }
+            calls.add("stix_observable.create", observables)
+            calls.add("indicator.create", indicators)
+            calls.add("indicator.add_stix_observable", links)
+            calls.add("stix_entity.add_tag", tags * (observables + indicators))
+            calls.add("report.read")
+            calls.add(
+                "query",
+                sum(chunks(count, self.report_linker.chunk_size) for count in refs),
+            )
+        kept, unindexed = [], 0
+        if self.delete_old_data and len(deleted) > 0:
+            kept, unindexed = self._plan_deletions(feed, deleted, calls, block_ids)
+        item.update(
+            {
+                "status": "changed",
+                "sha256": fetched.sha256,
+                "validators": fetched.validators(),
+                "counts": {
+                    "observables": observables,
+                    "indicators": indicators,
+                    "tags": tags * (observables + indicators),
+                    "links": observables + indicators,
+                    "deletions": (
+                        len(deleted) - len(kept) if self.delete_old_data else 0
+                    ),
+                    "unindexed_deletions": unindexed,
+                    "kept": len(kept),
+                    "updated": updated,
+                    "unchanged": result.unchanged,
+                    "malformed": result.malformed,
+                    **aggregation,
+                },
+                "calls": calls.to_dict(),
+                "added": added,
+                "deleted": deleted,
+                "kept": kept,
+            }
+        )
+        return item, calls
+
+    def plan(self, call_seconds):
+        """computing the calls the next run of every feed would issue"""
+        items = []
+        calls = CallPlan()
+        for feed in self.feeds:
+            item, feed_calls = self._plan_feed(feed)
+            self.helper.log_info(
+                "Feed {} planned: {} calls".format(feed.name, feed_calls.total())
+            )
+            items.append(item)
+            calls.update(feed_calls)
+        # values of a feed are created one at a time, feeds run concurrently
+        changed = sum(1 for item in items if item["status"] == "changed")
+        # the feed entities missing from OpenCTI are created at startup
+        for key in self.static.creations:
+            self.helper.log_info("{} planned for creation".format(key))
+        calls.update(self.static.calls)
+        return build_plan(
+            "talosip",
+            items,
+            calls,
+            self.rate_limiter,
+            max(1, min(self.feed_workers, changed)),
+            call_seconds,
+            self.static.creations,
+        )
+
+    def apply_plan(self, plan):
+        """importing the diffs of a plan, skipping feeds imported since"""
+        feeds = {feed.name: feed for feed in self.feeds}
+        for item in plan["items"]:
+            feed = feeds.get(item["feed"])
+            if feed is None:
+                self.helper.log_error("Unknown feed {}".format(item["feed"]))
+                continue
+            # the plan diffed against the snapshot of previous versions
+            self._migrate_files(feed)
+            self._refresh_entities(feed)
+            if item["status"] != "changed":
+                continue
+            if self._get_feed_state(feed).get("sha256") != item["base_sha256"]:
+                self.helper.log_error(
+                    "Feed {} was imported since the plan was made, skipping".format(
+                        feed.name
                     )
-                    time.sleep(3600)
+                )
+                continue
+            self.helper.log_info("[270] Applying the plan of feed {}".format(feed.name))
+            feed.being_added = feed.pack(item["added"])
+            feed.being_deleted = feed.pack(item["deleted"])
+            self._import_diff(feed, item["sha256"])
+            timestamp = int(time.time())
+            feed.index.touch((feed.encode(value) for value in item["added"]), timestamp)
+            feed.index.remove(feed.encode(value) for value in item["deleted"])
+            self._finish_import(feed, item["validators"])
+            self._set_feed_state(feed, {"last_run": timestamp})
+
+    def _run_feed(self, feed):
+        timestamp = int(time.time())
+        self.helper.log_info("[270] Feed {} will run!".format(feed.name))
+        try:
+            with self.metrics.timer("run", {"feed": feed.name}):
+                self._process_file(feed)
+        except Exception:
+            self.metrics.inc("runs_total", {"feed": feed.name, "status": "failed"})
+            raise
+        self.metrics.inc("runs_total", {"feed": feed.name, "status": "succeeded"})
+        self.helper.log_info(
+            "[273] Feed {} successfully run, storing last_run as {}".format(
+                feed.name, timestamp
+            )
+        )
+        self._set_feed_state(feed, {"last_run": timestamp})
+        self.helper.log_info(
+            "[278] Last_run stored, next run of {} in: {} days".format(
+                feed.name, round(feed.get_interval() / 60 / 60 / 24, 2)
+            )
+        )
+
+    def _due_feeds(self, running):
+        timestamp = int(time.time())
+        due = []
+        for feed in self.feeds:
+            if feed in running:
+                continue
+            last_run = self._get_feed_state(feed).get("last_run")
+            if last_run is None or (timestamp - last_run) > feed.get_interval():
+                due.append(feed)
+        return due
+
+    def start(self):
+        self.helper.log_info(
+            "[256] Fetching {} feeds: {}".format(
+                len(self.feeds), ", ".join(feed.name for feed in self.feeds)
+            )
+        )
+        # each feed runs on its own schedule, due feeds are fetched concurrently
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=self.feed_workers)
+        while True:
+            try:
+                for feed, future in list(running.items()):
+                    if not future.done():
+                        continue
+                    del running[feed]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.helper.log_error(
+                            "Feed {} failed: {}".format(feed.name, str(e))
+                        )
+                for feed in self._due_feeds(running):
+                    running[feed] = executor.submit(self._run_feed, feed)
+                time.sleep(60)
             except (KeyboardInterrupt, SystemExit):
                 self.helper.log_info("[292] Connector stop")
                 exit(0)
@@ -292,8 +1485,32 @@ class Talosip:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Talos Intelligence connector")
+    parser.add_argument(
+        "--plan",
+        metavar="FILE",
+        help="write the calls the next run would issue to FILE (- for stdout) and exit",
+    )
+    parser.add_argument(
+        "--apply", metavar="FILE", help="import the plan written to FILE and exit"
+    )
+    parser.add_argument(
+        "--call-seconds",
+        type=float,
+        default=0.05,
+        help="assumed duration of an API call for the plan estimate",
+    )
+    args = parser.parse_args()
     try:
-        talosipInstance = Talosip()
+        talosipInstance = Talosip(
+            "plan" if args.plan else "apply" if args.apply else None
+        )
+        if args.plan:
+            write_plan(args.plan, talosipInstance.plan(args.call_seconds))
+            exit(0)
+        if args.apply:
+            talosipInstance.apply_plan(read_plan(args.apply, "talosip"))
+            exit(0)
         talosipInstance.start()
     except Exception as e:
         print(e)
@@ -0,0 +1,103 @@
+import json
+import logging
+import threading
+import time
+
+import pika
+
+
+class BatchListenQueue(threading.Thread):
+    """consuming the connector queue in batches
+
+    Like the ListenQueue of pycti, but the broker delivers up to batch_size
+    messages at once (basic_qos prefetch) and they are handed over together
+    once batch_size of them arrived or window seconds after the first one.
+
+    callback(messages) returns one result per message, its job messages or
+    the Exception it failed with. Every message is acknowledged once the
+    batch holding it has been processed, so unprocessed messages are
+    delivered again after a reconnection.
+    """
+
+    def __init__(self, helper, config, callback, batch_size=100, window=1.0):
+        threading.Thread.__init__(self)
+        self.pika_connection = None
+        self.channel = None
+        self.helper = helper
+        self.callback = callback
+        self.uri = config["uri"]
+        self.queue_name = config["listen"]
+        self.batch_size = batch_size
+        self.window = window
+        # (delivery tag, message) delivered and not processed yet
+        self._pending = []
+        self._timer = None
+
+    # noinspection PyUnusedLocal
+    def _process_message(self, channel, method, properties, body):
+        self._pending.append((method.delivery_tag, json.loads(body)))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self.pika_connection.call_later(self.window, self._on_window)
+
+    def _on_window(self):
+        self._timer = None
+        self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self.pika_connection.remove_timeout(self._timer)
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if len(batch) == 0:
+            return
+        thread = threading.Thread(
+            target=self._data_handler, args=[[message for _, message in batch]]
+        )
+        thread.start()
+        # heartbeats are answered meanwhile, deliveries wait for the callback
+        while thread.is_alive():
+            self.pika_connection.sleep(0.1)
+        for delivery_tag, _ in batch:
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+        logging.info("Batch of {} messages processed".format(len(batch)))
+
+    def _data_handler(self, messages):
+        try:
+            results = self.callback(messages)
+        except Exception as e:
+            logging.exception("Error in batch processing, reporting error to API")
+            results = [e] * len(messages)
+        for json_data, result in zip(messages, results):
+            job_id = json_data["job_id"] if "job_id" in json_data else None
+            try:
+                if isinstance(result, Exception):
+                    self.helper.api.job.update_job(job_id, "error", [str(result)])
+                else:
+                    self.helper.api.job.update_job(job_id, "complete", result)
+            except Exception:
+                logging.error("Failing reporting the processing")
+
+    def run(self):
+        while True:
+            try:
+                # Connect the broker
+                self.pika_connection = pika.BlockingConnection(
+                    pika.URLParameters(self.uri)
+                )
+                self.channel = self.pika_connection.channel()
+                # unacknowledged messages come back on a new connection
+                self._pending = []
+                self._timer = None
+                self.channel.basic_qos(prefetch_count=self.batch_size)
+                self.channel.basic_consume(
+                    queue=self.queue_name, on_message_callback=self._process_message
+                )
+                self.channel.start_consuming()
+            except (KeyboardInterrupt, SystemExit):
+                self.helper.log_info("Connector stop")
+                exit(0)
+            except Exception as e:
+                self.helper.log_error(str(e))
+                time.sleep(10)
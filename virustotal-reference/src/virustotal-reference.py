@@ -1,9 +1,21 @@
 import yaml
 import json
 import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from pycti import OpenCTIConnectorHelper, get_config_variable
 
+from batcher import BatchListenQueue
+from cache import LookupCache
+from metrics import Metrics
+from ratelimit import RateLimiter
+
+VIRUSTOTAL_URL = "https://www.virustotal.com/gui/search/"
+# seconds between two saves of the lookup cache, batches are often small
+CACHE_SAVE_INTERVAL = 30
+
 
 class VirustotalReference:
     def __init__(self):
@@ -14,28 +26,207 @@ class VirustotalReference:
             else {}
         )
         self.helper = OpenCTIConnectorHelper(config)
+        self.metrics = Metrics("virustotal_reference")
+        self.rate_limiter = RateLimiter.from_config(
+            config, self.metrics, self.helper.log_info
+        )
+        # client methods are counted by the metrics, the GraphQL requests
+        # they send are throttled and retried by the limiter
+        self.helper.api = self.metrics.instrument(
+            self.rate_limiter.install(self.helper.api)
+        )
+        metrics_port = get_config_variable(
+            "METRICS_PORT", ["connector", "metrics_port"], config, True
+        )
+        if metrics_port:
+            self.metrics.serve(metrics_port)
+        self.cache = LookupCache(
+            path=os.path.dirname(os.path.abspath(__file__)) + "/cache.json",
+            max_size=get_config_variable(
+                "CACHE_SIZE", ["connector", "cache_size"], config, True
+            )
+            or 100000,
+            ttl=get_config_variable(
+                "CACHE_TTL", ["connector", "cache_ttl"], config, True
+            )
+            or 86400,
+        )
+        self.cache_saved_at = time.time()
+        self.workers = (
+            get_config_variable(
+                "VIRUSTOTAL_WORKERS", ["virustotal-reference", "workers"], config, True
+            )
+            or 4
+        )
+        self.batch_window = float(
+            get_config_variable(
+                "VIRUSTOTAL_BATCH_WINDOW",
+                ["virustotal-reference", "batch_window"],
+                config,
+            )
+            or 1
+        )
+        self.batch_size = (
+            get_config_variable(
+                "VIRUSTOTAL_BATCH_SIZE",
+                ["virustotal-reference", "batch_size"],
+                config,
+                True,
+            )
+            or 100
+        )
 
     def create_reference(self, data):
-        virus_ref = self.helper.api.external_reference.create(
-            source_name="Virustotal " + data,
-            url="https://www.virustotal.com/gui/search/" + data,
-        )
+        with self.metrics.timer("reference_create"):
+            virus_ref = self.helper.api.external_reference.create(
+                source_name="Virustotal " + data, url=VIRUSTOTAL_URL + data
+            )
         return virus_ref
 
-    def _process_message(self, data):
-        entity_id = data["entity_id"]
-        observable = self.helper.api.stix_observable.read(id=entity_id)
-        observable_value = observable["observable_value"]
-        # self.helper.log_info("Creating virustotal reference for {}".format(observable_value))
-        created_reference = self.create_reference(observable_value)
-        # self.helper.log_info("External reference created with id {}".format(created_reference["id"]))
-        # self.helper.log_info("Attaching the reference to {}".format(entity_id))
-        self.helper.api.stix_entity.add_external_reference(
-            id=entity_id, external_reference_id=created_reference["id"]
+    def _attach_reference(self, entity_id, reference_id):
+        with self.metrics.timer("reference_attach"):
+            self.helper.api.stix_entity.add_external_reference(
+                id=entity_id, external_reference_id=reference_id
+            )
+        self.cache.set("referenced:" + entity_id, True)
+
+    def _get_reference_id(self, value):
+        # the same value always maps to the same reference
+        return self.cache.get_or_create(
+            "reference:" + value, lambda: self.create_reference(value)["id"]
+        )
+
+    def _read_observables(self, entity_ids):
+        """resolving the values of many observables in a single query
+
+        returns the values and the ids of the observables already holding
+        their VirusTotal reference
+        """
+        values = {}
+        referenced = set()
+        unresolved = []
+        for entity_id in entity_ids:
+            value = self.cache.get("observable_value:" + entity_id)
+            if value is None:
+                unresolved.append(entity_id)
+                continue
+            values[entity_id] = value
+            if self.cache.get("referenced:" + entity_id):
+                referenced.add(entity_id)
+        if len(unresolved) == 0:
+            return values, referenced
+        arguments = []
+        fields = []
+        variables = {}
+        for index, entity_id in enumerate(unresolved):
+            arguments.append("$id{}: String!".format(index))
+            fields.append(
+                "o{0}: stixObservable(id: $id{0}) {{ id observable_value "
+                "externalReferences {{ edges {{ node {{ id url }} }} }} }}".format(
+                    index
+                )
+            )
+            variables["id" + str(index)] = entity_id
+        query = "query Observables({}) {{ {} }}".format(
+            ", ".join(arguments), " ".join(fields)
+        )
+        result = self.helper.api.query(query, variables)
+        for index, entity_id in enumerate(unresolved):
+            observable = result["data"]["o" + str(index)]
+            if observable is None:
+                continue
+            value = observable["observable_value"]
+            values[entity_id] = value
+            self.cache.set("observable_value:" + entity_id, value)
+            for edge in observable["externalReferences"]["edges"]:
+                if edge["node"]["url"] == VIRUSTOTAL_URL + value:
+                    referenced.add(entity_id)
+                    self.cache.set("referenced:" + entity_id, True)
+                    self.cache.set("reference:" + value, edge["node"]["id"])
+                    break
+        return values, referenced
+
+    def _process_batch(self, entity_ids):
+        with self.metrics.timer("batch"):
+            results = self._enrich(entity_ids)
+        self.metrics.observe("batch_size", len(entity_ids))
+        return results
+
+    def _enrich(self, entity_ids):
+        results = {}
+        with self.metrics.timer("read_observables"):
+            values, referenced = self._read_observables(set(entity_ids))
+        # identical values share one reference
+        entities_by_value = OrderedDict()
+        for entity_id in entity_ids:
+            if entity_id not in values:
+                self.metrics.inc("enrichments_total", {"status": "not_found"})
+                results[entity_id] = ValueError(
+                    "Observable {} not found".format(entity_id)
+                )
+                continue
+            if entity_id in referenced:
+                self.metrics.inc("enrichments_total", {"status": "skipped"})
+                results[entity_id] = None
+                continue
+            entities_by_value.setdefault(values[entity_id], set()).add(entity_id)
+        self.helper.log_info(
+            "Enriching {} observables ({} distinct values, {} already referenced)".format(
+                len(entity_ids), len(entities_by_value), len(referenced)
+            )
+        )
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            references = {
+                value: executor.submit(self._get_reference_id, value)
+                for value in entities_by_value
+            }
+            attachments = {}
+            for value, value_entity_ids in entities_by_value.items():
+                try:
+                    reference_id = references[value].result()
+                except Exception as e:
+                    for entity_id in value_entity_ids:
+                        self.metrics.inc("enrichments_total", {"status": "failed"})
+                        results[entity_id] = e
+                    continue
+                for entity_id in value_entity_ids:
+                    attachments[entity_id] = executor.submit(
+                        self._attach_reference, entity_id, reference_id
+                    )
+            for entity_id, attachment in attachments.items():
+                try:
+                    attachment.result()
+                    self.metrics.inc("enrichments_total", {"status": "enriched"})
+                    results[entity_id] = None
+                except Exception as e:
+                    self.metrics.inc("enrichments_total", {"status": "failed"})
+                    results[entity_id] = e
+        # batches are processed one at a time by the listen queue
+        if time.time() - self.cache_saved_at >= CACHE_SAVE_INTERVAL:
+            self.cache.save()
+            self.cache_saved_at = time.time()
+        self.helper.log_info(
+            "Lookup cache: {hits} hits, {misses} misses, {size} entries".format(
+                **self.cache.stats()
+            )
         )
+        return results
+
+    def _process_messages(self, messages):
+        """enriching the observables of a batch of messages, returning None
+        or the error of each message"""
+        results = self._process_batch([data["entity_id"] for data in messages])
+        return [results.get(data["entity_id"]) for data in messages]
 
     def start(self):
-        self.helper.listen(self._process_message)
+        listen_queue = BatchListenQueue(
+            self.helper,
+            self.helper.config,
+            self._process_messages,
+            self.batch_size,
+            self.batch_window,
+        )
+        listen_queue.start()
 
 
 if __name__ == "__main__":